@@ -0,0 +1,482 @@
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import chargeexchange as CX
+
+# Physical set-up shared by the benchmarks, matching test_CX_function
+MASS = 1.0
+VOLUME = 2.0
+DENSITY = 3.3e18
+DT_SI = 1e-8
+CX_RATE = 5e-14
+# Slowdowns and memory growth smaller than these are treated as noise
+NOISE_FLOOR = 1e-3
+MEMORY_FLOOR = 2**20
+
+
+def setup(
+    number_of_macroparticles: int,
+    fluid_velocity: float = 1.5,
+    fluid_temperature: float = 1.0,
+    **particle_options
+):
+    vel = np.random.normal(1.5, 1.0, number_of_macroparticles)
+    weight = np.full(
+        number_of_macroparticles, DENSITY * VOLUME / number_of_macroparticles
+    )
+    neutrals = CX.Particles(MASS, weight, vel, **particle_options)
+    ions = CX.IonFluid(
+        MASS, DENSITY, fluid_velocity * DENSITY, fluid_temperature, VOLUME
+    )
+    return ions, neutrals
+
+
+def time_steps(
+    ions, neutrals, number_of_timesteps: int, dt: float = DT_SI, rate=CX_RATE
+) -> float:
+    # Wall-clock seconds per step of the runner's time loop body
+    total_energy = ions.kinetic_energy + neutrals.kinetic_energy
+    start = time.perf_counter()
+    for i in range(number_of_timesteps):
+        single_momentum_random = neutrals.sampleIonMom(ions)
+        neutrals.applyCX(rate, dt, ions, VOLUME, single_momentum_random, i)
+        neutrals.updateKineticEnergy()
+        neutrals.updatetemperature()
+        ions.updatetemperature(total_energy, neutrals.kinetic_energy)
+        ions.updateKineticEnergy()
+    return (time.perf_counter() - start) / number_of_timesteps
+
+
+def benchmark_pairing(sizes, number_of_timesteps: int) -> None:
+    # Cost per step of each ion-neutral pairing strategy as N grows
+    strategies = list(CX.PAIRING_STRATEGIES)
+    print("Cost per step [ms] of the ion-neutral pairing strategies")
+    print("%10s" % "N" + "".join("%12s" % name for name in strategies))
+    for number_of_macroparticles in sizes:
+        row = "%10d" % number_of_macroparticles
+        for name in strategies:
+            ions, neutrals = setup(number_of_macroparticles, pairing=name)
+            row += "%12.3f" % (1e3 * time_steps(ions, neutrals, number_of_timesteps))
+        print(row)
+
+
+def time_run(CXrunner) -> float:
+    # Wall-clock seconds of runner.runCX
+    start = time.perf_counter()
+    CXrunner.runCX()
+    return time.perf_counter() - start
+
+
+def benchmark_adaptive(number_of_macroparticles: int, tolerances) -> None:
+    # Fixed 1e-8 steps over the test_CX_function time span against adaptive
+    # runs, relaxing a cold, slow fluid towards the neutrals. Deterministic
+    # quantile sampling is used so the error of the fluid temperature, measured
+    # against a fixed-step run ten times finer, is the time error. Both the
+    # largest error over the run and the error of the final temperature are
+    # shown: the final state of a relaxation is reached most cheaply with
+    # uniform steps, while the error over the run is where adaptive steps gain.
+    def temperatures(number_of_timesteps, dt_SI, controller=None):
+        np.random.seed(0)
+        ions, neutrals = setup(
+            number_of_macroparticles,
+            fluid_velocity=0.0,
+            fluid_temperature=0.1,
+            pairing=CX.QuantilePairing(jitter=False),
+        )
+        CXrunner = CX.runner(
+            ions,
+            neutrals,
+            number_of_timesteps,
+            dt_SI,
+            CX_RATE,
+            VOLUME,
+            controller=controller,
+            diagnostics=CX.Diagnostics(produce_plots=False),
+        )
+        elapsed = time_run(CXrunner)
+        recorder = CXrunner.recorder
+        return (
+            elapsed,
+            CXrunner.number_of_steps_taken,
+            np.append(recorder.time, number_of_timesteps * dt_SI),
+            np.append(recorder.temperature_fluid, ions.temperature),
+        )
+
+    _, _, reference_time, reference = temperatures(32000, DT_SI / 10.0)
+
+    def row(label, elapsed, steps, time, temperature):
+        error = np.abs(temperature / np.interp(time, reference_time, reference) - 1.0)
+        print(
+            "%12s%10d%12.3f%14.2e%14.2e"
+            % (label, steps, elapsed, np.max(error), error[-1])
+        )
+
+    print("Adaptive timestepping against fixed steps of %g s" % DT_SI)
+    print(
+        "%12s%10s%12s%14s%14s"
+        % ("tolerance", "steps", "time [s]", "max T err", "final T err")
+    )
+    row("fixed", *temperatures(3200, DT_SI))
+    for tolerance in tolerances:
+        row(
+            "%g" % tolerance,
+            *temperatures(3200, DT_SI, CX.TimestepController(tolerance)),
+        )
+
+
+def benchmark_integrators(number_of_macroparticles: int, step_factors) -> None:
+    # Convergence of the explicit and exponential integrators over the
+    # test_CX_function time span as the step grows to many times the explicit
+    # stability limit. The error of the neutral bulk velocity is measured
+    # against the analytic coupled relaxation, and that of the final fluid
+    # temperature against an exponential run with 1e-10 s steps.
+    end_time = 3200 * DT_SI
+
+    def run(integrator, dt):
+        np.random.seed(0)
+        ions, neutrals = setup(
+            number_of_macroparticles,
+            fluid_velocity=0.0,
+            fluid_temperature=0.1,
+            pairing=CX.QuantilePairing(jitter=False),
+            integrator=integrator,
+        )
+        # Total momentum is conserved and the bulk gap decays as
+        # exp(-rate*(n_ions + n_neutrals)*t), which fixes the neutral bulk velocity
+        number_of_neutrals = np.sum(neutrals.weight)
+        number_of_ions = ions.density * VOLUME
+        bulk_velocity = np.sum(neutrals.weight * neutrals.vel) / number_of_neutrals
+        gap = bulk_velocity - ions.mom / (ions.mass * ions.density)
+        total_velocity = number_of_neutrals * bulk_velocity + ions.mom * VOLUME / MASS
+        decay = np.exp(
+            -CX_RATE * (ions.density + number_of_neutrals / VOLUME) * end_time
+        )
+        exact_velocity = (total_velocity + number_of_ions * gap * decay) / (
+            number_of_neutrals + number_of_ions
+        )
+
+        number_of_timesteps = int(round(end_time / dt))
+        elapsed = time_steps(ions, neutrals, number_of_timesteps, dt)
+        bulk_velocity = np.sum(neutrals.weight * neutrals.vel) / number_of_neutrals
+        return (
+            elapsed * number_of_timesteps,
+            abs(bulk_velocity - exact_velocity) / abs(gap),
+            ions.temperature,
+        )
+
+    _, _, reference = run("exponential", DT_SI / 100.0)
+    print("Convergence of the charge exchange integrators")
+    print(
+        "%10s%12s%10s%14s%14s%10s"
+        % ("dt [s]", "rate*n*dt", "steps", "integrator", "velocity err", "T err")
+    )
+    for factor in step_factors:
+        dt = DT_SI * factor
+        for integrator in CX.INTEGRATORS:
+            elapsed, velocity_error, temperature = run(integrator, dt)
+            print(
+                "%10.1e%12.3g%10d%14s%14.2e%10.2e"
+                % (
+                    dt,
+                    CX_RATE * DENSITY * dt,
+                    int(round(end_time / dt)),
+                    integrator,
+                    velocity_error,
+                    abs(temperature - reference) / reference,
+                )
+            )
+
+
+def benchmark_rates(sizes, number_of_timesteps: int) -> None:
+    # Cost per step of tabulated rate coefficients against the constant rate:
+    # a temperature table, whose cached value is reused while the fluid
+    # temperature stays within the tolerance, and a temperature x speed table
+    # looked up per macroparticle. The tables tabulate a synthetic power-law
+    # fit scaled to CX_RATE at the fluid temperature.
+    temperatures = np.geomspace(0.01, 100.0, 50)
+    speeds = np.linspace(0.0, 20.0, 50)
+    rates = {
+        "constant": lambda: CX_RATE,
+        "temperature": lambda: CX.RateCoefficients(
+            CX.RateTable.from_function(lambda T: CX_RATE * T**0.3, temperatures)
+        ),
+        "speed": lambda: CX.RateCoefficients(
+            CX.RateTable.from_function(
+                lambda T, s: CX_RATE * T**0.3 * (1.0 + 0.05 * s), temperatures, speeds
+            )
+        ),
+    }
+    print("Cost per step [ms] of constant and tabulated rates")
+    print("%10s" % "N" + "".join("%14s" % name for name in rates))
+    for number_of_macroparticles in sizes:
+        row = "%10d" % number_of_macroparticles
+        for make_rate in rates.values():
+            np.random.seed(0)
+            ions, neutrals = setup(number_of_macroparticles)
+            elapsed = time_steps(ions, neutrals, number_of_timesteps, rate=make_rate())
+            row += "%14.3f" % (1e3 * elapsed)
+        print(row)
+
+
+def suite_cases(number_of_macroparticles: int, number_of_timesteps: int) -> dict:
+    # The hot path pieces timed by the suite, each as (function, work) where
+    # one call of function does `work` units: particle updates for the charge
+    # exchange step, samples for getRandomMom, particle steps for a full run and
+    # history entries for building Plotting from a (time x particle) history
+    def apply_cx():
+        ions, neutrals = setup(number_of_macroparticles)
+        ionSingleMom = neutrals.sampleIonMom(ions)
+        for i in range(number_of_timesteps):
+            neutrals.applyCX(CX_RATE, DT_SI, ions, VOLUME, ionSingleMom, i)
+
+    ions, _ = setup(1)
+
+    def get_random_mom():
+        for i in range(number_of_timesteps):
+            ions.getRandomMom(number_of_macroparticles)
+
+    def run_cx():
+        ions, neutrals = setup(number_of_macroparticles)
+        CX.runner(
+            ions,
+            neutrals,
+            number_of_timesteps,
+            DT_SI,
+            CX_RATE,
+            VOLUME,
+            diagnostics=CX.Diagnostics(produce_plots=False),
+        ).runCX()
+
+    # The history repeats one velocity row, so only the reductions over it,
+    # and not the history itself, count towards the time and peak memory
+    ions, neutrals = setup(number_of_macroparticles)
+    history = np.broadcast_to(
+        neutrals.vel, (number_of_timesteps, number_of_macroparticles)
+    )
+    times = DT_SI * np.arange(number_of_timesteps)
+    fluid_momentum = np.full(number_of_timesteps, ions.mom)
+
+    def plotting():
+        CX.Plotting(
+            times, MASS, neutrals.weight, DENSITY, history, fluid_momentum, VOLUME
+        )
+
+    updates = number_of_macroparticles * number_of_timesteps
+    return {
+        "applyCX": (apply_cx, updates),
+        "getRandomMom": (get_random_mom, updates),
+        "runCX": (run_cx, updates),
+        "Plotting": (plotting, updates),
+    }
+
+
+def measure(function, repeats: int) -> tuple:
+    # Best wall-clock time of `repeats` calls, then the peak traced memory of
+    # one more call; tracing slows numpy down so it is kept out of the timing
+    seconds = np.inf
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        function()
+        seconds = min(seconds, time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak_memory
+
+
+def scaling_exponent(sizes, seconds) -> float:
+    # Least squares slope of log(time) against log(size), 1 for linear cost
+    if len(sizes) < 2:
+        return float("nan")
+    return float(np.polyfit(np.log(sizes), np.log(seconds), 1)[0])
+
+
+def benchmark_suite(sizes, step_counts, repeats: int = 3) -> dict:
+    # Sweeps particle and step counts over the suite cases and returns the
+    # results in the machine-readable form stored as a baseline
+    results = []
+    print("Charge exchange hot path suite")
+    print(
+        "%14s%10s%8s%12s%16s%14s"
+        % ("case", "N", "steps", "time [s]", "throughput [/s]", "peak [MiB]")
+    )
+    for number_of_macroparticles in sizes:
+        for number_of_timesteps in step_counts:
+            cases = suite_cases(number_of_macroparticles, number_of_timesteps)
+            for case, (function, work) in cases.items():
+                seconds, peak_memory = measure(function, repeats)
+                results.append(
+                    {
+                        "case": case,
+                        "particles": number_of_macroparticles,
+                        "steps": number_of_timesteps,
+                        "seconds": seconds,
+                        "throughput": work / seconds,
+                        "peak_memory": peak_memory,
+                    }
+                )
+                print(
+                    "%14s%10d%8d%12.4f%16.3e%14.2f"
+                    % (
+                        case,
+                        number_of_macroparticles,
+                        number_of_timesteps,
+                        seconds,
+                        work / seconds,
+                        peak_memory / 2.0**20,
+                    )
+                )
+
+    # Exponents of time against particle count at the largest step count and
+    # against step count at the largest particle count
+    scaling = {}
+    print("Scaling exponents of time")
+    print("%14s%12s%12s" % ("case", "particles", "steps"))
+    for case in cases:
+
+        def seconds_where(**fixed):
+            return [
+                result["seconds"]
+                for result in results
+                if result["case"] == case
+                and all(result[key] == value for key, value in fixed.items())
+            ]
+
+        scaling[case] = {
+            "particles": scaling_exponent(sizes, seconds_where(steps=max(step_counts))),
+            "steps": scaling_exponent(step_counts, seconds_where(particles=max(sizes))),
+        }
+        print(
+            "%14s%12.2f%12.2f"
+            % (case, scaling[case]["particles"], scaling[case]["steps"])
+        )
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "results": results,
+        "scaling": scaling,
+    }
+
+
+def compare_to_baseline(suite: dict, baseline: dict, threshold: float) -> list:
+    # Cases whose time or peak memory grew by more than `threshold` times the
+    # baseline, ignoring changes below NOISE_FLOOR and MEMORY_FLOOR. Speedups
+    # are reported as the baseline/new time ratio.
+    previous = {
+        (result["case"], result["particles"], result["steps"]): result
+        for result in baseline["results"]
+    }
+    regressions = []
+    print("Comparison with baseline (speedup = baseline time / time)")
+    print("%14s%10s%8s%10s%14s" % ("case", "N", "steps", "speedup", "memory ratio"))
+    for result in suite["results"]:
+        key = (result["case"], result["particles"], result["steps"])
+        if key not in previous:
+            continue
+        speedup = previous[key]["seconds"] / result["seconds"]
+        memory_ratio = result["peak_memory"] / max(previous[key]["peak_memory"], 1)
+        slower = (
+            1.0 / speedup > threshold
+            and result["seconds"] - previous[key]["seconds"] > NOISE_FLOOR
+        )
+        grown = (
+            memory_ratio > threshold
+            and result["peak_memory"] - previous[key]["peak_memory"] > MEMORY_FLOOR
+        )
+        regressed = slower or grown
+        if regressed:
+            regressions.append(key)
+        print(
+            "%14s%10d%8d%10.2f%14.2f%s"
+            % (key + (speedup, memory_ratio, "  REGRESSION" if regressed else ""))
+        )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Charge exchange benchmarks")
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 100000, 1000000],
+        help="Numbers of macroparticles to benchmark",
+    )
+    parser.add_argument(
+        "--timesteps", type=int, default=20, help="Timesteps timed per point"
+    )
+    parser.add_argument(
+        "--tolerances",
+        type=float,
+        nargs="+",
+        default=[1e-2, 1e-3, 1e-4],
+        help="Error tolerances of the adaptive timestep benchmark",
+    )
+    parser.add_argument(
+        "--step-factors",
+        type=float,
+        nargs="+",
+        default=[1, 10, 100, 400, 3200],
+        help="Multiples of the 1e-8 s step for the integrator benchmark",
+    )
+    parser.add_argument(
+        "--steps",
+        type=int,
+        nargs="+",
+        default=[10, 100],
+        help="Step counts swept by the suite benchmark",
+    )
+    parser.add_argument(
+        "--save-baseline", help="Write the suite results to this JSON file"
+    )
+    parser.add_argument(
+        "--compare", help="Compare the suite results with this JSON baseline"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.25,
+        help="Slowdown or memory growth over the baseline counted as a regression",
+    )
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        help="Benchmarks to run: pairing, adaptive, integrators, rates, suite "
+        "(default: pairing, adaptive and integrators, or only suite with "
+        "--save-baseline or --compare)",
+    )
+    args = parser.parse_args()
+    baseline = args.save_baseline or args.compare
+    if not args.benchmarks:
+        args.benchmarks = (
+            ["suite"] if baseline else ["pairing", "adaptive", "integrators"]
+        )
+    elif baseline and "suite" not in args.benchmarks:
+        args.benchmarks.append("suite")
+    if "pairing" in args.benchmarks:
+        benchmark_pairing(args.sizes, args.timesteps)
+    if "adaptive" in args.benchmarks:
+        benchmark_adaptive(2000, args.tolerances)
+    if "integrators" in args.benchmarks:
+        benchmark_integrators(2000, args.step_factors)
+    if "rates" in args.benchmarks:
+        benchmark_rates(args.sizes, args.timesteps)
+    if "suite" in args.benchmarks:
+        suite = benchmark_suite(args.sizes, args.steps)
+        if args.save_baseline:
+            with open(args.save_baseline, "w") as baseline_file:
+                json.dump(suite, baseline_file, indent=2)
+        if args.compare:
+            with open(args.compare) as baseline_file:
+                regressions = compare_to_baseline(
+                    suite, json.load(baseline_file), args.threshold
+                )
+            if regressions:
+                sys.exit(1)
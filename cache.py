@@ -0,0 +1,262 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from types import SimpleNamespace
+
+import numpy as np
+import chargeexchange as CX
+
+
+def _update(hasher, value) -> None:
+    # Feeds a canonical encoding of nested dicts, sequences, arrays and scalars
+    # to hasher; equal inputs always give the same bytes
+    if isinstance(value, dict):
+        hasher.update(b"dict")
+        for name in sorted(value):
+            _update(hasher, name)
+            _update(hasher, value[name])
+    elif isinstance(value, (list, tuple)):
+        hasher.update(b"list%d" % len(value))
+        for item in value:
+            _update(hasher, item)
+    elif isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        hasher.update(("array%s%s" % (value.dtype.str, value.shape)).encode())
+        hasher.update(value.tobytes())
+    else:
+        hasher.update((type(value).__name__ + repr(value)).encode())
+
+
+def source_version(*paths) -> str:
+    # Digest of the source files a result depends on, so editing the code
+    # invalidates every cached result computed with the old version
+    hasher = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as source:
+            hasher.update(source.read())
+    return hasher.hexdigest()
+
+
+def _sampler_inputs(sampler: CX.IonSampler):
+    if sampler is None:
+        return None
+    return {
+        "method": sampler.method,
+        "batch_size": sampler.batch_size,
+        "moment_matched": sampler.moment_matched,
+        "state": sampler.generator.bit_generator.state,
+        "batch": sampler._batch,
+        "cursor": sampler._cursor,
+    }
+
+
+def _rate_inputs(CXrate):
+    if not isinstance(CXrate, CX.RateCoefficients):
+        return np.asarray(CXrate)
+    return {
+        "grid": CXrate.table.grid,
+        "temperatures": CXrate.table.temperatures,
+        "speeds": CXrate.table.speeds,
+        "temperature_tolerance": CXrate.temperature_tolerance,
+        "temperature": CXrate.temperature,
+        "cached": CXrate.cached,
+    }
+
+
+# Particle attributes which are scratch space, instrumentation or handles on
+# worker processes and shared memory rather than inputs of a run
+RUNTIME_ATTRIBUTES = (
+    "workspace",
+    "timer",
+    "collect_metrics",
+    "metrics",
+    "memory",
+    "workers",
+    "_shard",
+)
+
+
+def _object_inputs(value):
+    # An object's class and attributes, recursively, so options added by
+    # subclasses (tolerances, chunk sizes, seeds) are part of the key; random
+    # streams are keyed by their state
+    if isinstance(value, np.random.Generator):
+        return value.bit_generator.state
+    if isinstance(value, np.random.SeedSequence):
+        return {"entropy": value.entropy, "spawn_key": value.spawn_key}
+    if isinstance(value, dict):
+        return {name: _object_inputs(item) for name, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_object_inputs(item) for item in value]
+    if hasattr(value, "__dict__"):
+        return [
+            type(value).__name__,
+            {
+                name: _object_inputs(item)
+                for name, item in vars(value).items()
+                if name not in RUNTIME_ATTRIBUTES
+            },
+        ]
+    return value
+
+
+def run_inputs(
+    ions: CX.IonFluid,
+    neutrals: CX.Particles,
+    number_of_timesteps,
+    dt_SI,
+    CXrate,
+    Volume,
+    recorder: CX.Recorder = None,
+    controller: CX.TimestepController = None,
+) -> dict:
+    # Everything a runner run depends on: the fluid and macroparticle state,
+    # the sampler's stream position, the numerical options and time stepping
+    return {
+        "ions": {
+            "class": type(ions).__name__,
+            "mass": ions.mass,
+            "density": np.asarray(ions.density),
+            "mom": np.asarray(ions.mom),
+            "temperature": np.asarray(ions.temperature),
+            "Volume": np.asarray(ions.Volume),
+            "sampler": _sampler_inputs(ions.sampler),
+        },
+        # Read through vars() rather than the vel property, which resamples
+        # HybridParticles in moment mode
+        "neutrals": _object_inputs(neutrals),
+        "number_of_timesteps": number_of_timesteps,
+        "dt_SI": dt_SI,
+        "CXrate": _rate_inputs(CXrate),
+        "Volume": np.asarray(Volume),
+        "recorder": None if recorder is None else recorder.interval,
+        "controller": None if controller is None else vars(controller),
+    }
+
+
+class ResultCache:
+    # Content-addressed store of run results. Each entry is a directory named
+    # by the digest of the run inputs and the code version, holding one .npy
+    # file per recorded series; entries are loaded memory-mapped, so a hit
+    # costs milliseconds whatever the length of the run. The least recently
+    # used entries are evicted once the cache grows beyond max_bytes.
+    def __init__(self, directory, max_bytes: int = 2**30) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, inputs: dict, sources=(CX.__file__,)) -> str:
+        hasher = hashlib.sha256()
+        _update(hasher, inputs)
+        hasher.update(source_version(*sources).encode())
+        return hasher.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str) -> dict:
+        # The arrays stored under key as read-only memory maps, or None on a miss
+        path = self._path(key)
+        try:
+            names = os.listdir(path)
+            os.utime(path)  # Marks the entry as recently used
+            return {
+                name[: -len(".npy")]: np.load(os.path.join(path, name), mmap_mode="r")
+                for name in names
+            }
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, arrays: dict) -> None:
+        # Entries are written to a temporary directory and renamed into place,
+        # so concurrent writers (e.g. sweep workers) never expose a partial
+        # entry; if another writer got there first its entry is kept
+        staging = tempfile.mkdtemp(dir=self.directory, prefix=".staging-")
+        for name, array in arrays.items():
+            np.save(os.path.join(staging, name + ".npy"), np.asarray(array))
+        try:
+            os.replace(staging, self._path(key))
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+        self.evict()
+
+    def _entries(self) -> list:
+        # (last used, size in bytes, path) of every complete entry
+        entries = []
+        for name in os.listdir(self.directory):
+            path = self._path(name)
+            if name.startswith(".staging-"):
+                continue
+            try:
+                size = sum(
+                    os.path.getsize(os.path.join(path, file))
+                    for file in os.listdir(path)
+                )
+                entries.append((os.path.getmtime(path), size, path))
+            except FileNotFoundError:
+                continue
+        return sorted(entries)
+
+    def size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self) -> None:
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+def run_cached(
+    cache: ResultCache,
+    ions: CX.IonFluid,
+    neutrals: CX.Particles,
+    number_of_timesteps,
+    dt_SI,
+    CXrate,
+    Volume,
+    seed=None,
+    recorder: CX.Recorder = None,
+    controller: CX.TimestepController = None,
+    diagnostics: CX.Diagnostics = None,
+):
+    # Runs runner.runCX unless a run with the same inputs, seed and code has
+    # been cached, and returns the recorded series as attributes (as Recorder
+    # does), with cache_hit telling whether the run was skipped. seed seeds
+    # the global numpy RNG for runs without an IonSampler; unseeded, such runs
+    # are keyed by the current global state instead. On a hit ions and
+    # neutrals are not advanced; only the recorded history is restored.
+    inputs = run_inputs(
+        ions, neutrals, number_of_timesteps, dt_SI, CXrate, Volume, recorder, controller
+    )
+    inputs["seed"] = seed
+    if seed is None and ions.sampler is None:
+        inputs["global_random"] = np.random.get_state()
+    key = cache.key(inputs)
+    arrays = cache.get(key)
+    if arrays is not None:
+        return SimpleNamespace(cache_hit=True, **arrays)
+
+    if seed is not None:
+        np.random.seed(seed)
+    CXrunner = CX.runner(
+        ions,
+        neutrals,
+        number_of_timesteps,
+        dt_SI,
+        CXrate,
+        Volume,
+        recorder=recorder,
+        controller=controller,
+        diagnostics=diagnostics,
+    )
+    CXrunner.runCX()
+    arrays = {
+        name: getattr(CXrunner.recorder, name) for name in CX.Recorder.diagnostics
+    }
+    cache.put(key, arrays)
+    return SimpleNamespace(cache_hit=False, **arrays)
@@ -1,5 +1,241 @@
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+import warnings
+from types import SimpleNamespace
+
 import numpy as np
-import matplotlib.pyplot as plt  # Used for plotting
+from scipy.special import ndtri  # Inverse of the standard normal CDF
+
+
+def _members(value):
+    # Per-ensemble quantities (shape (ensemble,)) gain a trailing macroparticle
+    # axis so they broadcast against (ensemble x macroparticle) particle arrays.
+    # Scalars are returned unchanged so single realisations behave as before.
+    if np.ndim(value) == 0:
+        return value
+    return np.expand_dims(value, -1)
+
+
+def _ensemble_mean(series):
+    # Reduces a (time x ensemble) series to the ensemble average for plotting
+    series = np.asarray(series)
+    if series.ndim <= 1:
+        return series
+    return np.mean(series, axis=tuple(range(1, series.ndim)))
+
+
+def _chunked_moments(values, weights, chunk_size: int):
+    # Weighted mean and standard deviation over the trailing axis accumulated
+    # chunk by chunk with the Welford/Chan update, so temporaries are bounded
+    # by chunk_size
+    total_weight = np.zeros(np.shape(values)[:-1])
+    mean = np.zeros(np.shape(values)[:-1])
+    m2 = np.zeros(np.shape(values)[:-1])
+    weights = np.broadcast_to(weights, np.shape(values))
+    for start in range(0, np.shape(values)[-1], chunk_size):
+        chunk = values[..., start : start + chunk_size]
+        chunk_weights = weights[..., start : start + chunk_size]
+        chunk_weight = np.sum(chunk_weights, axis=-1)
+        chunk_mean = np.sum(chunk_weights * chunk, axis=-1) / chunk_weight
+        chunk_m2 = np.sum(
+            chunk_weights * (chunk - chunk_mean[..., None]) ** 2.0, axis=-1
+        )
+        combined_weight = total_weight + chunk_weight
+        delta = chunk_mean - mean
+        mean = mean + delta * chunk_weight / combined_weight
+        m2 = (
+            m2
+            + chunk_m2
+            + delta * delta * total_weight * chunk_weight / combined_weight
+        )
+        total_weight = combined_weight
+    return mean, np.sqrt(m2 / total_weight)
+
+
+def _accurate_sum(values, axis: int = -1) -> float:
+    # Pairwise summation in float64 whatever the storage precision. Products of
+    # two float32 values are exact in float64, so momentum and energy sums of
+    # float32 macroparticles are as accurate as in float64 storage.
+    return np.add.reduce(values, axis=axis, dtype=np.float64)
+
+
+def _event_generator(ionFluid) -> np.random.Generator:
+    # Random source of the stochastic mode: the fluid's IonSampler stream, or
+    # otherwise a generator seeded from the global numpy state so that
+    # np.random.seed still makes runs reproducible
+    if ionFluid.sampler is not None:
+        return ionFluid.sampler.generator
+    return np.random.default_rng(np.random.randint(2**31))
+
+
+class Workspace:
+    # Scratch arrays reused by the charge exchange hot path so that a step
+    # writes into existing memory with out= instead of allocating temporaries.
+    # A buffer is only reallocated when its shape or dtype changes, e.g. when
+    # the split/merge engine changes the number of macroparticles.
+    def __init__(self) -> None:
+        self._buffers = {}
+
+    def buffer(self, name: str, shape: tuple, dtype=np.float64):
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            self._buffers[name] = buffer
+        return buffer
+
+
+def _pyplot():
+    # matplotlib is only imported when something is plotted. Unless pyplot is
+    # already in use the headless Agg backend is selected, so rendering needs
+    # no display and starts quickly.
+    if "matplotlib.pyplot" not in sys.modules:
+        import matplotlib
+
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    return plt
+
+
+def _resize_npy(path, shape: tuple) -> None:
+    # Changes the leading dimension of a .npy file in place. numpy pads headers
+    # so the shape can grow, so only the header and the file length change.
+    with open(path, "r+b") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            _, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            length_field = 2
+        else:
+            _, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            length_field = 4
+        data_offset = f.tell()
+        header = repr(
+            {
+                "descr": np.lib.format.dtype_to_descr(dtype),
+                "fortran_order": fortran_order,
+                "shape": tuple(shape),
+            }
+        )
+        header_start = np.lib.format.MAGIC_LEN + length_field
+        space = data_offset - header_start - 1
+        if len(header) > space:
+            raise ValueError("No room in the .npy header of " + str(path))
+        f.seek(header_start)
+        f.write((header.ljust(space) + "\n").encode("latin1"))
+        f.truncate(data_offset + int(np.prod(shape)) * dtype.itemsize)
+
+
+class IonSampler:
+    # Reproducible source of standard normal variates for IonFluid, built on a
+    # numpy.random.Generator with an explicit seed. Samples for batch_size
+    # timesteps are generated in one bulk call and handed out one timestep at a
+    # time. method selects plain normal draws, antithetic pairs (+z, -z) or
+    # scrambled Sobol points mapped through the inverse normal CDF. With
+    # moment_matched each timestep's samples are standardised to exactly zero
+    # mean and unit variance while the batch is generated, so getRandomMom
+    # needs no further passes over the samples.
+    methods = ("normal", "antithetic", "sobol")
+
+    def __init__(
+        self,
+        seed=None,
+        batch_size: int = 64,
+        method: str = "normal",
+        moment_matched: bool = True,
+    ) -> None:
+        if method not in self.methods:
+            raise ValueError("Unknown sampling method " + str(method))
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self.seed_sequence = seed
+        self.generator = np.random.Generator(np.random.PCG64(seed))
+        self.batch_size = batch_size
+        self.method = method
+        self.moment_matched = moment_matched
+        self._batch = None
+        self._batch_state = None
+        self._cursor = 0
+
+    def spawn(self, number_of_streams: int) -> list:
+        # Independent child samplers, e.g. one per ensemble member or sweep point
+        return [
+            IonSampler(child, self.batch_size, self.method, self.moment_matched)
+            for child in self.seed_sequence.spawn(number_of_streams)
+        ]
+
+    def standard_normal(self, shape: tuple) -> float:
+        shape = tuple(shape)
+        if (
+            self._batch is None
+            or self._cursor == self.batch_size
+            or self._batch.shape[1:] != shape
+        ):
+            # The generator state a batch was drawn from is kept, so a
+            # checkpoint can regenerate the batch instead of storing it
+            self._batch_state = self.generator.bit_generator.state
+            self._batch = self._generate((self.batch_size,) + shape)
+            self._cursor = 0
+        self._cursor += 1
+        return self._batch[self._cursor - 1]
+
+    def get_state(self) -> dict:
+        # Position in the stream, small enough to checkpoint every step
+        return {
+            "state": self.generator.bit_generator.state,
+            "batch_state": self._batch_state,
+            "batch_shape": None if self._batch is None else list(self._batch.shape),
+            "cursor": self._cursor,
+        }
+
+    def set_state(self, state: dict) -> None:
+        if state["batch_shape"] is None:
+            self._batch = None
+        else:
+            self.generator.bit_generator.state = state["batch_state"]
+            self._batch = self._generate(tuple(state["batch_shape"]))
+        self._batch_state = state["batch_state"]
+        self._cursor = state["cursor"]
+        self.generator.bit_generator.state = state["state"]
+
+    def _generate(self, shape: tuple) -> float:
+        number_of_samples = shape[-1]
+        if self.method == "normal":
+            z = self.generator.standard_normal(shape)
+        elif self.method == "antithetic":
+            half = self.generator.standard_normal(
+                shape[:-1] + (number_of_samples // 2,)
+            )
+            middle = np.zeros(shape[:-1] + (number_of_samples % 2,))
+            z = np.concatenate((half, -half, middle), axis=-1)
+        else:
+            # One Sobol dimension per timestep (and ensemble member), with the
+            # macroparticles as the points of the sequence. Dimensions beyond
+            # scipy's limit are drawn from further independently scrambled
+            # engines. scipy.stats is only imported here as it takes most of the
+            # import time of this module.
+            from scipy.stats import qmc
+
+            dimensions = int(np.prod(shape[:-1]))
+            u = np.empty((number_of_samples, dimensions))
+            for start in range(0, dimensions, qmc.Sobol.MAXDIM):
+                stop = min(start + qmc.Sobol.MAXDIM, dimensions)
+                engine = qmc.Sobol(stop - start, scramble=True, seed=self.generator)
+                with warnings.catch_warnings():
+                    # Sobol balance is best for powers of 2 but any count is valid
+                    warnings.simplefilter("ignore", UserWarning)
+                    u[:, start:stop] = engine.random(number_of_samples)
+            u = np.clip(u, np.finfo(float).tiny, 1.0 - np.finfo(float).epsneg)
+            z = ndtri(u.T.reshape(shape))
+        if self.moment_matched:
+            if self.method != "antithetic":
+                z -= np.mean(z, axis=-1, keepdims=True)
+            z /= np.sqrt(np.mean(z * z, axis=-1, keepdims=True))
+        return z
 
 
 class IonFluid:
@@ -10,9 +246,13 @@ class IonFluid:
         momentum: float,
         temperature: float,
         Volume: float,
+        sampler: IonSampler = None,
     ) -> None:
         self.density = density  # Density of the fluid
-        self.mom = momentum  # Bulk pseudo momentum (density * bulk velocity)
+        # Bulk pseudo momentum (density * bulk velocity). In ensemble mode this is
+        # a vector with one entry per member, copied so in-place updates do not
+        # alias the caller's array.
+        self.mom = momentum if np.ndim(momentum) == 0 else np.array(momentum, float)
         self.mass = mass  # Mass of a single ion in the fluid
         # self.kinetic_energy = density*Volume*(0.5*temperature) #0.5*(Number_of_ions)*(average value of v^2 in terms of temperature)
         self.kinetic_energy = ((momentum * Volume) ** 2.0) / (
@@ -20,19 +260,31 @@ class IonFluid:
         ) + mass * density * Volume * ((temperature / mass)) / 2.0
         self.temperature = temperature
         self.Volume = Volume
+        # Optional seeded sampler; without one the global np.random state is used
+        self.sampler = sampler
+
+    @property
+    def ensemble_shape(self) -> tuple:
+        # () for a single realisation, (ensemble,) when the state is per-member
+        return np.broadcast(self.mom, self.density, self.temperature).shape
 
     def getRandomMom(self, number_of_samples: int) -> float:
         # Sample velocity with standard deviation = particle thermal velocity = sqrt(KT/M)
-        velocity_single_ion = self.mom / (self.mass * self.density)
+        # In ensemble mode one row of samples is drawn per member in a single call
+        velocity_single_ion = _members(self.mom / (self.mass * self.density))
+        thermal_velocity = _members((self.temperature / self.mass) ** 0.5)
+        if self.sampler is not None:
+            z = self.sampler.standard_normal(self.ensemble_shape + (number_of_samples,))
+            return self.mass * (velocity_single_ion + thermal_velocity * z)
         b = np.random.normal(
             velocity_single_ion,
-            (self.temperature / self.mass) ** 0.5,
-            number_of_samples,
+            thermal_velocity,
+            self.ensemble_shape + (number_of_samples,),
         )
         b = (
             self.mass
-            * (b - np.mean(b))
-            * (((self.temperature / self.mass) ** 0.5) / (np.std(b)))
+            * (b - np.mean(b, axis=-1, keepdims=True))
+            * (thermal_velocity / (np.std(b, axis=-1, keepdims=True)))
             + self.mass * velocity_single_ion
         )
         # plt.clf()
@@ -43,6 +295,41 @@ class IonFluid:
         # plt.savefig("./Fluid_Images/Distvel"+str(n)+".png")
         return b
 
+    def getEventMom(self, members, generator) -> float:
+        # One independent ion momentum per charge exchange event, drawn from the
+        # fluid of the ensemble member each event belongs to. Unlike
+        # getRandomMom the draws are not renormalised, as there may be very few.
+        velocity_single_ion = np.ravel(
+            np.broadcast_to(self.mom / (self.mass * self.density), self.ensemble_shape)
+        )[members]
+        thermal_velocity = np.ravel(
+            np.broadcast_to((self.temperature / self.mass) ** 0.5, self.ensemble_shape)
+        )[members]
+        z = generator.standard_normal(len(members))
+        return self.mass * (velocity_single_ion + thermal_velocity * z)
+
+    def getQuantileMom(self, number_of_samples: int, jitter: bool = True) -> float:
+        # Generates ion momenta directly in ascending order by mapping stratified
+        # points (i + U_i)/N through the inverse normal CDF, so no sort is needed.
+        # The affine renormalisation to the target mean and variance keeps order.
+        velocity_single_ion = _members(self.mom / (self.mass * self.density))
+        thermal_velocity = _members((self.temperature / self.mass) ** 0.5)
+        shape = self.ensemble_shape + (number_of_samples,)
+        uniform = (
+            np.random.uniform
+            if self.sampler is None
+            else self.sampler.generator.uniform
+        )
+        offset = uniform(0.0, 1.0, shape) if jitter else 0.5
+        z = ndtri((np.arange(number_of_samples) + offset) / number_of_samples)
+        z = np.broadcast_to(z, shape)
+        return (
+            self.mass
+            * (z - np.mean(z, axis=-1, keepdims=True))
+            * (thermal_velocity / np.std(z, axis=-1, keepdims=True))
+            + self.mass * velocity_single_ion
+        )
+
     def updateKineticEnergy(self) -> None:
         self.kinetic_energy = ((self.mom * self.Volume) ** 2.0) / (
             2.0 * (self.mass * self.density * self.Volume)
@@ -74,23 +361,48 @@ class Plotting:
         Volume: float,
     ) -> None:
         self.time = time
-        self.momentum_particles = np.zeros((len(time), len(weight)))
-        for i in range(len(time)):
-            self.momentum_particles[i, :] = mass * weight[:] * particle_velocity[i, :]
+        # particle_velocity is (time x macroparticle), or (time x ensemble x
+        # macroparticle) for ensemble runs, which are plotted as ensemble averages
+        self.bulk_momentum = _ensemble_mean(
+            mass * np.einsum("...n,...n->...", particle_velocity, weight)
+        )
+        self.mean = _ensemble_mean(mass * np.mean(particle_velocity, axis=-1))
+        self.std = _ensemble_mean(mass * np.std(particle_velocity, axis=-1))
+        self.fluid_momentum = _ensemble_mean(fluid_momentum * Volume)
+        self.fluid_velocity = _ensemble_mean(fluid_momentum / density)
+
+    @classmethod
+    def from_recorder(cls, recorder: "Recorder", Volume: float) -> "Plotting":
+        # Builds the plots from the reduced diagnostics of a Recorder, so no
+        # (time x macroparticle) history is ever needed
+        plot = cls.__new__(cls)
+        plot.time = recorder.time
+        plot.bulk_momentum = _ensemble_mean(recorder.bulk_momentum)
+        plot.mean = _ensemble_mean(recorder.mean)
+        plot.std = _ensemble_mean(recorder.std)
+        plot.fluid_momentum = _ensemble_mean(recorder.fluid_momentum * Volume)
+        plot.fluid_velocity = _ensemble_mean(
+            recorder.fluid_momentum / recorder.fluid_density
+        )
+        return plot
 
-        self.bulk_momentum = np.sum(self.momentum_particles, axis=1)
-        self.mean = mass * np.mean(particle_velocity, axis=1)
-        self.std = mass * np.std(particle_velocity, axis=1)
-        self.fluid_momentum = fluid_momentum * Volume
-        self.fluid_velocity = fluid_momentum / density
+    def _decimation(self, plt) -> slice:
+        # Every n-th record, so that about two records fall on each pixel
+        # column of the figure; long runs then cost no more to draw than short
+        figure = plt.gcf()
+        points = 2 * int(figure.get_figwidth() * figure.dpi)
+        return slice(None, None, max(1, -(-len(self.time) // points)))
 
     def plot_bulk_properties(self, filename) -> None:
+        plt = _pyplot()
         plt.clf()
-        plt.plot(self.time, self.bulk_momentum, "g", label="Total Momentum Particles")
-        plt.plot(self.time, self.fluid_momentum, "k", label="Total Momentum Fluid")
+        d = self._decimation(plt)
+        time = self.time[d]
+        plt.plot(time, self.bulk_momentum[d], "g", label="Total Momentum Particles")
+        plt.plot(time, self.fluid_momentum[d], "k", label="Total Momentum Fluid")
         plt.plot(
-            self.time,
-            self.fluid_momentum + self.bulk_momentum,
+            time,
+            self.fluid_momentum[d] + self.bulk_momentum[d],
             "r",
             label="Total Momentum Fluid + Particles",
         )
@@ -101,10 +413,14 @@ class Plotting:
         plt.tight_layout()
         plt.savefig(filename)
 
+    def plot_momentum_conservation(self, filename) -> None:
+        plt = _pyplot()
         plt.clf()
+        d = self._decimation(plt)
+        total_momentum = self.fluid_momentum + self.bulk_momentum
         plt.plot(
-            self.time,
-            (self.fluid_momentum + self.bulk_momentum - self.fluid_momentum[0] - self.bulk_momentum[0])/(self.fluid_momentum[0] - self.bulk_momentum[0]),
+            self.time[d],
+            (total_momentum[d] - total_momentum[0]) / total_momentum[0],
             "r",
             label="Normalised Momentum Conservation",
         )
@@ -113,30 +429,30 @@ class Plotting:
         plt.xlabel("Time [Seconds]")
         plt.ylabel("Momentum [Nektar Units]")
         plt.tight_layout()
-        plt.savefig("momentum_conservation.png")    
-    
+        plt.savefig(filename)
 
     def plot_single_properties(self, filename) -> None:
+        plt = _pyplot()
         plt.clf()
+        d = self._decimation(plt)
+        time, mean, std = self.time[d], self.mean[d], self.std[d]
         plt.fill_between(
-            self.time,
-            self.mean - 3.0 * self.std,
-            self.mean + 3.0 * self.std,
+            time,
+            mean - 3.0 * std,
+            mean + 3.0 * std,
             color="g",
             alpha=0.2,
         )
         plt.fill_between(
-            self.time,
-            self.mean - 2.0 * self.std,
-            self.mean + 2.0 * self.std,
+            time,
+            mean - 2.0 * std,
+            mean + 2.0 * std,
             color="g",
             alpha=0.3,
         )
-        plt.fill_between(
-            self.time, self.mean - self.std, self.mean + self.std, color="g", alpha=0.4
-        )
-        plt.plot(self.time, self.mean, "g", label="Mean Neutral Momentum")
-        plt.plot(self.time, self.fluid_velocity, "k", label="Mean Ion Momentum")
+        plt.fill_between(time, mean - std, mean + std, color="g", alpha=0.4)
+        plt.plot(time, mean, "g", label="Mean Neutral Momentum")
+        plt.plot(time, self.fluid_velocity[d], "k", label="Mean Ion Momentum")
         plt.xlim([0, self.time.max()])
         plt.legend(loc="upper right")
         plt.xlabel("Time [Seconds]")
@@ -145,20 +461,23 @@ class Plotting:
         plt.savefig(filename)
 
     def plot_log_exp(self, rate, ion_density, filename) -> None:
+        plt = _pyplot()
         plt.clf()
+        d = self._decimation(plt)
+        time = self.time[d]
         slope_fluid = np.log(
-            (self.fluid_velocity - self.fluid_velocity[0] / 2.0 - self.mean[0] / 2.0)
+            (self.fluid_velocity[d] - self.fluid_velocity[0] / 2.0 - self.mean[0] / 2.0)
             / (-self.mean[0] / 2.0 + self.fluid_velocity[0] / 2.0)
         )
         slope_particles = np.log(
-            (self.mean - self.fluid_velocity[0] / 2.0 - self.mean[0] / 2.0)
+            (self.mean[d] - self.fluid_velocity[0] / 2.0 - self.mean[0] / 2.0)
             / (self.mean[0] / 2.0 - self.fluid_velocity[0] / 2.0)
         )
-        plt.plot(self.time, slope_fluid, "ko", label="y= - lambda t (fluid)")
-        plt.plot(self.time, slope_particles, "g", label="y= - lambda t (particles)")
+        plt.plot(time, slope_fluid, "ko", label="y= - lambda t (fluid)")
+        plt.plot(time, slope_particles, "g", label="y= - lambda t (particles)")
         plt.plot(
-            self.time,
-            -2.0 * rate * ion_density * self.time,
+            time,
+            -2.0 * rate * np.mean(ion_density) * time,
             "b",
             label="y= - 2*R_CX*n_ions t",
         )
@@ -169,10 +488,15 @@ class Plotting:
     def plot_total_energy(
         self, particles_energy: float, fluid_energy: float, filename
     ) -> None:
+        plt = _pyplot()
         plt.clf()
-        plt.plot(self.time, particles_energy, "r", label="Kinetic Energy Particles")
-        plt.plot(self.time, fluid_energy, "g", label="Kinetic Energy Fluid")
-        plt.plot(self.time, particles_energy + fluid_energy, "k", label="Total Energy")
+        d = self._decimation(plt)
+        time = self.time[d]
+        particles_energy = _ensemble_mean(particles_energy)[d]
+        fluid_energy = _ensemble_mean(fluid_energy)[d]
+        plt.plot(time, particles_energy, "r", label="Kinetic Energy Particles")
+        plt.plot(time, fluid_energy, "g", label="Kinetic Energy Fluid")
+        plt.plot(time, particles_energy + fluid_energy, "k", label="Total Energy")
         plt.xlabel("Time [Seconds]")
         plt.ylabel("Energy [Nektar Units]")
         plt.legend(loc="center right")
@@ -181,27 +505,473 @@ class Plotting:
     def plot_temperature(
         self, fluid_temperature: float, particles_temperature: float, filename
     ) -> None:
+        plt = _pyplot()
         plt.clf()
-        plt.plot(self.time, fluid_temperature, "g", label="Fluid Temperature")
-        plt.plot(self.time, particles_temperature, "r", label="Particles Temperature")
+        d = self._decimation(plt)
+        time = self.time[d]
+        fluid_temperature = _ensemble_mean(fluid_temperature)[d]
+        particles_temperature = _ensemble_mean(particles_temperature)[d]
+        plt.plot(time, fluid_temperature, "g", label="Fluid Temperature")
+        plt.plot(time, particles_temperature, "r", label="Particles Temperature")
         plt.xlabel("Time [Seconds]")
         plt.ylabel("Temperature")
         plt.legend(loc="center right")
         plt.savefig(filename)
 
 
+def render_plots(results_path, directory=".") -> None:
+    # Draws the standard figures of a run from the results saved by
+    # Recorder.save, so plotting can happen after, or apart from, the run
+    results = SimpleNamespace(**np.load(results_path))
+    plot = Plotting.from_recorder(results, results.Volume)
+
+    def output(filename):
+        return os.path.join(directory, filename)
+
+    plot.plot_bulk_properties(output("Momentum_Numerical_Bulk.png"))
+    plot.plot_momentum_conservation(output("momentum_conservation.png"))
+    plot.plot_single_properties(output("Momentum_Numerical_Single.png"))
+    plot.plot_log_exp(
+        results.CXrate,
+        results.fluid_density[-1],
+        output("Momentum_Numerical_Slope.png"),
+    )
+    plot.plot_total_energy(
+        results.particles_energy, results.fluid_energy, output("Energy.png")
+    )
+    plot.plot_temperature(
+        results.temperature_fluid,
+        results.temperature_particles,
+        output("Temperature.png"),
+    )
+
+
+def render_in_background(results_path, directory=".") -> subprocess.Popen:
+    # Runs render_plots in a separate Python process and returns at once. The
+    # process is returned so callers can wait() for the figures if they need to.
+    return subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), str(results_path), str(directory)]
+    )
+
+
+def _permute(order, weight, vel):
+    weight = np.broadcast_to(weight, vel.shape)
+    return (
+        np.take_along_axis(weight, order, axis=-1),
+        np.take_along_axis(vel, order, axis=-1),
+    )
+
+
+def _maintain_order(weight, vel):
+    # O(N) check that the macroparticles are still in ascending order, repaired
+    # with an adaptive (timsort) argsort which is near linear on almost sorted data
+    if np.all(vel[..., 1:] >= vel[..., :-1]):
+        return weight, vel
+    return _permute(np.argsort(vel, axis=-1, kind="stable"), weight, vel)
+
+
+class SortedPairing:
+    # Reference quantile-matched pairing: every step the macroparticles and the
+    # ion samples are both sorted so the i-th slowest neutral exchanges with the
+    # i-th slowest ion. Costs two O(N log N) sorts per step.
+    def sample(self, ionFluid: IonFluid, number_of_samples: int) -> float:
+        return ionFluid.getRandomMom(number_of_samples)
+
+    def pair(self, weight, vel, ionSingleMom):
+        weight, vel = _permute(np.argsort(vel, axis=-1), weight, vel)
+        return weight, vel, np.sort(ionSingleMom, axis=-1)
+
+
+class RandomPairing(SortedPairing):
+    # Ion samples are independent draws, so pairing them with the macroparticles
+    # in storage order is already a random pairing. No sorting at all.
+    def pair(self, weight, vel, ionSingleMom):
+        return weight, vel, ionSingleMom
+
+
+class MaintainedPairing(SortedPairing):
+    # Quantile-matched pairing that keeps the macroparticles in ascending order
+    # between steps. A CX update is a convex combination of two sorted arrays so
+    # the order normally survives and only the ion samples need sorting.
+    def pair(self, weight, vel, ionSingleMom):
+        weight, vel = _maintain_order(weight, vel)
+        return weight, vel, np.sort(ionSingleMom, axis=-1)
+
+
+class QuantilePairing(MaintainedPairing):
+    # Maintained-order pairing fed by ion momenta generated already in ascending
+    # order from the inverse normal CDF, removing the remaining per-step sort
+    def __init__(self, jitter: bool = True) -> None:
+        self.jitter = jitter
+
+    def sample(self, ionFluid: IonFluid, number_of_samples: int) -> float:
+        return ionFluid.getQuantileMom(number_of_samples, self.jitter)
+
+    def pair(self, weight, vel, ionSingleMom):
+        weight, vel = _maintain_order(weight, vel)
+        return weight, vel, ionSingleMom
+
+
+PAIRING_STRATEGIES = {
+    "sorted": SortedPairing,
+    "random": RandomPairing,
+    "maintained": MaintainedPairing,
+    "quantile": QuantilePairing,
+}
+
+
+class SplitMergeEngine:
+    # Keeps the "separate" charge exchange mode affordable. After each step
+    # every macroparticle has split into the part that kept its velocity and the
+    # part that took its ion's, doubling the population. Once it exceeds
+    # max_particles the macroparticles are binned uniformly in velocity and
+    # every bin holding more than one is replaced by two of weight W/2 at
+    # mean +/- standard deviation of the bin, which conserves weight, momentum
+    # and kinetic energy exactly. The output is in ascending velocity order.
+    def __init__(self, max_particles: int) -> None:
+        if max_particles < 2:
+            raise ValueError("max_particles must be at least 2")
+        self.max_particles = max_particles
+
+    def merge(self, weight, vel):
+        if len(vel) <= self.max_particles:
+            return weight, vel
+        number_of_bins = self.max_particles // 2
+        lower = np.min(vel)
+        width = (np.max(vel) - lower) / number_of_bins
+        if width == 0.0:
+            bins = np.zeros(len(vel), dtype=np.intp)
+        else:
+            bins = np.minimum(
+                ((vel - lower) / width).astype(np.intp), number_of_bins - 1
+            )
+        counts = np.bincount(bins, minlength=number_of_bins)
+        bin_weight = np.bincount(bins, weight, number_of_bins)
+        occupied = bin_weight > 0.0
+        bin_mean = np.zeros(number_of_bins)
+        bin_mean[occupied] = (
+            np.bincount(bins, weight * vel, number_of_bins)[occupied]
+            / bin_weight[occupied]
+        )
+        deviation = vel - bin_mean[bins]
+        bin_std = np.zeros(number_of_bins)
+        bin_std[occupied] = np.sqrt(
+            np.bincount(bins, weight * deviation * deviation, number_of_bins)[occupied]
+            / bin_weight[occupied]
+        )
+
+        # Each bin keeps its single macroparticle or becomes a merged pair
+        output_counts = np.minimum(counts, 2)
+        offsets = np.cumsum(output_counts) - output_counts
+        merged_weight = np.empty(np.sum(output_counts))
+        merged_vel = np.empty(np.sum(output_counts))
+        single = counts[bins] == 1
+        merged_weight[offsets[bins[single]]] = weight[single]
+        merged_vel[offsets[bins[single]]] = vel[single]
+        pairs = np.flatnonzero(counts >= 2)
+        merged_weight[offsets[pairs]] = 0.5 * bin_weight[pairs]
+        merged_weight[offsets[pairs] + 1] = 0.5 * bin_weight[pairs]
+        merged_vel[offsets[pairs]] = bin_mean[pairs] - bin_std[pairs]
+        merged_vel[offsets[pairs] + 1] = bin_mean[pairs] + bin_std[pairs]
+        # mean +/- std of a skewed bin can reach past its neighbours' pairs
+        order = np.argsort(merged_vel, kind="stable")
+        return merged_weight[order], merged_vel[order]
+
+
+class RateTable:
+    # Charge exchange rate coefficient tabulated against ion temperature, and
+    # optionally against the relative speed of a neutral and its paired ion.
+    # rates is a (temperature,) or (temperature x speed) array over ascending
+    # grids. The table is resampled once onto `resolution` points uniform in
+    # log temperature (and uniform in speed), interpolating log-log where the
+    # rates are positive, so each lookup is index arithmetic and a linear blend
+    # with no search. Values outside the grids are clamped to its edges.
+    def __init__(self, temperatures, rates, speeds=None, resolution: int = 256):
+        temperatures = np.asarray(temperatures, dtype=np.float64)
+        rates = np.asarray(rates, dtype=np.float64)
+        if np.any(temperatures <= 0.0) or np.any(np.diff(temperatures) <= 0.0):
+            raise ValueError("temperatures must be positive and ascending")
+        if rates.shape != temperatures.shape + (
+            () if speeds is None else np.shape(speeds)
+        ):
+            raise ValueError("rates must have one entry per grid point")
+        self.temperatures = temperatures
+        self.rates = rates
+        self.speeds = None if speeds is None else np.asarray(speeds, dtype=np.float64)
+        self.resolution = resolution
+
+        log_temperatures = np.log(temperatures)
+        self._log_temperature_start = log_temperatures[0]
+        self._log_temperature_step = (log_temperatures[-1] - log_temperatures[0]) / (
+            resolution - 1
+        )
+        grid = np.linspace(log_temperatures[0], log_temperatures[-1], resolution)
+        logarithmic = np.all(rates > 0.0)
+        values = np.log(rates) if logarithmic else rates
+        values = np.stack(
+            [
+                np.interp(grid, log_temperatures, column)
+                for column in values.reshape(len(temperatures), -1).T
+            ],
+            axis=-1,
+        )
+        if self.speeds is not None:
+            if np.any(np.diff(self.speeds) <= 0.0):
+                raise ValueError("speeds must be ascending")
+            self._speed_start = self.speeds[0]
+            self._speed_step = (self.speeds[-1] - self.speeds[0]) / (resolution - 1)
+            speed_grid = np.linspace(self.speeds[0], self.speeds[-1], resolution)
+            values = np.stack(
+                [np.interp(speed_grid, self.speeds, row) for row in values]
+            )
+        else:
+            values = values[:, 0]
+        self.grid = np.exp(values) if logarithmic else values
+
+    @property
+    def speed_dependent(self) -> bool:
+        return self.speeds is not None
+
+    @classmethod
+    def from_function(
+        cls, function, temperatures, speeds=None, resolution: int = 256
+    ) -> "RateTable":
+        # Tabulates a fit function(temperature) or function(temperature, speed)
+        temperatures = np.asarray(temperatures, dtype=np.float64)
+        if speeds is None:
+            rates = function(temperatures)
+        else:
+            speeds = np.asarray(speeds, dtype=np.float64)
+            rates = function(temperatures[:, None], speeds[None, :])
+        return cls(temperatures, rates, speeds, resolution)
+
+    @classmethod
+    def load(cls, path, resolution: int = 256) -> "RateTable":
+        # Reads a table written by save, or any .npz holding "temperatures",
+        # "rates" and optionally "speeds"
+        with np.load(path) as table:
+            speeds = table["speeds"] if "speeds" in table.files else None
+            return cls(table["temperatures"], table["rates"], speeds, resolution)
+
+    def save(self, path) -> None:
+        tables = {"temperatures": self.temperatures, "rates": self.rates}
+        if self.speeds is not None:
+            tables["speeds"] = self.speeds
+        np.savez(path, **tables)
+
+    @staticmethod
+    def _locate(position, size: int):
+        # Lower grid index and blending weight of fractional grid positions
+        position = np.clip(position, 0.0, size - 1)
+        index = np.minimum(position.astype(np.intp), size - 2)
+        return index, position - index
+
+    def _temperature_position(self, temperature):
+        temperature = np.clip(temperature, self.temperatures[0], self.temperatures[-1])
+        return (
+            np.log(temperature) - self._log_temperature_start
+        ) / self._log_temperature_step
+
+    def rows(self, temperature):
+        # The table at the given temperatures: rates for a temperature-only
+        # table, or one row over the speed grid per temperature
+        index, blend = self._locate(
+            self._temperature_position(np.asarray(temperature, dtype=np.float64)),
+            self.resolution,
+        )
+        if self.speeds is not None:
+            blend = blend[..., None]
+        return self.grid[index] * (1.0 - blend) + self.grid[index + 1] * blend
+
+    def lookup_speed(self, rows, row_index, speed):
+        # Rate of each particle from its row of the table (see rows) and its
+        # relative speed
+        index, blend = self._locate(
+            (speed - self._speed_start) / self._speed_step, self.resolution
+        )
+        return (
+            rows[row_index, index] * (1.0 - blend) + rows[row_index, index + 1] * blend
+        )
+
+    def evaluate(self, temperature, speed=None):
+        # Rate at each (temperature, speed), broadcast together
+        if self.speeds is None:
+            return self.rows(temperature)
+        temperature, speed = np.broadcast_arrays(
+            np.asarray(temperature, dtype=np.float64),
+            np.asarray(speed, dtype=np.float64),
+        )
+        rows = self.rows(temperature).reshape(-1, self.resolution)
+        return self.lookup_speed(
+            rows, np.arange(temperature.size), np.ravel(speed)
+        ).reshape(temperature.shape)
+
+
+class RateCoefficients:
+    # Temperature- and speed-dependent charge exchange rate, passed to runner
+    # and applyCX in place of a constant rate. The table is evaluated at the ion
+    # fluid temperature (per ensemble member or cell), and each member's or
+    # cell's value is reused until its temperature moves by more than
+    # temperature_tolerance relative to the one it was evaluated at; the count
+    # of steps that needed any evaluation is number_of_evaluations. For a
+    # speed-dependent table the cached value is the table row at that
+    # temperature, and applyCX looks up each macroparticle's rate from the
+    # speed to its paired ion.
+    def __init__(self, table: RateTable, temperature_tolerance: float = 1e-2) -> None:
+        self.table = table
+        self.temperature_tolerance = temperature_tolerance
+        self.temperature = None
+        self.cached = None
+        self.number_of_evaluations = 0
+        self.max_rate = None
+
+    @property
+    def speed_dependent(self) -> bool:
+        return self.table.speed_dependent
+
+    def _refresh(self, temperature) -> None:
+        # Re-evaluates only the members or cells whose temperature has drifted
+        temperature = np.asarray(temperature, dtype=np.float64)
+        if self.temperature is None or self.temperature.shape != temperature.shape:
+            self.temperature = temperature.copy()
+            # Kept as an array, so a single fluid's rate is updated in place too
+            self.cached = np.array(self.table.rows(temperature))
+            self.number_of_evaluations += 1
+            return
+        stale = np.abs(temperature - self.temperature) > (
+            self.temperature_tolerance * np.abs(self.temperature)
+        )
+        if np.any(stale):
+            self.temperature[stale] = temperature[stale]
+            self.cached[stale] = self.table.rows(temperature[stale])
+            self.number_of_evaluations += 1
+
+    def evaluate(self, ionFluid: IonFluid, neutrals: "Particles", ionSingleMom=None):
+        # The rate for this step: shaped like the fluid temperature for a
+        # temperature-only table, or one rate per macroparticle (paired with
+        # ionSingleMom) for a speed-dependent one
+        self._refresh(ionFluid.temperature)
+        if not self.speed_dependent:
+            self.max_rate = np.max(self.cached)
+            return self.cached[()]
+        if ionSingleMom is None:
+            raise ValueError("Speed dependent rates need paired ion samples")
+        speed = np.abs(ionSingleMom / neutrals.mass - neutrals.vel)
+        rows = self.cached.reshape(-1, self.table.resolution)
+        if hasattr(neutrals, "cell"):
+            row_index = neutrals.cell
+        else:
+            # One row per ensemble member, shared by its macroparticles
+            row_index = np.arange(len(rows)).reshape(np.shape(self.cached)[:-1] + (1,))
+        rate = self.table.lookup_speed(rows, row_index, speed)
+        self.max_rate = np.max(rate)
+        return rate
+
+
+def _rate_value(rate):
+    # Largest rate of a constant or RateCoefficients rate, for step control
+    # and the saved run metadata
+    if isinstance(rate, RateCoefficients):
+        return rate.max_rate
+    return rate
+
+
+INTEGRATORS = ("euler", "exponential", "stochastic")
+
+
 class Particles:
-    def __init__(self, mass: float, weight: float, vel: float) -> None:
+    def __init__(
+        self,
+        mass: float,
+        weight: float,
+        vel: float,
+        pairing="sorted",
+        integrator: str = "euler",
+        merger: SplitMergeEngine = None,
+        dtype=np.float64,
+    ) -> None:
+        # weight and vel are (macroparticle,) arrays, or (ensemble x macroparticle)
+        # arrays to advance many independent realisations in one vectorised step.
+        # pairing selects how ion samples are matched to macroparticles in
+        # applyCX, either by name from PAIRING_STRATEGIES or as an instance.
+        # integrator is "euler", the explicit update which needs
+        # dt*rate*density << 1, or "exponential", which relaxes each macroparticle
+        # towards its ion by 1-exp(-n_ions*rate*dt) and closes the bulk velocity
+        # gap exactly at the coupled rate, so it is stable for any dt, or
+        # "stochastic", where each macroparticle charge exchanges outright with
+        # probability 1-exp(-n_ions*rate*dt): only the sampled events are touched
+        # and the particle sums are kept incrementally, so a step costs
+        # O(events) rather than O(macroparticles).
+        # With a merger each step splits the macroparticles ("separate" mode)
+        # and the SplitMergeEngine bounds the population, so the number of
+        # macroparticles changes during a run; it needs the euler integrator,
+        # as the exponential bulk correction assumes combined mode.
+        # dtype is the storage precision of weight and vel. With np.float32 the
+        # particle arrays take half the memory while momentum and energy are
+        # still accumulated in float64.
+        if integrator not in INTEGRATORS:
+            raise ValueError("Unknown integrator " + str(integrator))
+        if merger is not None and np.ndim(vel) > 1:
+            raise ValueError("Split/merge is not supported in ensemble mode")
+        if merger is not None and integrator == "stochastic":
+            raise ValueError("Split/merge is not supported by the stochastic mode")
+        if merger is not None and integrator == "exponential":
+            raise ValueError("Split/merge is not supported by the exponential mode")
+        self.integrator = integrator
+        self.merger = merger
         self.mass = mass
-        self.weight = weight
-        self.vel = vel
-        self.kinetic_energy = 0.5 * np.sum(np.multiply(weight, np.multiply(vel, vel)))
-        self.temperature = (
-            2.0
-            * self.mass
-            * (self.kinetic_energy - 0.5 * np.sum(weight * np.mean(vel) * np.mean(vel)))
-            / np.sum(weight)
-        )
+        self.dtype = np.dtype(dtype)
+        self.weight = np.asarray(weight, dtype=self.dtype)
+        self.vel = np.array(vel, dtype=self.dtype)
+        if isinstance(pairing, str):
+            pairing = PAIRING_STRATEGIES[pairing]()
+        self.pairing = pairing
+        self.workspace = Workspace()
+        # Instrumentation hooks set by Diagnostics: a PhaseTimer lapped inside
+        # applyCX, and whether applyCX should fill self.metrics this step
+        self.timer = None
+        self.collect_metrics = False
+        self.metrics = {}
+        if integrator == "stochastic":
+            self._refresh_sums()
+        self.updateKineticEnergy()
+        self.updatetemperature()
+
+    def _refresh_sums(self) -> None:
+        # Exact weight, momentum and energy sums of the stochastic mode, which
+        # are otherwise updated per event; recomputed once as many events as
+        # macroparticles have occurred, an amortised O(1) per event
+        self._sums = {
+            "weight": _accurate_sum(self.weight * np.ones_like(self.vel)),
+            "momentum": self._weighted_sum(self.weight, self.vel),
+            "energy": self._weighted_sum(self.weight, self.vel, self.vel),
+        }
+        self._events_since_refresh = 0
+
+    def _weighted_sum(self, weight, first, second=None) -> float:
+        # Sum over macroparticles of weight*first(*second), formed in a float64
+        # workspace buffer and accumulated pairwise. The products are computed
+        # in float64 too: with only out= float32 inputs would be multiplied in
+        # float32 and rounded before the cast.
+        product = self.workspace.buffer("product", np.shape(first))
+        if second is None:
+            np.multiply(weight, first, out=product, dtype=np.float64)
+        else:
+            np.multiply(first, second, out=product, dtype=np.float64)
+            np.multiply(product, weight, out=product, dtype=np.float64)
+        return _accurate_sum(product)
+
+    def _fluid_sum(self, values) -> float:
+        # Per-macroparticle values summed into the fluid they exchange with,
+        # one sum per ensemble member
+        return _accurate_sum(values)
+
+    def total_momentum(self) -> float:
+        return self.mass * self._weighted_sum(self.weight, self.vel)
+
+    def _at_particles(self, value) -> float:
+        # A fluid quantity as seen by each macroparticle
+        return _members(value)
 
     def applyCX(
         self,
@@ -212,74 +982,1297 @@ class Particles:
         ionSingleMom: float,
         timestep: int
     ) -> None:
-        ionSingleMom = np.sort(ionSingleMom)
-        self.vel = np.sort(self.vel)
-        ionRandomMombulk = ionSingleMom * ionFluid.density
+        if self.integrator == "stochastic":
+            if isinstance(rate, RateCoefficients):
+                rate = rate.evaluate(ionFluid, self)
+            self._stochasticCX(rate, dt, ionFluid, Volume)
+            return
+        timer = self.timer
+        self.weight, self.vel, ionSingleMom = self.pairing.pair(
+            self.weight, self.vel, ionSingleMom
+        )
+        if timer is not None:
+            timer.lap("sort")
+        # A speed-dependent RateCoefficients gives one rate per macroparticle,
+        # looked up once the macroparticles are paired with their ions
+        per_particle = isinstance(rate, RateCoefficients) and rate.speed_dependent
+        if isinstance(rate, RateCoefficients):
+            rate = rate.evaluate(ionFluid, self, ionSingleMom)
+        if per_particle:
+            fraction = self.exchangeFraction(rate, dt, _members(ionFluid.density))
+            particle_fraction = fraction
+        else:
+            fraction = self.exchangeFraction(rate, dt, ionFluid.density)
+            particle_fraction = _members(fraction)
+        shape = self.vel.shape
+        workspace = self.workspace
         #Determine Total Kinetic Energy of Fluid and Macroparticles Before Charge Exchange
         kinetic_energy_before=self.kinetic_energy + ionFluid.kinetic_energy
-        weight_temp = np.copy(self.weight)
-        vel_temp=np.copy(self.vel)
-        ionFluid.mom += (
-            ionFluid.density
-            * dt
-            * rate
-            * np.sum(np.multiply(self.weight, self.vel))
-            * self.mass
-            / Volume
+        weight_temp = self.weight
+        vel_temp = workspace.buffer("vel_before", shape, self.dtype)
+        np.copyto(vel_temp, self.vel)
+        # Velocity gap between each macroparticle and its paired ion
+        gap = workspace.buffer("gap", shape, self.dtype)
+        np.divide(ionSingleMom, self.mass, out=gap)
+        gap -= self.vel
+        # Each macroparticle moves the fraction of the way to its paired ion
+        exchange = workspace.buffer("exchange", shape, self.dtype)
+        np.multiply(gap, particle_fraction, out=exchange)
+        if self.integrator == "exponential":
+            # The bulk velocity gap between neutrals and ions closes at the
+            # coupled rate rate*(n_ions + n_neutrals), exactly over the step,
+            # taking the weighted mean rate when rates are per macroparticle
+            total_weight = _accurate_sum(self.weight)
+            if per_particle:
+                rate = self._weighted_sum(self.weight, rate) / total_weight
+            neutral_density = total_weight / Volume
+            relaxed = -np.expm1(-rate * (ionFluid.density + neutral_density) * dt)
+            bulk_fraction = (
+                relaxed * ionFluid.density / (ionFluid.density + neutral_density)
+            )
+            bulk_gap = self._weighted_sum(self.weight, gap) / total_weight
+            exchange += (_members(bulk_fraction) - particle_fraction) * _members(
+                bulk_gap
+            )
+        if self.merger is not None:
+            # Separate mode: the exchanged part of each macroparticle becomes a
+            # new macroparticle moving with its ion, then the population is merged
+            ionFluid.mom -= (
+                self.mass * self._weighted_sum(self.weight, exchange) / Volume
+            )
+            exchanged_weight = fraction * self.weight
+            self.weight = np.concatenate(
+                (self.weight - exchanged_weight, exchanged_weight)
+            ).astype(self.dtype)
+            self.vel = np.concatenate((self.vel, ionSingleMom / self.mass))
+            keep = self.weight > 0.0
+            self.weight, self.vel = self.merger.merge(self.weight[keep], self.vel[keep])
+            self.weight = self.weight.astype(self.dtype, copy=False)
+            self.vel = self.vel.astype(self.dtype, copy=False)
+        elif self.dtype == np.float64:
+            # The fluid loses exactly the momentum the macroparticles gain
+            ionFluid.mom -= (
+                self.mass * self._weighted_sum(self.weight, exchange) / Volume
+            )
+            self.vel += exchange
+        else:
+            # In reduced precision the stored velocities are rounded, so the
+            # fluid is given the change actually stored, measured in float64
+            self.vel += exchange
+            change = workspace.buffer("change", shape)
+            np.subtract(self.vel, vel_temp, out=change, dtype=np.float64)
+            ionFluid.mom -= self.mass * self._weighted_sum(self.weight, change) / Volume
+        if timer is not None:
+            timer.lap("update")
+
+        def fraction_sum(factor, first, second=None):
+            # Sum of factor*weight*first(*second) over the macroparticles before
+            # the exchange, with factor per macroparticle or per realisation
+            if per_particle:
+                return self._weighted_sum(weight_temp * factor, first, second)
+            return factor * self._weighted_sum(weight_temp, first, second)
+
+        #working out error in kinetic energy of macroparticles over timestep
+        error_kinetic_energy = 0.5*self.mass*fraction_sum((-1 + fraction)*fraction, gap, gap)
+        # Relative energy error estimate of this step, used by TimestepController
+        self.energy_error = abs(error_kinetic_energy) / kinetic_energy_before
+        if self.collect_metrics:
+            #Determine Kinetic Energy of Macroparticles after Charge Exchange where macroparticles have been combined
+            energy_after_combined = 0.5 * self.mass * self._weighted_sum(self.weight, self.vel, self.vel)
+
+            #Determine Kinetic Energy of Macroparticles if each macroparticle had been allowed to split into 2
+            #First remove the kinetic energy of neutrals which have become ions
+            energy_after_separate = kinetic_energy_before - 0.5*self.mass*fraction_sum(fraction, vel_temp, vel_temp)
+            #Next add on kinetic energy of ions which have become neutrals
+            energy_after_separate =  energy_after_separate +0.5*self.mass*fraction_sum(fraction, ionSingleMom, ionSingleMom)
+
+            #Determine centre of mass energy of the Fluid after Charge Exchange
+            com_energy_after = ((ionFluid.mom * ionFluid.Volume) ** 2.0) / (2.0 * (ionFluid.density * ionFluid.Volume))
+
+            #Determine thermal energy of Fluid in 2 situations
+            #1) Where macroparticles are combined after charge exchange to stop the number of macroparticles increasing at a rate of 2^n_timesteps
+            #2) Where each macroparticle splits into 2 after each timestep
+            thermal_energy_after_combined=(kinetic_energy_before-energy_after_combined-com_energy_after)
+            thermal_energy_after_separate=(kinetic_energy_before-energy_after_separate-com_energy_after)
+
+            #Determine fluid temperatures for 2 cases above
+            self.metrics = {
+                "energy_error": self.energy_error,
+                "temperature_combined": 2.0
+                * thermal_energy_after_combined
+                / (ionFluid.density * ionFluid.Volume),
+                "temperature_separate": 2.0
+                * thermal_energy_after_separate
+                / (ionFluid.density * ionFluid.Volume),
+            }
+        if timer is not None:
+            timer.lap("energy")
+
+    def _stochasticCX(
+        self, rate: float, dt: float, ionFluid: IonFluid, Volume: float
+    ) -> None:
+        # Sparse Monte Carlo step: draw the number of events of each realisation
+        # from a binomial distribution, choose that many distinct macroparticles
+        # and give each the velocity of an ion drawn from the fluid. The fluid
+        # takes up exactly the momentum the chosen macroparticles lose, summed
+        # over the events only.
+        timer = self.timer
+        generator = _event_generator(ionFluid)
+        ensemble_shape = self.vel.shape[:-1]
+        number_of_macroparticles = self.vel.shape[-1]
+        probability = self.exchangeFraction(rate, dt, ionFluid.density)
+        events = np.asarray(
+            generator.binomial(
+                number_of_macroparticles, np.broadcast_to(probability, ensemble_shape)
+            )
         )
-        ionFluid.mom -= (
-            dt * rate * np.sum(np.multiply(self.weight, ionRandomMombulk)) / Volume
+        members = np.repeat(np.arange(events.size), np.ravel(events))
+        chosen = np.concatenate(
+            [
+                generator.choice(
+                    number_of_macroparticles, count, replace=False, shuffle=False
+                )
+                for count in np.ravel(events)
+            ]
         )
-        self.vel += dt * rate * ionFluid.density * (ionSingleMom / self.mass - self.vel)
+        if timer is not None:
+            timer.lap("sort")
+        if ensemble_shape:
+            index = np.unravel_index(members, ensemble_shape) + (chosen,)
+        else:
+            index = (chosen,)
+        weight = np.broadcast_to(self.weight, self.vel.shape)[index]
+        vel_before = self.vel[index].astype(np.float64)
+        self.vel[index] = ionFluid.getEventMom(members, generator) / self.mass
+        vel_after = self.vel[index].astype(np.float64)
 
-        #Determine Kinetic Energy of Macroparticles after Charge Exchange where macroparticles have been combined
-        energy_after_combined = (1.0 / 2.0) * self.mass * np.sum(np.multiply(self.weight, np.multiply(self.vel, self.vel)))
+        def member_sum(values):
+            return np.bincount(members, values, events.size).reshape(ensemble_shape)
 
-        #Determine Kinetic Energy of Macroparticles if each macroparticle had been allowed to split into 2
-        #First remove the kinetic energy of neutrals which have become ions
-        energy_after_separate = kinetic_energy_before - 0.5*self.mass*rate*dt*ionFluid.density*np.sum(np.multiply(weight_temp,np.multiply(vel_temp,vel_temp)),axis=0) 
-        #Next add on kinetic energy of ions which have become neutrals
-        energy_after_separate =  energy_after_separate +0.5*self.mass*rate*dt*ionFluid.density*np.sum(np.multiply(weight_temp,np.multiply(ionSingleMom,ionSingleMom)),axis=0)
+        momentum_change = member_sum(weight * (vel_after - vel_before))
+        ionFluid.mom -= self.mass * momentum_change / Volume
+        self._sums["momentum"] = self._sums["momentum"] + momentum_change
+        self._sums["energy"] = self._sums["energy"] + member_sum(
+            weight * (vel_after * vel_after - vel_before * vel_before)
+        )
+        self._events_since_refresh += len(members)
+        if self._events_since_refresh >= self.vel.size:
+            self._refresh_sums()
+        if timer is not None:
+            timer.lap("update")
+        # Each event is an exact exchange, so there is no truncation error
+        self.events = events
+        self.energy_error = np.zeros(ensemble_shape)
+        if self.collect_metrics:
+            self.metrics = {"energy_error": self.energy_error, "events": events}
+        if timer is not None:
+            timer.lap("energy")
 
-        #Determine centre of mass energy of the Fluid after Charge Exchange
-        com_energy_after = ((ionFluid.mom * ionFluid.Volume) ** 2.0) / (2.0 * (ionFluid.density * ionFluid.Volume))
+    def exchangeFraction(self, rate: float, dt: float, density: float) -> float:
+        # Fraction of each macroparticle that charge exchanges in one step, the
+        # event probability in the stochastic mode
+        if self.integrator != "euler":
+            return -np.expm1(-rate * density * dt)
+        return dt * rate * density
 
-        #Determine thermal energy of Fluid in 2 situations
-        #1) Where macroparticles are combined after charge exchange to stop the number of macroparticles increasing at a rate of 2^n_timesteps
-        #2) Where each macroparticle splits into 2 after each timestep
-        thermal_energy_after_combined=(kinetic_energy_before-energy_after_combined-com_energy_after)
-        thermal_energy_after_separate=(kinetic_energy_before-energy_after_separate-com_energy_after)
-        
-        #Determine fluid temperatures for 2 cases above
-        temperature_energy_after_combined=2.0 * thermal_energy_after_combined / (ionFluid.density * ionFluid.Volume)
-        temperature_energy_after_separate=2.0 * thermal_energy_after_separate / (ionFluid.density * ionFluid.Volume)
+    def sampleIonMom(self, ionFluid: IonFluid) -> float:
+        # Draws one ion momentum per macroparticle, ordered as the pairing expects.
+        # The stochastic mode draws ions for its events only, inside applyCX.
+        if self.integrator == "stochastic":
+            return None
+        return self.pairing.sample(ionFluid, np.shape(self.weight)[-1])
 
-        #working out error in kinetic energy of macroparticles over timestep
-        ionsample_vel=ionSingleMom/ionFluid.mass
-        diff_vel=vel_temp-ionsample_vel
-        error_kinetic_energy = 0.5*self.mass*(-1 + dt*rate*ionFluid.density)*dt*rate*ionFluid.density*np.sum(np.multiply(self.weight, np.multiply(diff_vel,diff_vel) ),axis=0)
-        #Print temperature for both cases
-        #print(temperature_energy_after_combined,temperature_energy_after_separate)
-        print(timestep," , ",100*abs(error_kinetic_energy)/kinetic_energy_before)
-        
+    def moments(self, chunk_size: int):
+        # Bulk momentum and the weighted mean and standard deviation of the
+        # single particle momentum, as stored by Recorder
+        mean, std = _chunked_moments(self.vel, self.weight, chunk_size)
+        bulk_momentum = self.mass * np.einsum("...n,...n->...", self.weight, self.vel)
+        return bulk_momentum, self.mass * mean, self.mass * std
 
     def updateKineticEnergy(self) -> None:
+        if self.integrator == "stochastic":
+            self.kinetic_energy = 0.5 * self.mass * self._sums["energy"]
+            return
         self.kinetic_energy = (
             (1.0 / 2.0)
             * self.mass
-            * np.sum(np.multiply(self.weight, np.multiply(self.vel, self.vel)))
+            * self._weighted_sum(self.weight, self.vel, self.vel)
+        )
+
+    def updatetemperature(self) -> None:
+        # Weighted mean velocity, as merged macroparticles have unequal weights
+        if self.integrator == "stochastic":
+            total_weight = self._sums["weight"]
+            mean_vel = self._sums["momentum"] / total_weight
+        else:
+            total_weight = _accurate_sum(self.weight)
+            mean_vel = self._weighted_sum(self.weight, self.vel) / total_weight
+        self.temperature = (
+            2.0
+            * self.mass
+            * (self.kinetic_energy - 0.5 * total_weight * mean_vel * mean_vel)
+            / total_weight
+        )
+
+
+class SpatialIonFluid(IonFluid):
+    # Ion fluid on a domain of cells, stored as one array per quantity
+    # (density, mom, temperature, Volume) so that every IonFluid update acts on
+    # all cells at once. Per-cell diagnostics take the place of the ensemble
+    # axis of IonFluid.
+    def __init__(
+        self,
+        mass: float,
+        density: float,
+        momentum: float,
+        temperature: float,
+        Volume: float,
+        sampler: IonSampler = None,
+    ) -> None:
+        shape = np.broadcast(density, momentum, temperature, Volume).shape
+
+        def cells(value):
+            return np.array(np.broadcast_to(value, shape), dtype=float)
+
+        IonFluid.__init__(
+            self,
+            mass,
+            cells(density),
+            cells(momentum),
+            cells(temperature),
+            cells(Volume),
+            sampler,
+        )
+
+    @property
+    def number_of_cells(self) -> int:
+        return len(self.density)
+
+    def getCellRandomMom(self, cell) -> float:
+        # One ion momentum per macroparticle, drawn from the Maxwellian of the
+        # cell it sits in by gathering the cell's bulk and thermal velocities
+        velocity_single_ion = self.mom / (self.mass * self.density)
+        thermal_velocity = (self.temperature / self.mass) ** 0.5
+        if self.sampler is None:
+            z = np.random.standard_normal(len(cell))
+        else:
+            z = self.sampler.standard_normal((len(cell),))
+        return self.mass * (velocity_single_ion[cell] + thermal_velocity[cell] * z)
+
+
+class SpatialParticles(Particles):
+    # Macroparticles which each carry the index of the cell they occupy. The
+    # charge exchange kernel gathers the fluid properties of every particle's
+    # cell, updates all particles at once and scatter-adds the momentum and
+    # energy changes back to the cells with np.bincount, so a step costs no
+    # Python loop over cells. Ion samples are paired in storage order.
+    def __init__(
+        self,
+        mass: float,
+        weight: float,
+        vel: float,
+        cell,
+        number_of_cells: int,
+        integrator: str = "euler",
+    ) -> None:
+        self.cell = np.asarray(cell, dtype=np.intp)
+        self.number_of_cells = number_of_cells
+        if np.any(self.cell < 0) or np.any(self.cell >= number_of_cells):
+            raise ValueError("Cell index outside the domain")
+        if integrator == "stochastic":
+            raise ValueError("The stochastic mode is not supported on cells")
+        Particles.__init__(self, mass, weight, vel, "random", integrator)
+        self.updateKineticEnergy()
+        self.updatetemperature()
+
+    def _cell_sum(self, values) -> float:
+        return np.bincount(self.cell, values, self.number_of_cells)
+
+    def _cell_mean(self, total, cell_weight) -> float:
+        # Weighted mean per cell, zero in cells without macroparticles
+        return np.divide(
+            total,
+            cell_weight,
+            out=np.zeros(self.number_of_cells),
+            where=cell_weight > 0.0,
+        )
+
+    def _fluid_sum(self, values) -> float:
+        return self._cell_sum(values)
+
+    def _at_particles(self, value) -> float:
+        return np.broadcast_to(value, self.number_of_cells)[self.cell]
+
+    def applyCX(
+        self,
+        rate: float,
+        dt: float,
+        ionFluid: SpatialIonFluid,
+        Volume: float,
+        ionSingleMom: float,
+        timestep: int,
+    ) -> None:
+        timer = self.timer
+        Volume = np.broadcast_to(Volume, self.number_of_cells)
+        if isinstance(rate, RateCoefficients) and rate.speed_dependent:
+            # Per-macroparticle rates; the bulk correction uses each cell's
+            # weighted mean rate
+            particle_rate = rate.evaluate(ionFluid, self, ionSingleMom)
+            cell_rate = self._cell_mean(
+                self._cell_sum(self.weight * particle_rate),
+                self._cell_sum(self.weight),
+            )
+        else:
+            if isinstance(rate, RateCoefficients):
+                rate = rate.evaluate(ionFluid, self)
+            cell_rate = np.broadcast_to(rate, self.number_of_cells)
+            particle_rate = cell_rate[self.cell]
+        kinetic_energy_before = self.kinetic_energy + ionFluid.kinetic_energy
+        density = ionFluid.density[self.cell]
+        fraction = self.exchangeFraction(particle_rate, dt, density)
+        gap = ionSingleMom / self.mass - self.vel
+        exchange = fraction * gap
+        if self.integrator == "exponential":
+            # Bulk velocity gap of each cell closes at the coupled rate
+            cell_weight = self._cell_sum(self.weight)
+            neutral_density = cell_weight / Volume
+            relaxed = -np.expm1(
+                -cell_rate * (ionFluid.density + neutral_density) * dt
+            )
+            bulk_fraction = relaxed * ionFluid.density / (
+                ionFluid.density + neutral_density
+            )
+            bulk_gap = self._cell_mean(self._cell_sum(self.weight * gap), cell_weight)
+            exchange += (bulk_fraction[self.cell] - fraction) * bulk_gap[self.cell]
+        # Each cell's fluid loses exactly the momentum its macroparticles gain
+        ionFluid.mom -= self.mass * self._cell_sum(self.weight * exchange) / Volume
+        self.vel += exchange
+        if timer is not None:
+            timer.lap("update")
+
+        # Per-cell relative energy error estimate, as in Particles.applyCX
+        error_kinetic_energy = self._cell_sum(
+            0.5 * self.mass * (fraction - 1.0) * fraction * self.weight * gap * gap
+        )
+        self.energy_error = abs(error_kinetic_energy) / kinetic_energy_before
+        if self.collect_metrics:
+            self.metrics = {"energy_error": self.energy_error}
+        if timer is not None:
+            timer.lap("energy")
+
+    def sampleIonMom(self, ionFluid: SpatialIonFluid) -> float:
+        return ionFluid.getCellRandomMom(self.cell)
+
+    def moments(self, chunk_size: int):
+        # Per-cell bulk momentum and weighted mean and standard deviation
+        cell_weight = self._cell_sum(self.weight)
+        bulk_momentum = self.mass * self._cell_sum(self.weight * self.vel)
+        mean_vel = self._cell_mean(bulk_momentum / self.mass, cell_weight)
+        deviation = self.vel - mean_vel[self.cell]
+        variance = self._cell_mean(
+            self._cell_sum(self.weight * deviation * deviation), cell_weight
+        )
+        return bulk_momentum, self.mass * mean_vel, self.mass * np.sqrt(variance)
+
+    def updateKineticEnergy(self) -> None:
+        self.kinetic_energy = self._cell_sum(
+            0.5 * self.mass * self.weight * self.vel * self.vel
+        )
+
+    def updatetemperature(self) -> None:
+        cell_weight = self._cell_sum(self.weight)
+        mean_vel = self._cell_mean(self._cell_sum(self.weight * self.vel), cell_weight)
+        self.temperature = self._cell_mean(
+            2.0
+            * self.mass
+            * (self.kinetic_energy - 0.5 * cell_weight * mean_vel * mean_vel),
+            cell_weight,
+        )
+
+
+def _mixture_departure(mean_a, variance_a, mean_b, variance_b) -> float:
+    # Largest |skewness| or |excess kurtosis| of any mixture of two normal
+    # distributions, sampled over the mixing fraction: how far charge exchange
+    # between Maxwellian neutrals and ions can take the neutrals from Maxwellian
+    fraction = np.linspace(0.05, 0.95, 19).reshape((19,) + (1,) * np.ndim(mean_a))
+    mean = (1.0 - fraction) * mean_a + fraction * mean_b
+    moments = [0.0, 0.0, 0.0]
+    for weight, component_mean, variance in (
+        (1.0 - fraction, mean_a, variance_a),
+        (fraction, mean_b, variance_b),
+    ):
+        d = component_mean - mean
+        moments[0] = moments[0] + weight * (variance + d * d)
+        moments[1] = moments[1] + weight * (3.0 * d * variance + d**3)
+        moments[2] = moments[2] + weight * (
+            3.0 * variance * variance + 6.0 * d * d * variance + d**4
+        )
+    second, third, fourth = moments
+    return np.max(
+        np.maximum(np.abs(third) / second**1.5, np.abs(fourth / second**2 - 3.0))
+    )
+
+
+class HybridParticles(Particles):
+    # Macroparticles that hand over to a moment model while the neutrals are
+    # near-Maxwellian. In kinetic mode every check_interval steps the weighted
+    # skewness and excess kurtosis of the velocities are measured; once both are
+    # below tolerance/2, as is the departure from Maxwellian that charge
+    # exchange with the current ion Maxwellian could cause (_mixture_departure),
+    # the particles are frozen and only their weight, momentum and energy sums
+    # are advanced, at O(1) cost per step. Charge exchange moves the neutral
+    # momentum towards the ions' as dP_n/dt = R(n_n P_i - n_i P_n), which with
+    # the total momentum conserved is an exponential relaxation at rate
+    # R(n_i + n_n), solved exactly over each step. The velocity spread follows
+    # the update the kinetic model makes to Maxwellian neutrals with the same
+    # pairing, so both models agree through a switch; the fluid temperature
+    # comes from the conserved total energy as before. When the mixture
+    # departure exceeds tolerance, or when anything reads vel (snapshots, other
+    # processes), the macroparticles are resampled from a Maxwellian whose
+    # weighted mean and variance match the sums exactly, and the kinetic mode
+    # resumes. Checkpointer saves the frozen state without reading vel.
+    def __init__(
+        self,
+        mass: float,
+        weight: float,
+        vel: float,
+        pairing="sorted",
+        integrator: str = "euler",
+        tolerance: float = 0.05,
+        check_interval: int = 10,
+        dtype=np.float64,
+    ) -> None:
+        if integrator == "stochastic":
+            raise ValueError("The hybrid model needs a deterministic integrator")
+        # Resampled velocities are stored as drawn, so rounding them to a
+        # reduced precision would change the total momentum
+        if np.dtype(dtype) != np.float64:
+            raise ValueError("The hybrid model needs float64 storage")
+        self.moment_mode = False
+        Particles.__init__(self, mass, weight, vel, pairing, integrator, None, dtype)
+        self.tolerance = tolerance
+        self.check_interval = check_interval
+        self.number_of_switches = 0
+        self._steps_since_check = 0
+        self._generator = None
+
+    @property
+    def vel(self):
+        if self.moment_mode:
+            self._resample()
+        return self._vel
+
+    @vel.setter
+    def vel(self, value) -> None:
+        self._vel = value
+
+    def shape_departure(self) -> float:
+        # Largest |skewness| or |excess kurtosis| of the macroparticle velocities
+        weight = np.broadcast_to(self.weight, self._vel.shape)
+        total_weight = _accurate_sum(weight)
+        mean = self._weighted_sum(weight, self._vel) / total_weight
+        deviation = self._vel - _members(mean)
+        squared = deviation * deviation
+        second = self._weighted_sum(weight, squared) / total_weight
+        third = self._weighted_sum(weight, squared, deviation) / total_weight
+        fourth = self._weighted_sum(weight, squared, squared) / total_weight
+        return np.max(
+            np.maximum(np.abs(third) / second**1.5, np.abs(fourth / second**2 - 3.0))
+        )
+
+    def _ion_departure(self, ionFluid: IonFluid) -> float:
+        total_weight = self._sums["weight"]
+        mean = self._sums["momentum"] / total_weight
+        return _mixture_departure(
+            mean,
+            self._sums["energy"] / total_weight - mean * mean,
+            ionFluid.mom / (ionFluid.mass * ionFluid.density),
+            ionFluid.temperature / ionFluid.mass,
+        )
+
+    def _refresh_sums(self) -> None:
+        weight = np.broadcast_to(self.weight, self._vel.shape)
+        self._sums = {
+            "weight": _accurate_sum(weight),
+            "momentum": self._weighted_sum(weight, self._vel),
+            "energy": self._weighted_sum(weight, self._vel, self._vel),
+        }
+
+    def _resample(self) -> None:
+        # Back to kinetic mode: velocities drawn from a Maxwellian and shifted
+        # and scaled so their weighted mean and variance match the sums
+        self.moment_mode = False
+        self.number_of_switches += 1
+        self._steps_since_check = 0
+        weight = np.broadcast_to(self.weight, self._vel.shape)
+        total_weight = self._sums["weight"]
+        mean = self._sums["momentum"] / total_weight
+        variance = np.maximum(self._sums["energy"] / total_weight - mean * mean, 0.0)
+        z = self._generator.standard_normal(self._vel.shape)
+        z_mean = _accurate_sum(weight * z) / total_weight
+        z -= _members(z_mean)
+        z_std = np.sqrt(_accurate_sum(weight * z * z) / total_weight)
+        self._vel = (_members(mean) + z * _members(np.sqrt(variance) / z_std)).astype(
+            self.dtype
         )
 
+    def sampleIonMom(self, ionFluid: IonFluid) -> float:
+        if self.moment_mode:
+            return None
+        return Particles.sampleIonMom(self, ionFluid)
+
+    def applyCX(
+        self,
+        rate: float,
+        dt: float,
+        ionFluid: IonFluid,
+        Volume: float,
+        ionSingleMom: float,
+        timestep: int,
+    ) -> None:
+        if not self.moment_mode:
+            Particles.applyCX(self, rate, dt, ionFluid, Volume, ionSingleMom, timestep)
+            self._steps_since_check += 1
+            if self._steps_since_check < self.check_interval:
+                return
+            self._steps_since_check = 0
+            if self.shape_departure() >= 0.5 * self.tolerance:
+                return
+            self._refresh_sums()
+            if self._ion_departure(ionFluid) >= 0.5 * self.tolerance:
+                return
+            self.moment_mode = True
+            self.number_of_switches += 1
+            self._generator = _event_generator(ionFluid)
+            return
+
+        if isinstance(rate, RateCoefficients):
+            rate = rate.evaluate(ionFluid, self)
+        # The neutral mean velocity relaxes exactly towards the shared
+        # equilibrium at the coupled rate R(n_i + n_n)
+        number_of_neutrals = self._sums["weight"]
+        number_of_particles = number_of_neutrals + ionFluid.density * Volume
+        decay = np.exp(-rate * number_of_particles / Volume * dt)
+        equilibrium = (
+            ionFluid.mom * Volume / self.mass + self._sums["momentum"]
+        ) / number_of_particles
+        mean = self._sums["momentum"] / number_of_neutrals
+        variance = np.maximum(
+            self._sums["energy"] / number_of_neutrals - mean * mean, 0.0
+        )
+        mean_after = equilibrium + (mean - equilibrium) * decay
+        momentum_after = number_of_neutrals * mean_after
+        ionFluid.mom -= self.mass * (momentum_after - self._sums["momentum"]) / Volume
+        # The spread follows the combined-mode update of the kinetic model for
+        # Maxwellian neutrals and ions: standard deviations blend when the
+        # pairing matches quantiles, variances when it is random
+        fraction = self.exchangeFraction(rate, dt, ionFluid.density)
+        ion_variance = ionFluid.temperature / ionFluid.mass
+        if isinstance(self.pairing, RandomPairing):
+            variance_after = (
+                1.0 - fraction
+            ) ** 2 * variance + fraction**2 * ion_variance
+        else:
+            variance_after = (
+                (1.0 - fraction) * np.sqrt(variance) + fraction * np.sqrt(ion_variance)
+            ) ** 2
+        self._sums["momentum"] = momentum_after
+        self._sums["energy"] = number_of_neutrals * (
+            variance_after + mean_after * mean_after
+        )
+        self.energy_error = np.zeros(np.shape(number_of_neutrals))
+        if self.collect_metrics:
+            self.metrics = {"energy_error": self.energy_error}
+        if self._ion_departure(ionFluid) > self.tolerance:
+            self._resample()
+
+    def total_momentum(self) -> float:
+        if self.moment_mode:
+            return self.mass * self._sums["momentum"]
+        return Particles.total_momentum(self)
+
+    def moments(self, chunk_size: int):
+        if not self.moment_mode:
+            return Particles.moments(self, chunk_size)
+        total_weight = self._sums["weight"]
+        mean = self._sums["momentum"] / total_weight
+        std = np.sqrt(
+            np.maximum(self._sums["energy"] / total_weight - mean * mean, 0.0)
+        )
+        return self.mass * self._sums["momentum"], self.mass * mean, self.mass * std
+
+    def updateKineticEnergy(self) -> None:
+        if not self.moment_mode:
+            Particles.updateKineticEnergy(self)
+            return
+        self.kinetic_energy = 0.5 * self.mass * self._sums["energy"]
+
     def updatetemperature(self) -> None:
+        if not self.moment_mode:
+            Particles.updatetemperature(self)
+            return
+        total_weight = self._sums["weight"]
+        mean_vel = self._sums["momentum"] / total_weight
         self.temperature = (
             2.0
             * self.mass
+            * (self.kinetic_energy - 0.5 * total_weight * mean_vel * mean_vel)
+            / total_weight
+        )
+
+
+class ChargeExchange:
+    # Charge exchange as a process of OperatorSplitting, through Particles.applyCX
+    def __init__(self, rate) -> None:
+        self.rate = rate
+
+    def apply(
+        self,
+        dt: float,
+        ionFluid: IonFluid,
+        neutrals: Particles,
+        Volume: float,
+        ionSingleMom: float,
+        timestep: int,
+    ) -> None:
+        neutrals.applyCX(self.rate, dt, ionFluid, Volume, ionSingleMom, timestep)
+
+
+def _process_rate(rate, ionFluid: IonFluid, neutrals: Particles):
+    # A constant rate, or a temperature-only RateCoefficients at the fluid
+    # temperature
+    if isinstance(rate, RateCoefficients):
+        return rate.evaluate(ionFluid, neutrals)
+    return rate
+
+
+def _weights_changed(neutrals: Particles) -> None:
+    if neutrals.integrator == "stochastic":
+        neutrals._refresh_sums()
+
+
+class Ionisation:
+    # Electron impact ionisation of the neutrals at rate*n_e, with the electron
+    # density equal to the ion density (quasi-neutrality). Each macroparticle
+    # loses the fraction 1-exp(-rate*n_e*dt) of its weight and the fluid gains
+    # exactly the particles and momentum removed. Their kinetic energy stays in
+    # the total energy, so the energy update of the step passes it to the fluid.
+    def __init__(self, rate) -> None:
+        self.rate = rate
+
+    def apply(
+        self,
+        dt: float,
+        ionFluid: IonFluid,
+        neutrals: Particles,
+        Volume: float,
+        ionSingleMom: float,
+        timestep: int,
+    ) -> None:
+        rate = _process_rate(self.rate, ionFluid, neutrals)
+        fraction = -np.expm1(-rate * ionFluid.density * dt)
+        weight_before = np.array(
+            np.broadcast_to(neutrals.weight, neutrals.vel.shape), dtype=np.float64
+        )
+        neutrals.weight = (
+            weight_before * (1.0 - neutrals._at_particles(fraction))
+        ).astype(neutrals.dtype)
+        # The weight actually removed, measured from the stored weights
+        ionised = weight_before - neutrals.weight
+        ionFluid.density = ionFluid.density + neutrals._fluid_sum(ionised) / Volume
+        ionFluid.mom += (
+            neutrals.mass * neutrals._fluid_sum(ionised * neutrals.vel) / Volume
+        )
+        _weights_changed(neutrals)
+        if neutrals.timer is not None:
+            neutrals.timer.lap("update")
+
+
+class Recombination:
+    # Radiative recombination of the fluid at rate*n_e (n_e = ion density):
+    # the fraction 1-exp(-rate*n_e*dt) of the ions becomes neutral, moving with
+    # ions of the shared sample. Without a merger the recombined ions are shared
+    # equally between the macroparticles of each fluid (member or cell) and
+    # each is combined with its paired ion, as charge exchange combines them, so
+    # the population is unchanged. With a merger ("separate" mode) they are new
+    # macroparticles and the population is merged. The fluid loses exactly the
+    # particles and momentum the neutrals gain.
+    def __init__(self, rate) -> None:
+        self.rate = rate
+
+    def apply(
+        self,
+        dt: float,
+        ionFluid: IonFluid,
+        neutrals: Particles,
+        Volume: float,
+        ionSingleMom: float,
+        timestep: int,
+    ) -> None:
+        if ionSingleMom is None:
+            # The stochastic mode draws no per-macroparticle ion sample
+            ionSingleMom = ionFluid.getRandomMom(neutrals.vel.shape[-1])
+        rate = _process_rate(self.rate, ionFluid, neutrals)
+        recombined = (
+            -np.expm1(-rate * ionFluid.density * dt) * ionFluid.density * Volume
+        )
+        weight = np.broadcast_to(neutrals.weight, neutrals.vel.shape)
+        number_of_macroparticles = neutrals._fluid_sum(np.ones_like(weight))
+        share = neutrals._at_particles(
+            np.divide(
+                recombined,
+                number_of_macroparticles,
+                out=np.zeros(np.shape(number_of_macroparticles)),
+                where=number_of_macroparticles > 0,
+            )
+        )
+        ion_vel = ionSingleMom / neutrals.mass
+        number_before = neutrals._fluid_sum(weight)
+        momentum_before = neutrals._fluid_sum(weight * neutrals.vel.astype(np.float64))
+        if neutrals.merger is None:
+            weight_after = weight + share
+            neutrals.vel = (
+                (weight * neutrals.vel + share * ion_vel) / weight_after
+            ).astype(neutrals.dtype)
+            neutrals.weight = weight_after.astype(neutrals.dtype)
+        else:
+            # One new macroparticle per ion sample (single realisation only)
+            neutrals.weight, neutrals.vel = neutrals.merger.merge(
+                np.concatenate(
+                    (weight, np.full(len(ion_vel), recombined / len(ion_vel)))
+                ),
+                np.concatenate((neutrals.vel, ion_vel)),
+            )
+            neutrals.weight = neutrals.weight.astype(neutrals.dtype, copy=False)
+            neutrals.vel = neutrals.vel.astype(neutrals.dtype, copy=False)
+        # Changes measured from the stored macroparticles, so rounding and
+        # merging are charged to the fluid as well
+        ionFluid.density = (
+            ionFluid.density
+            - (
+                neutrals._fluid_sum(neutrals.weight * np.ones_like(neutrals.vel))
+                - number_before
+            )
+            / Volume
+        )
+        ionFluid.mom -= (
+            neutrals.mass
             * (
-                self.kinetic_energy
-                - 0.5 * np.sum(self.weight * np.mean(self.vel) * np.mean(self.vel))
+                neutrals._fluid_sum(neutrals.weight * neutrals.vel.astype(np.float64))
+                - momentum_before
             )
-            / np.sum(self.weight)
+            / Volume
         )
+        _weights_changed(neutrals)
+        if neutrals.timer is not None:
+            neutrals.timer.lap("update")
+
+
+PROCESSES = {
+    "charge_exchange": ChargeExchange,
+    "ionisation": Ionisation,
+    "recombination": Recombination,
+}
+
+
+class OperatorSplitting:
+    # Advances several atomic processes over one timestep by operator splitting.
+    # processes are instances, or (name, rate) pairs from PROCESSES, applied in
+    # order ("lie", first order) or as a symmetric Strang sequence of half steps
+    # around the last one ("strang", second order). Every process shares the
+    # ion sample drawn for the step (redrawn only if a merger has changed the
+    # number of macroparticles), and the energy and temperature updates are
+    # made once after all of them, by the runner, from the conserved total
+    # energy: the processes only move particles, momentum and kinetic energy
+    # between the fluid and the macroparticles.
+    schemes = ("lie", "strang")
+
+    def __init__(self, processes, scheme: str = "lie") -> None:
+        if scheme not in self.schemes:
+            raise ValueError("Unknown splitting scheme " + str(scheme))
+        self.processes = [
+            PROCESSES[process[0]](process[1]) if isinstance(process, tuple) else process
+            for process in processes
+        ]
+        self.scheme = scheme
+
+    def apply(
+        self,
+        dt: float,
+        ionFluid: IonFluid,
+        neutrals: Particles,
+        Volume: float,
+        ionSingleMom: float,
+        timestep: int,
+    ) -> None:
+        if self.scheme == "lie" or len(self.processes) == 1:
+            sequence = [(process, dt) for process in self.processes]
+        else:
+            half = [(process, 0.5 * dt) for process in self.processes[:-1]]
+            sequence = half + [(self.processes[-1], dt)] + half[::-1]
+        for process, step in sequence:
+            if (
+                ionSingleMom is not None
+                and np.shape(ionSingleMom)[-1] != np.shape(neutrals.vel)[-1]
+            ):
+                # A merger changed the population, so the sample is redrawn
+                ionSingleMom = neutrals.sampleIonMom(ionFluid)
+            process.apply(step, ionFluid, neutrals, Volume, ionSingleMom, timestep)
+
+
+class Recorder:
+    # Records the time history of a run as reduced diagnostics. Every
+    # `interval` timesteps one row of each diagnostic is stored, so memory scales
+    # with the number of diagnostics rather than timesteps x macroparticles.
+    # Full velocity snapshots are optional and are spilled to a memory-mapped
+    # .npy file every `snapshot_interval` records. Buffers start sized for
+    # number_of_timesteps and double when a variable-step run needs more rows.
+    diagnostics = (
+        "time",
+        "fluid_density",
+        "fluid_momentum",
+        "bulk_momentum",
+        "mean",
+        "std",
+        "particles_energy",
+        "fluid_energy",
+        "temperature_fluid",
+        "temperature_particles",
+    )
+
+    def __init__(
+        self,
+        interval: int = 1,
+        snapshot_path=None,
+        snapshot_interval: int = 1,
+        chunk_size: int = 65536,
+    ) -> None:
+        self.interval = interval
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.chunk_size = chunk_size
+        self.number_of_records = 0
+        self.snapshots = None
+
+    def start(
+        self,
+        ions: IonFluid,
+        neutrals: "Particles",
+        number_of_timesteps,
+        resume: bool = False,
+    ):
+        # With resume an existing snapshot file is reopened rather than
+        # truncated, as a restarted run continues the one that wrote it
+        number_of_rows = max(-(-number_of_timesteps // self.interval), 1)
+        ensemble_shape = ions.ensemble_shape
+        self._buffers = {
+            name: np.zeros((number_of_rows,) + ensemble_shape)
+            for name in self.diagnostics[1:]
+        }
+        self._buffers["time"] = np.zeros(number_of_rows)
+        self.number_of_records = 0
+        if self.snapshot_path is not None:
+            number_of_snapshots = -(-number_of_rows // self.snapshot_interval)
+            self._snapshot_shape = np.shape(neutrals.vel)
+            if resume and os.path.exists(self.snapshot_path):
+                self.snapshots = np.lib.format.open_memmap(
+                    self.snapshot_path, mode="r+"
+                )
+                return
+            self.snapshots = np.lib.format.open_memmap(
+                self.snapshot_path,
+                mode="w+",
+                dtype=np.float64,
+                shape=(number_of_snapshots,) + self._snapshot_shape,
+            )
+
+    def due(self, timestep: int) -> bool:
+        return timestep % self.interval == 0
+
+    def _grow(self) -> None:
+        for name, buffer in self._buffers.items():
+            grown = np.zeros((2 * len(buffer),) + buffer.shape[1:])
+            grown[: len(buffer)] = buffer
+            self._buffers[name] = grown
+
+    def _resize_snapshots(self, number_of_snapshots: int) -> None:
+        self.snapshots.flush()
+        self.snapshots = None
+        _resize_npy(self.snapshot_path, (number_of_snapshots,) + self._snapshot_shape)
+        self.snapshots = np.lib.format.open_memmap(self.snapshot_path, mode="r+")
+
+    def record(self, time: float, ions: IonFluid, neutrals: "Particles") -> None:
+        row = self.number_of_records
+        if row == len(self._buffers["time"]):
+            self._grow()
+        bulk_momentum, mean, std = neutrals.moments(self.chunk_size)
+        self._buffers["time"][row] = time
+        self._buffers["fluid_density"][row] = ions.density
+        self._buffers["fluid_momentum"][row] = ions.mom
+        self._buffers["bulk_momentum"][row] = bulk_momentum
+        self._buffers["mean"][row] = mean
+        self._buffers["std"][row] = std
+        self._buffers["particles_energy"][row] = neutrals.kinetic_energy
+        self._buffers["fluid_energy"][row] = ions.kinetic_energy
+        self._buffers["temperature_fluid"][row] = ions.temperature
+        self._buffers["temperature_particles"][row] = neutrals.temperature
+        if self.snapshots is not None and row % self.snapshot_interval == 0:
+            if np.shape(neutrals.vel) != self._snapshot_shape:
+                raise ValueError("Snapshots need a fixed number of macroparticles")
+            snapshot = row // self.snapshot_interval
+            if snapshot == len(self.snapshots):
+                self._resize_snapshots(2 * len(self.snapshots))
+            self.snapshots[snapshot] = neutrals.vel
+        self.number_of_records += 1
+
+    def rows(self, start: int, stop: int) -> dict:
+        # Copies of the recorded rows [start, stop) of every diagnostic
+        return {
+            name: buffer[start:stop].copy() for name, buffer in self._buffers.items()
+        }
+
+    def restore(self, columns: dict, number_of_records: int) -> None:
+        # Refills the buffers with the first number_of_records rows of columns
+        while len(self._buffers["time"]) < number_of_records:
+            self._grow()
+        for name, buffer in self._buffers.items():
+            buffer[:number_of_records] = columns[name][:number_of_records]
+        self.number_of_records = number_of_records
+
+    def save(self, path, **metadata) -> None:
+        # Saves the recorded diagnostics, with any run metadata such as Volume
+        # and CXrate, to an .npz file that render_plots can draw from
+        np.savez(
+            path, **{name: getattr(self, name) for name in self.diagnostics}, **metadata
+        )
+
+    def finish(self) -> None:
+        # Diagnostics are exposed as attributes trimmed to the recorded rows
+        for name in self.diagnostics:
+            setattr(self, name, self._buffers[name][: self.number_of_records])
+        if self.snapshots is not None:
+            self._resize_snapshots(-(-self.number_of_records // self.snapshot_interval))
+
+
+def _write_array(path, array) -> None:
+    # Writes array to an .npy file, in place through a memory map when the file
+    # already holds an array of the same shape and dtype
+    array = np.asarray(array)
+    if os.path.exists(path):
+        stored = np.load(path, mmap_mode="r+")
+        if stored.shape == array.shape and stored.dtype == array.dtype:
+            stored[...] = array
+            stored.flush()
+            return
+        del stored
+    stored = np.lib.format.open_memmap(
+        path, mode="w+", dtype=array.dtype, shape=array.shape
+    )
+    stored[...] = array
+    stored.flush()
+
+
+def _to_json(value):
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.item()
+    if isinstance(value, dict):
+        return {name: _to_json(item) for name, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(item) for item in value]
+    return value
+
+
+class Checkpointer:
+    # Periodic checkpoints of a runner, from which runCX(restart=True) continues
+    # the run along exactly the trajectory it would have followed. Every
+    # `interval` steps the state at the start of the step is copied (particle
+    # vel and weight, fluid mom, temperature and kinetic energy, the loop
+    # counters and timestep, the global numpy and IonSampler random states and
+    # the Diagnostics reference totals) and handed to a background thread which
+    # writes it while the time loop carries on. Arrays are written in place to
+    # memory-mapped .npy files in one of two alternating slots and
+    # latest.json is only switched to a slot once it is complete, so an
+    # interrupted write never damages the last good checkpoint. Recorder rows
+    # are appended incrementally to memory-mapped files shared by both slots.
+    def __init__(self, directory, interval: int) -> None:
+        self.directory = directory
+        self.interval = interval
+        self.number_of_checkpoints = 0
+        self._rows_written = 0
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = None
+        self._error = None
+        os.makedirs(os.path.join(directory, "recorder"), exist_ok=True)
+
+    def due(self, step: int) -> bool:
+        return step % self.interval == 0
+
+    def _writer(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            try:
+                self._write(*job)
+            except Exception as error:  # Re-raised in the time loop
+                self._error = error
+
+    def _write(self, slot: str, arrays: dict, scalars: dict, rows: tuple) -> None:
+        start, columns = rows
+        for name, column in columns.items():
+            path = os.path.join(self.directory, "recorder", name + ".npy")
+            needed = start + len(column)
+            if not os.path.exists(path):
+                stored = np.lib.format.open_memmap(
+                    path,
+                    mode="w+",
+                    dtype=column.dtype,
+                    shape=(max(needed, 1),) + column.shape[1:],
+                )
+            else:
+                stored = np.load(path, mmap_mode="r+")
+                if len(stored) < needed:
+                    del stored
+                    _resize_npy(path, (2 * needed,) + column.shape[1:])
+                    stored = np.load(path, mmap_mode="r+")
+            stored[start:needed] = column
+            stored.flush()
+            del stored
+        slot_directory = os.path.join(self.directory, slot)
+        os.makedirs(slot_directory, exist_ok=True)
+        for name, array in arrays.items():
+            _write_array(os.path.join(slot_directory, name + ".npy"), array)
+        with open(os.path.join(slot_directory, "state.json"), "w") as state_file:
+            json.dump(scalars, state_file)
+        latest = os.path.join(self.directory, "latest.json")
+        with open(latest + ".tmp", "w") as latest_file:
+            json.dump({"slot": slot}, latest_file)
+        os.replace(latest + ".tmp", latest)
+
+    def save(self, CXrunner: "runner", step: int, time: float, dt: float, total_energy):
+        if self._error is not None:
+            raise self._error
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._writer, daemon=True)
+            self._thread.start()
+        ions, neutrals = CXrunner.ions, CXrunner.neutrals
+        values = {
+            "step": step,
+            "time": time,
+            "dt": dt,
+            "number_of_steps_taken": CXrunner.number_of_steps_taken,
+            "total_energy": total_energy,
+            "weight": neutrals.weight,
+            "neutrals_kinetic_energy": neutrals.kinetic_energy,
+            "neutrals_temperature": neutrals.temperature,
+            "energy_error": getattr(neutrals, "energy_error", None),
+            "ions_mom": ions.mom,
+            "ions_temperature": ions.temperature,
+            "ions_kinetic_energy": ions.kinetic_energy,
+            "ions_density": ions.density,
+            "number_of_records": CXrunner.recorder.number_of_records,
+            "momentum_start": CXrunner.diagnostics.momentum_start,
+            "energy_start": CXrunner.diagnostics.energy_start,
+        }
+        if neutrals.integrator == "stochastic":
+            # The incremental sums carry their own rounding, so they are saved
+            # rather than recomputed on restore
+            for name, value in neutrals._sums.items():
+                values["sum_" + name] = value
+            values["events_since_refresh"] = neutrals._events_since_refresh
+        if not isinstance(neutrals, HybridParticles):
+            values["vel"] = neutrals.vel
+        else:
+            # Reading vel would resample the moment mode and change the run
+            values["vel"] = neutrals._vel
+            values["hybrid_moment_mode"] = neutrals.moment_mode
+            values["hybrid_switches"] = neutrals.number_of_switches
+            values["hybrid_steps_since_check"] = neutrals._steps_since_check
+            for name, value in getattr(neutrals, "_sums", {}).items():
+                values["sum_" + name] = value
+            generator = neutrals._generator
+            if generator is not None and ions.sampler is not None:
+                # The fluid's IonSampler stream, restored with the sampler
+                generator = (
+                    "sampler" if generator is ions.sampler.generator else generator
+                )
+            if isinstance(generator, np.random.Generator):
+                generator = generator.bit_generator.state
+            values["hybrid_generator"] = generator
+        if isinstance(CXrunner.CXrate, RateCoefficients):
+            # The cached rates depend on when they were last evaluated
+            rate = CXrunner.CXrate
+            values["rate_temperature"] = rate.temperature
+            values["rate_cached"] = rate.cached
+            values["rate_max"] = rate.max_rate
+            values["rate_evaluations"] = rate.number_of_evaluations
+        # Arrays are copied now, as the time loop updates them in place
+        arrays = {
+            name: np.array(value)
+            for name, value in values.items()
+            if isinstance(value, np.ndarray) and value.ndim > 0
+        }
+        scalars = {
+            name: _to_json(value)
+            for name, value in values.items()
+            if name not in arrays
+        }
+        legacy_state = np.random.get_state()
+        arrays["global_random_keys"] = legacy_state[1].copy()
+        scalars["global_random"] = _to_json(legacy_state[:1] + legacy_state[2:])
+        scalars["sampler"] = (
+            None if ions.sampler is None else _to_json(ions.sampler.get_state())
+        )
+        number_of_records = CXrunner.recorder.number_of_records
+        rows = (
+            self._rows_written,
+            CXrunner.recorder.rows(self._rows_written, number_of_records),
+        )
+        self._rows_written = number_of_records
+        slot = "slot%d" % (self.number_of_checkpoints % 2)
+        self.number_of_checkpoints += 1
+        self._queue.put((slot, arrays, scalars, rows))
+
+    def close(self) -> None:
+        # Waits for the pending checkpoint writes to reach the disk
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            raise self._error
+
+    def restore(self, CXrunner: "runner") -> dict:
+        # Loads the latest complete checkpoint into the runner's objects and
+        # returns the loop state (step, time, dt, total_energy) to resume from
+        with open(os.path.join(self.directory, "latest.json")) as latest_file:
+            slot_directory = os.path.join(
+                self.directory, json.load(latest_file)["slot"]
+            )
+        with open(os.path.join(slot_directory, "state.json")) as state_file:
+            values = json.load(state_file)
+        for name in os.listdir(slot_directory):
+            if name.endswith(".npy"):
+                values[name[: -len(".npy")]] = np.array(
+                    np.load(os.path.join(slot_directory, name), mmap_mode="r")
+                )
+        ions, neutrals = CXrunner.ions, CXrunner.neutrals
+        neutrals.vel = values["vel"]
+        neutrals.weight = values["weight"]
+        neutrals.kinetic_energy = values["neutrals_kinetic_energy"]
+        neutrals.temperature = values["neutrals_temperature"]
+        if values["energy_error"] is not None:
+            neutrals.energy_error = values["energy_error"]
+        if neutrals.integrator == "stochastic":
+            neutrals._sums = {
+                name: values["sum_" + name] for name in ("weight", "momentum", "energy")
+            }
+            neutrals._events_since_refresh = values["events_since_refresh"]
+        if isinstance(neutrals, HybridParticles):
+            neutrals.moment_mode = values["hybrid_moment_mode"]
+            neutrals.number_of_switches = values["hybrid_switches"]
+            neutrals._steps_since_check = values["hybrid_steps_since_check"]
+            if "sum_weight" in values:
+                neutrals._sums = {
+                    name: values["sum_" + name]
+                    for name in ("weight", "momentum", "energy")
+                }
+            generator = values["hybrid_generator"]
+            if generator == "sampler":
+                neutrals._generator = ions.sampler.generator
+            elif generator is None:
+                neutrals._generator = None
+            else:
+                neutrals._generator = np.random.default_rng()
+                neutrals._generator.bit_generator.state = generator
+        if isinstance(CXrunner.CXrate, RateCoefficients):
+            rate = CXrunner.CXrate
+            rate.temperature = (
+                None
+                if values["rate_temperature"] is None
+                else np.asarray(values["rate_temperature"], dtype=np.float64)
+            )
+            rate.cached = (
+                None
+                if values["rate_cached"] is None
+                else np.asarray(values["rate_cached"])
+            )
+            rate.max_rate = values["rate_max"]
+            rate.number_of_evaluations = values["rate_evaluations"]
+        ions.mom = values["ions_mom"]
+        ions.temperature = values["ions_temperature"]
+        ions.kinetic_energy = values["ions_kinetic_energy"]
+        ions.density = values["ions_density"]
+        key, pos, has_gauss, cached_gaussian = values["global_random"]
+        np.random.set_state(
+            (key, values["global_random_keys"], pos, has_gauss, cached_gaussian)
+        )
+        if values["sampler"] is not None:
+            ions.sampler.set_state(values["sampler"])
+        CXrunner.diagnostics.momentum_start = values["momentum_start"]
+        CXrunner.diagnostics.energy_start = values["energy_start"]
+        number_of_records = values["number_of_records"]
+        columns = {
+            name: np.load(
+                os.path.join(self.directory, "recorder", name + ".npy"), mmap_mode="r"
+            )
+            for name in Recorder.diagnostics
+        }
+        CXrunner.recorder.restore(columns, number_of_records)
+        self._rows_written = number_of_records
+        CXrunner.number_of_steps_taken = values["number_of_steps_taken"]
+        return values
+
+
+class TimestepController:
+    # Adapts the timestep to the relative error estimate of the last step. The
+    # estimate is the kinetic energy error of applyCX plus, for the first-order
+    # "euler" integrator, the relaxation error: a step moves the fraction
+    # x = dt * rate * density of the way to the ions where 1 - exp(-x) is
+    # exact, so the energy it moved between neutrals and fluid (relative to the
+    # fluid thermal energy) is off by about x/2 of itself. Both are first order
+    # in dt, so the next step is dt * safety * tolerance / error, limited to
+    # [max_shrink, max_growth] times the last step and to [dt_min, dt_max].
+    # Near equilibrium both estimates vanish, so the exchanged fraction x is
+    # also bounded, by max_fraction and, for the euler integrator, by
+    # sqrt(2 * tolerance), the fraction whose relaxation error x**2/2 per step
+    # reaches the tolerance; this bound sets the accuracy of the late, large
+    # steps. Ensemble members share the step set by the worst member.
+    def __init__(
+        self,
+        tolerance: float,
+        dt_min: float = 0.0,
+        dt_max: float = np.inf,
+        safety: float = 0.9,
+        max_growth: float = 2.0,
+        max_shrink: float = 0.2,
+        max_fraction: float = 0.05,
+    ) -> None:
+        self.tolerance = tolerance
+        self.dt_min = dt_min
+        self.dt_max = dt_max
+        self.safety = safety
+        self.max_growth = max_growth
+        self.max_shrink = max_shrink
+        self.max_fraction = max_fraction
+
+    def next_dt(
+        self, dt: float, error: float, exchange_rate: float, moved: float = None
+    ) -> float:
+        # moved is the relative energy moved over the step by a first-order
+        # integrator, or None when the relaxation is exact
+        max_fraction = self.max_fraction
+        if moved is not None:
+            error = error + 0.5 * exchange_rate * dt * moved
+            max_fraction = min(max_fraction, np.sqrt(2.0 * self.tolerance))
+        error = np.max(error)
+        if error > 0.0:
+            factor = self.safety * self.tolerance / error
+            factor = min(max(factor, self.max_shrink), self.max_growth)
+        else:
+            factor = self.max_growth
+        dt_limit = min(self.dt_max, max_fraction / np.max(exchange_rate))
+        return min(max(dt * factor, self.dt_min), dt_limit)
 
 
 class InitialConditions:
@@ -296,13 +2289,171 @@ class InitialConditions:
         self.neutrals_velocity = neutrals_velocity
 
 
+class PhaseTimer:
+    # Accumulates wall-clock time per phase of a step. start() marks the
+    # beginning of a step and each lap(phase) charges the time since the
+    # previous mark to that phase.
+    def __init__(self) -> None:
+        self.totals = {}
+        self._last = time.perf_counter()
+
+    def start(self) -> None:
+        self._last = time.perf_counter()
+
+    def lap(self, phase: str) -> None:
+        now = time.perf_counter()
+        self.totals[phase] = self.totals.get(phase, 0.0) + now - self._last
+        self._last = now
+
+    def take(self, phases) -> dict:
+        # Time per phase since the previous take, resetting the totals
+        taken = {phase: self.totals.get(phase, 0.0) for phase in phases}
+        self.totals = {}
+        return taken
+
+
+class MemorySink:
+    # Keeps every record in memory; column(name) stacks one quantity over the run
+    def __init__(self) -> None:
+        self.records = []
+
+    def write(self, record: dict) -> None:
+        self.records.append(record)
+
+    def column(self, name: str):
+        return np.array([record[name] for record in self.records])
+
+    def close(self) -> None:
+        pass
+
+
+class CSVSink:
+    # Writes one row per record to a CSV file with a header of record keys.
+    # Per-member or per-cell values are written space separated in their field.
+    def __init__(self, path) -> None:
+        self.path = path
+        self._file = None
+
+    def write(self, record: dict) -> None:
+        if self._file is None:
+            self._file = open(self.path, "w")
+            self._file.write(",".join(record) + "\n")
+        fields = (
+            " ".join(repr(float(value)) for value in np.ravel(values))
+            for values in record.values()
+        )
+        self._file.write(",".join(fields) + "\n")
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class NPZSink:
+    # Collects records by key and saves them as columns of an .npz file on close
+    def __init__(self, path) -> None:
+        self.path = path
+        self.columns = {}
+
+    def write(self, record: dict) -> None:
+        for name, value in record.items():
+            self.columns.setdefault(name, []).append(value)
+
+    def close(self) -> None:
+        np.savez(
+            self.path,
+            **{name: np.array(values) for name, values in self.columns.items()}
+        )
+
+
+class CallbackSink:
+    # Passes every record to callback(record), e.g. to forward it to a logger
+    def __init__(self, callback) -> None:
+        self.callback = callback
+
+    def write(self, record: dict) -> None:
+        self.callback(record)
+
+    def close(self) -> None:
+        pass
+
+
 class Diagnostics:
+    # Instrumentation of a run. include_diagnostics records conservation
+    # metrics: the drift of total momentum and energy relative to the start, the
+    # applyCX energy error estimate and the fluid temperatures obtained with
+    # combined and with separate macroparticles. include_sampling records the
+    # wall-clock time of each phase of a step. produce_plots makes runner save
+    # the recorded history to plot_directory and render the figures there, by
+    # default in a background process so runCX returns without waiting for
+    # matplotlib. A record is taken every `interval` steps and
+    # written to every sink (a MemorySink by default). With both include flags
+    # off nothing is measured and the time loop only checks a flag per step.
+    phases = ("recording", "sampling", "sort", "update", "energy")
+
     def __init__(
-        self, include_diagnostis: bool, include_sampling: bool, produce_plots: bool
+        self,
+        include_diagnostics: bool = False,
+        include_sampling: bool = False,
+        produce_plots: bool = False,
+        interval: int = 1,
+        sinks=None,
+        plot_directory=".",
+        background_plots: bool = True,
     ) -> None:
         self.include_diagnostics = include_diagnostics
         self.include_sampling = include_sampling
         self.produce_plots = produce_plots
+        self.plot_directory = plot_directory
+        self.background_plots = background_plots
+        self.interval = interval
+        self.sinks = [MemorySink()] if sinks is None else list(sinks)
+        self.timer = PhaseTimer() if include_sampling else None
+        self.enabled = include_diagnostics or include_sampling
+
+    def due(self, step: int) -> bool:
+        return self.enabled and step % self.interval == 0
+
+    def _totals(self, ions: IonFluid, neutrals: Particles):
+        # Total momentum and energy of the fluid and macroparticles, summed over
+        # the cells of a spatial run and kept per member in ensemble mode
+        fluid_momentum = ions.mom * ions.Volume
+        energy = ions.kinetic_energy + neutrals.kinetic_energy
+        if isinstance(ions, SpatialIonFluid):
+            return np.sum(fluid_momentum) + neutrals.total_momentum(), np.sum(energy)
+        return fluid_momentum + neutrals.total_momentum(), energy
+
+    def start(self, ions: IonFluid, neutrals: Particles) -> None:
+        self.momentum_start, self.energy_start = self._totals(ions, neutrals)
+        neutrals.timer = self.timer
+        if self.timer is not None:
+            self.timer.take(())
+
+    def record(
+        self, step: int, time: float, dt: float, ions: IonFluid, neutrals: Particles
+    ) -> None:
+        record = {"step": step, "time": time, "dt": dt}
+        if self.include_diagnostics:
+            momentum, energy = self._totals(ions, neutrals)
+            record["momentum_drift"] = (momentum - self.momentum_start) / abs(
+                self.momentum_start
+            )
+            record["energy_drift"] = (energy - self.energy_start) / abs(
+                self.energy_start
+            )
+            record.update(neutrals.metrics)
+        if self.timer is not None:
+            for phase, seconds in self.timer.take(self.phases).items():
+                record["time_" + phase] = seconds
+        for sink in self.sinks:
+            sink.write(record)
+
+    def finish(self, neutrals: Particles) -> None:
+        neutrals.timer = None
+        neutrals.collect_metrics = False
+        for sink in self.sinks:
+            sink.close()
 
 
 class runner:
@@ -314,6 +2465,12 @@ class runner:
         dt_SI,
         CXrate,
         Volume,
+        recorder: Recorder = None,
+        controller: TimestepController = None,
+        diagnostics: Diagnostics = None,
+        checkpointer: Checkpointer = None,
+        processes: list = None,
+        splitting: str = "lie",
     ):
         self.ions = ions
         self.neutrals = neutrals
@@ -321,29 +2478,95 @@ class runner:
         self.dt_SI = dt_SI
         self.CXrate = CXrate
         self.Volume = Volume
+        # Diagnostics are streamed into the recorder; by default every timestep
+        self.recorder = Recorder() if recorder is None else recorder
+        # With a controller dt_SI is only the first step and the run covers the
+        # same time span as number_of_timesteps fixed steps
+        self.controller = controller
+        # Instrumentation; by default nothing is measured or plotted
+        self.diagnostics = Diagnostics() if diagnostics is None else diagnostics
+        # Optional periodic checkpoints, which runCX(restart=True) resumes from
+        self.checkpointer = checkpointer
+        # Further atomic processes (e.g. ("ionisation", rate)) operator-split
+        # with charge exchange at CXrate using the given OperatorSplitting scheme
+        self.processes = [] if processes is None else list(processes)
+        self.splitting = splitting
+
+    def _steps(self, i: int = 0, time: float = 0.0, dt: float = None):
+        # Yields (timestep, time, dt) for each step of the run, starting from
+        # step i at the given time and (adaptive) step size
+        if self.controller is None:
+            for i in range(i, self.number_of_timesteps):
+                yield i, i * self.dt_SI, self.dt_SI
+            return
+        end_time = self.number_of_timesteps * self.dt_SI
+        dt = self.dt_SI if dt is None else dt
+        while end_time - time > 1e-12 * end_time:
+            dt = min(dt, end_time - time)
+            kinetic_energy_before = self.neutrals.kinetic_energy
+            yield i, time, dt
+            time += dt
+            moved = None
+            if self.neutrals.integrator == "euler":
+                ions = self.ions
+                moved = np.abs(self.neutrals.kinetic_energy - kinetic_energy_before) / (
+                    0.5 * ions.density * ions.Volume * ions.temperature
+                )
+            dt = self.controller.next_dt(
+                dt,
+                self.neutrals.energy_error,
+                _rate_value(self.CXrate) * self.ions.density,
+                moved,
+            )
+            i += 1
 
-    def runCX(self):
-        neutralVel = np.zeros((self.number_of_timesteps, len(self.neutrals.weight)))
-        ionMom = np.zeros(self.number_of_timesteps)
-        particles_energy = np.zeros(self.number_of_timesteps)
-        fluid_energy = np.zeros(self.number_of_timesteps)
-        temperature_fluid = np.zeros(self.number_of_timesteps)
-        temperature_particles = np.zeros(self.number_of_timesteps)
-        single_momentum_random = np.zeros(len(self.neutrals.weight))
-        time = np.zeros(self.number_of_timesteps)
+    def runCX(self, restart: bool = False):
+        # In ensemble mode every diagnostic gains a trailing ensemble axis and all
+        # members are advanced together by each call in the time loop.
+        # With restart the run continues from the latest checkpoint written by
+        # the checkpointer, given a runner set up as for the original run.
+        self.recorder.start(
+            self.ions, self.neutrals, self.number_of_timesteps, resume=restart
+        )
+
+        diagnostics = self.diagnostics
+        diagnostics.start(self.ions, self.neutrals)
+        timer = diagnostics.timer
 
+        checkpointer = self.checkpointer
+        pipeline = OperatorSplitting(
+            [ChargeExchange(self.CXrate)] + self.processes, self.splitting
+        )
         total_energy = self.ions.kinetic_energy + self.neutrals.kinetic_energy
-        for i in range(len(ionMom)):
-            ionMom[i] = self.ions.mom
-            neutralVel[i, :] = self.neutrals.vel[:]
-            time[i] = i * self.dt_SI
-            particles_energy[i] = self.neutrals.kinetic_energy
-            fluid_energy[i] = self.ions.kinetic_energy
-            temperature_fluid[i] = self.ions.temperature
-            temperature_particles[i] = self.neutrals.temperature
-            single_momentum_random = self.ions.getRandomMom(len(self.neutrals.weight))
-            self.neutrals.applyCX(
-                self.CXrate, self.dt_SI, self.ions, self.Volume, single_momentum_random, i
+        self.number_of_steps_taken = 0
+        first_step = (0, 0.0, None)
+        if restart:
+            state = checkpointer.restore(self)
+            total_energy = state["total_energy"]
+            first_step = (state["step"], state["time"], state["dt"])
+        for i, time, dt in self._steps(*first_step):
+            if (
+                checkpointer is not None
+                and checkpointer.due(i)
+                and i != first_step[0]
+            ):
+                checkpointer.save(self, i, time, dt, total_energy)
+            self.number_of_steps_taken += 1
+            if timer is not None:
+                timer.start()
+            if self.recorder.due(i):
+                self.recorder.record(time, self.ions, self.neutrals)
+            if timer is not None:
+                timer.lap("recording")
+            single_momentum_random = self.neutrals.sampleIonMom(self.ions)
+            if timer is not None:
+                timer.lap("sampling")
+            diagnostics_due = diagnostics.due(i)
+            self.neutrals.collect_metrics = (
+                diagnostics_due and diagnostics.include_diagnostics
+            )
+            pipeline.apply(
+                dt, self.ions, self.neutrals, self.Volume, single_momentum_random, i
             )
             #plt.clf()
             #if i == 0:
@@ -377,22 +2600,31 @@ class runner:
                 total_energy, self.neutrals.kinetic_energy
             )  # Update fluid temperature
             self.ions.updateKineticEnergy()  # Updates Ions Kinetic Energy
+            if timer is not None:
+                timer.lap("energy")
+            if diagnostics_due:
+                diagnostics.record(i, time + dt, dt, self.ions, self.neutrals)
 
-        newPlot_numerical = Plotting(
-            time,
-            self.neutrals.mass,
-            self.neutrals.weight,
-            self.ions.density,
-            neutralVel,
-            ionMom,
-            self.Volume,
-        )
-        newPlot_numerical.plot_bulk_properties("Momentum_Numerical_Bulk.png")
-        newPlot_numerical.plot_single_properties("Momentum_Numerical_Single.png")
-        newPlot_numerical.plot_log_exp(self.CXrate,self.ions.density,"Momentum_Numerical_Slope.png")
-        newPlot_numerical.plot_total_energy(
-            particles_energy, fluid_energy, "Energy.png"
-        )
-        newPlot_numerical.plot_temperature(
-            temperature_fluid, temperature_particles, "Temperature.png"
-        )
+        if checkpointer is not None:
+            checkpointer.close()
+        self.recorder.finish()
+        diagnostics.finish(self.neutrals)
+        # Plots are drawn from the saved results, in a background process
+        # unless the diagnostics ask to wait for them
+        self.render_process = None
+        if diagnostics.produce_plots:
+            results_path = os.path.join(diagnostics.plot_directory, "run_results.npz")
+            self.recorder.save(
+                results_path, Volume=self.Volume, CXrate=_rate_value(self.CXrate)
+            )
+            if diagnostics.background_plots:
+                self.render_process = render_in_background(
+                    results_path, diagnostics.plot_directory
+                )
+            else:
+                render_plots(results_path, diagnostics.plot_directory)
+
+
+if __name__ == "__main__":
+    # python chargeexchange.py results.npz [directory] renders saved results
+    render_plots(*sys.argv[1:3])
@@ -0,0 +1,150 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+import chargeexchange as CX
+
+
+class FluidBuffer:
+    # Fluid state and charge exchange sources shared between the kinetic code
+    # and an external fluid solver in one block of shared memory, one float64
+    # array per field shaped like the fluid (() for a single realisation,
+    # (ensemble,) or (cells,)). The fluid writes density, mom (density * bulk
+    # velocity * mass, as IonFluid.mom) and temperature; the kinetic side writes
+    # the momentum and energy density gained by the fluid over each step. Other
+    # codes attach to the block by name (/dev/shm/<name> on Linux).
+    fields = ("density", "mom", "temperature", "momentum_source", "energy_source")
+
+    def __init__(self, shape=(), name=None, create: bool = True) -> None:
+        self.shape = tuple(shape)
+        field_bytes = int(np.prod(self.shape)) * np.dtype(np.float64).itemsize
+        self.memory = shared_memory.SharedMemory(
+            name, create, len(self.fields) * field_bytes
+        )
+        for index, field in enumerate(self.fields):
+            setattr(
+                self,
+                field,
+                np.ndarray(
+                    self.shape, np.float64, self.memory.buf, index * field_bytes
+                ),
+            )
+
+    @property
+    def name(self) -> str:
+        return self.memory.name
+
+    def close(self) -> None:
+        # Views of the block must be released before it can be closed
+        for field in self.fields:
+            delattr(self, field)
+        self.memory.close()
+
+    def unlink(self) -> None:
+        self.memory.unlink()
+
+
+class KineticCoupler:
+    # Kinetic side of a run coupled to a fluid solver through a FluidBuffer.
+    # Each step it waits for the fluid to publish its state, reads density and
+    # temperature straight from the buffer, advances the neutrals by one charge
+    # exchange step against it and writes the momentum and energy sources of the
+    # step back into the buffer in place, then waits for the fluid to take them.
+    # The fluid owns its state: it applies the sources itself, so the kinetic
+    # side keeps no energy bookkeeping of the fluid. barrier is any object with
+    # a wait() shared with the fluid process, e.g. multiprocessing.Barrier(2).
+    def __init__(
+        self,
+        buffer: FluidBuffer,
+        neutrals: CX.Particles,
+        CXrate,
+        Volume,
+        barrier,
+        sampler: CX.IonSampler = None,
+    ) -> None:
+        self.buffer = buffer
+        self.neutrals = neutrals
+        self.CXrate = CXrate
+        self.Volume = Volume
+        self.barrier = barrier
+        fluid_class = (
+            CX.SpatialIonFluid
+            if isinstance(neutrals, CX.SpatialParticles)
+            else CX.IonFluid
+        )
+        self.ions = fluid_class(
+            neutrals.mass,
+            buffer.density,
+            buffer.mom,
+            buffer.temperature,
+            Volume,
+            sampler,
+        )
+        # Density and temperature are views of the buffer; mom is a private
+        # array applyCX updates, refreshed from the buffer every step
+        self.ions.density = buffer.density
+        self.ions.temperature = buffer.temperature
+        self.ions.mom = np.array(buffer.mom)
+
+    def step(self, dt: float, timestep: int) -> None:
+        # One charge exchange step against the fluid state in the buffer
+        ions, neutrals, buffer = self.ions, self.neutrals, self.buffer
+        np.copyto(ions.mom, buffer.mom)
+        ions.updateKineticEnergy()
+        kinetic_energy_before = neutrals.kinetic_energy
+        single_momentum_random = neutrals.sampleIonMom(ions)
+        neutrals.applyCX(
+            self.CXrate, dt, ions, self.Volume, single_momentum_random, timestep
+        )
+        neutrals.updateKineticEnergy()
+        neutrals.updatetemperature()
+        np.subtract(ions.mom, buffer.mom, out=buffer.momentum_source)
+        buffer.energy_source[...] = (
+            kinetic_energy_before - neutrals.kinetic_energy
+        ) / self.Volume
+
+    def run(
+        self, number_of_timesteps: int, dt_SI: float, recorder: CX.Recorder = None
+    ) -> None:
+        if recorder is not None:
+            recorder.start(self.ions, self.neutrals, number_of_timesteps)
+        for i in range(number_of_timesteps):
+            self.barrier.wait()  # Fluid state published
+            if recorder is not None and recorder.due(i):
+                np.copyto(self.ions.mom, self.buffer.mom)
+                recorder.record(i * dt_SI, self.ions, self.neutrals)
+            self.step(dt_SI, i)
+            self.barrier.wait()  # Sources written
+        if recorder is not None:
+            recorder.finish()
+
+    def detach(self) -> None:
+        # Replaces the views of the buffer by copies, so the ions outlive it
+        self.ions.density = np.array(self.ions.density)
+        self.ions.temperature = np.array(self.ions.temperature)
+
+
+def apply_sources(buffer: FluidBuffer, mass: float) -> None:
+    # Adds the charge exchange sources to the fluid state in place, keeping
+    # the fluid energy density mom^2/(2*mass*density) + density*temperature/2
+    # plus the energy source
+    bulk_before = buffer.mom**2 / (2.0 * mass * buffer.density)
+    buffer.mom += buffer.momentum_source
+    bulk_after = buffer.mom**2 / (2.0 * mass * buffer.density)
+    buffer.temperature += (
+        2.0 * (buffer.energy_source - (bulk_after - bulk_before)) / buffer.density
+    )
+
+
+def stand_in_fluid(name: str, shape, mass: float, barrier, number_of_timesteps):
+    # Local stand-in for the external fluid code, run as a separate process.
+    # It attaches to the buffer the kinetic side created and, like the
+    # IonFluid of a runner, has no dynamics of its own: each step it publishes
+    # its state and applies the charge exchange sources it receives.
+    buffer = FluidBuffer(shape, name, create=False)
+    try:
+        for _ in range(number_of_timesteps):
+            barrier.wait()
+            barrier.wait()
+            apply_sources(buffer, mass)
+    finally:
+        buffer.close()
@@ -0,0 +1,317 @@
+import math
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+import chargeexchange as CX
+
+# Reduced sums kept per chunk: weight, momentum and energy (without the mass)
+SUMS = ("weight", "momentum", "energy")
+
+
+def _reduce(partials: list, number_of_sums: int) -> tuple:
+    # Combines per-chunk partial sums, gathered from every worker, in chunk
+    # order with math.fsum. fsum is correctly rounded, so the totals depend only
+    # on the chunk partials and not on how chunks were spread over workers.
+    partials = sorted(partials)
+    return tuple(
+        math.fsum(partial[1][index] for partial in partials)
+        for index in range(number_of_sums)
+    )
+
+
+class _Shard:
+    # The chunks of the macroparticle arrays owned by one worker, each with its
+    # own ion sample stream. Partial sums are returned per chunk as
+    # (chunk index, sums) and are accumulated pairwise within the chunk.
+    def __init__(self, weight, vel, chunks: list, streams: list) -> None:
+        self.weight = weight
+        self.vel = vel
+        self.chunks = chunks
+        self.generators = {
+            index: np.random.Generator(np.random.PCG64(streams[index]))
+            for index, _, _ in chunks
+        }
+        self.ion_vel = {}
+
+    def sums(self) -> list:
+        partials = []
+        for index, start, stop in self.chunks:
+            weight = self.weight[start:stop]
+            vel = self.vel[start:stop]
+            partials.append(
+                (
+                    index,
+                    (
+                        CX._accurate_sum(weight),
+                        CX._accurate_sum(weight * vel),
+                        CX._accurate_sum(weight * vel * vel),
+                    ),
+                )
+            )
+        return partials
+
+    def sample(self, bulk_velocity: float, thermal_velocity: float) -> list:
+        # Draws the ion velocity paired with each macroparticle (in storage
+        # order) and returns the partial sums of weight * velocity gap
+        partials = []
+        for index, start, stop in self.chunks:
+            z = self.generators[index].standard_normal(stop - start)
+            self.ion_vel[index] = bulk_velocity + thermal_velocity * z
+            gap = self.ion_vel[index] - self.vel[start:stop]
+            partials.append((index, (CX._accurate_sum(self.weight[start:stop] * gap),)))
+        return partials
+
+    def update(self, fraction: float, bulk_shift: float) -> list:
+        # Moves each macroparticle the fraction of the way to its ion (plus
+        # the exponential integrator's bulk correction) and returns the partial
+        # momentum change, squared gap and the new sums
+        partials = []
+        for index, start, stop in self.chunks:
+            weight = self.weight[start:stop]
+            vel = self.vel[start:stop]
+            gap = self.ion_vel.pop(index) - vel
+            exchange = fraction * gap + bulk_shift
+            vel += exchange
+            partials.append(
+                (
+                    index,
+                    (
+                        CX._accurate_sum(weight * exchange),
+                        CX._accurate_sum(weight * gap * gap),
+                        CX._accurate_sum(weight),
+                        CX._accurate_sum(weight * vel),
+                        CX._accurate_sum(weight * vel * vel),
+                    ),
+                )
+            )
+        return partials
+
+
+def _serve(
+    connection, memory_name: str, number_of_macroparticles: int, chunks, streams
+):
+    # Worker process: attaches to the shared macroparticle arrays and runs
+    # _Shard methods on request until told to stop
+    memory = shared_memory.SharedMemory(memory_name)
+    weight = np.ndarray(number_of_macroparticles, np.float64, memory.buf)
+    vel = np.ndarray(number_of_macroparticles, np.float64, memory.buf, weight.nbytes)
+    shard = _Shard(weight, vel, chunks, streams)
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        name, arguments = request
+        connection.send(getattr(shard, name)(*arguments))
+    del shard, weight, vel
+    memory.close()
+
+
+class ShardedParticles(CX.Particles):
+    # Macroparticles of a single realisation sharded over worker processes.
+    # weight and vel live in shared memory and are split into fixed chunks of
+    # chunk_size macroparticles, dealt out to the workers in contiguous blocks.
+    # Each step every worker pairs its macroparticles with ions drawn from its
+    # chunks' own streams (spawned from seed), applies the charge exchange
+    # update and returns per-chunk partial sums, which are reduced with _reduce
+    # to update IonFluid.mom and the kinetic energy. As chunk boundaries and
+    # streams do not depend on the number of workers, neither do the results:
+    # any worker count reproduces workers=1 (run in this process) bit for bit.
+    # Ion samples are paired in storage order and are not moment matched, and
+    # the integrator is "euler" or "exponential". runner drives the object as
+    # it does Particles. The shared weight and vel arrays are updated in place
+    # and cannot be replaced (ValueError), so processes which assign new arrays
+    # (Ionisation, Recombination), checkpoint restores and split/merge are not
+    # supported.
+    def __init__(
+        self,
+        mass: float,
+        weight: float,
+        vel: float,
+        integrator: str = "euler",
+        workers: int = None,
+        chunk_size: int = 65536,
+        seed=None,
+    ) -> None:
+        if np.ndim(vel) != 1:
+            raise ValueError("Sharded particles hold a single realisation")
+        if integrator not in ("euler", "exponential"):
+            raise ValueError("Sharded particles support euler and exponential")
+        number_of_macroparticles = len(vel)
+        self._shared = False
+        self.memory = shared_memory.SharedMemory(
+            create=True, size=2 * number_of_macroparticles * 8
+        )
+        shared_weight = np.ndarray(
+            number_of_macroparticles, np.float64, self.memory.buf
+        )
+        shared_vel = np.ndarray(
+            number_of_macroparticles, np.float64, self.memory.buf, shared_weight.nbytes
+        )
+        shared_weight[...] = np.broadcast_to(weight, number_of_macroparticles)
+        shared_vel[...] = vel
+
+        starts = range(0, number_of_macroparticles, chunk_size)
+        chunks = [
+            (index, start, min(start + chunk_size, number_of_macroparticles))
+            for index, start in enumerate(starts)
+        ]
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self.seed = seed
+        self.chunk_size = chunk_size
+        streams = seed.spawn(len(chunks))
+        workers = os.cpu_count() if workers is None else workers
+        self.workers = []
+        self._shard = None
+        if workers == 1:
+            self._shard = _Shard(shared_weight, shared_vel, chunks, streams)
+        else:
+            for block in np.array_split(np.arange(len(chunks)), workers):
+                if len(block) == 0:
+                    continue
+                connection, worker_connection = multiprocessing.Pipe()
+                process = multiprocessing.Process(
+                    target=_serve,
+                    args=(
+                        worker_connection,
+                        self.memory.name,
+                        number_of_macroparticles,
+                        [chunks[index] for index in block],
+                        streams,
+                    ),
+                    daemon=True,
+                )
+                process.start()
+                self.workers.append((process, connection))
+
+        self._sums = dict(zip(SUMS, _reduce(self._call("sums"), len(SUMS))))
+        CX.Particles.__init__(
+            self, mass, shared_weight, shared_vel, "random", integrator
+        )
+        self.weight = shared_weight
+        self.vel = shared_vel
+        self._shared = True
+
+    @property
+    def weight(self):
+        return self._weight
+
+    @weight.setter
+    def weight(self, value) -> None:
+        self._replace("_weight", value)
+
+    @property
+    def vel(self):
+        return self._vel
+
+    @vel.setter
+    def vel(self, value) -> None:
+        self._replace("_vel", value)
+
+    def _replace(self, name: str, value) -> None:
+        # The workers and the reduced sums follow the shared arrays, so a new
+        # array would silently detach them from the particles
+        if self._shared and value is not getattr(self, name):
+            raise ValueError(
+                "The shared arrays of sharded particles cannot be replaced"
+            )
+        setattr(self, name, value)
+
+    def _call(self, name: str, *arguments) -> list:
+        # Runs a _Shard method on every worker and gathers the chunk partials
+        if self._shard is not None:
+            return getattr(self._shard, name)(*arguments)
+        for _, connection in self.workers:
+            connection.send((name, arguments))
+        partials = []
+        for _, connection in self.workers:
+            partials.extend(connection.recv())
+        return partials
+
+    def close(self) -> None:
+        # Stops the workers and frees the shared memory; weight and vel are
+        # kept as ordinary arrays
+        for process, connection in self.workers:
+            connection.send(None)
+            process.join()
+        self.workers = []
+        self._shard = None
+        self._shared = False
+        self.weight = np.array(self.weight)
+        self.vel = np.array(self.vel)
+        self.memory.close()
+        self.memory.unlink()
+
+    def sampleIonMom(self, ionFluid: CX.IonFluid) -> float:
+        # Ions are drawn by the workers inside applyCX
+        return None
+
+    def applyCX(
+        self,
+        rate: float,
+        dt: float,
+        ionFluid: CX.IonFluid,
+        Volume: float,
+        ionSingleMom: float,
+        timestep: int,
+    ) -> None:
+        if isinstance(rate, CX.RateCoefficients):
+            rate = rate.evaluate(ionFluid, self)
+        kinetic_energy_before = self.kinetic_energy + ionFluid.kinetic_energy
+        fraction = self.exchangeFraction(rate, dt, ionFluid.density)
+        bulk_velocity = ionFluid.mom / (ionFluid.mass * ionFluid.density)
+        thermal_velocity = (ionFluid.temperature / ionFluid.mass) ** 0.5
+        (gap_sum,) = _reduce(self._call("sample", bulk_velocity, thermal_velocity), 1)
+        if self.timer is not None:
+            self.timer.lap("sampling")
+        bulk_shift = 0.0
+        if self.integrator == "exponential":
+            # Closes the bulk gap at the coupled rate, as Particles.applyCX does
+            total_weight = self._sums["weight"]
+            neutral_density = total_weight / Volume
+            relaxed = -np.expm1(-rate * (ionFluid.density + neutral_density) * dt)
+            bulk_fraction = (
+                relaxed * ionFluid.density / (ionFluid.density + neutral_density)
+            )
+            bulk_shift = (bulk_fraction - fraction) * gap_sum / total_weight
+        momentum_change, squared_gap, *sums = _reduce(
+            self._call("update", fraction, bulk_shift), 5
+        )
+        ionFluid.mom -= self.mass * momentum_change / Volume
+        self._sums = dict(zip(SUMS, sums))
+        if self.timer is not None:
+            self.timer.lap("update")
+        error_kinetic_energy = (
+            0.5 * self.mass * (fraction - 1.0) * fraction * squared_gap
+        )
+        self.energy_error = abs(error_kinetic_energy) / kinetic_energy_before
+        if self.collect_metrics:
+            self.metrics = {"energy_error": self.energy_error}
+        if self.timer is not None:
+            self.timer.lap("energy")
+
+    def moments(self, chunk_size: int):
+        # From the reduced sums of the last step rather than a pass over vel
+        total_weight = self._sums["weight"]
+        mean = self._sums["momentum"] / total_weight
+        variance = max(self._sums["energy"] / total_weight - mean * mean, 0.0)
+        return (
+            self.mass * self._sums["momentum"],
+            self.mass * mean,
+            self.mass * math.sqrt(variance),
+        )
+
+    def updateKineticEnergy(self) -> None:
+        self.kinetic_energy = 0.5 * self.mass * self._sums["energy"]
+
+    def updatetemperature(self) -> None:
+        total_weight = self._sums["weight"]
+        mean_vel = self._sums["momentum"] / total_weight
+        self.temperature = (
+            2.0
+            * self.mass
+            * (self.kinetic_energy - 0.5 * total_weight * mean_vel * mean_vel)
+            / total_weight
+        )
@@ -0,0 +1,209 @@
+import argparse
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import cache
+import chargeexchange as CX
+
+# Parameters of a single run. A sweep overrides any of them with a list of
+# values and runs every combination; the defaults match test_CX_function.
+DEFAULTS = {
+    "CXrate": 5e-14,
+    "dt_SI": 1e-8,
+    "density": 3.3e18,
+    "temperature": 1.0,
+    "number_of_macroparticles": 2000,
+    "number_of_timesteps": 3200,
+    "fluid_velocity": 1.5,
+    "neutral_density": 3.3e18,
+    "neutral_velocity": 1.5,
+    "neutral_temperature": 1.0,
+    "mass": 1.0,
+    "Volume": 2.0,
+    "pairing": "sorted",
+    "integrator": "euler",
+    "interval": 1,
+}
+
+# Recorder diagnostics and Diagnostics metrics gathered for every run
+SERIES = CX.Recorder.diagnostics + (
+    "momentum_drift",
+    "energy_drift",
+    "energy_error",
+    "temperature_combined",
+    "temperature_separate",
+)
+
+
+def expand_grid(**axes) -> list:
+    # Every combination of the given parameter values, filled in from DEFAULTS
+    for name in axes:
+        if name not in DEFAULTS:
+            raise ValueError("Unknown sweep parameter " + str(name))
+    names = list(axes)
+    return [
+        dict(DEFAULTS, **dict(zip(names, values)))
+        for values in itertools.product(*(axes[name] for name in names))
+    ]
+
+
+def run_point(
+    point: dict, seed_sequence: np.random.SeedSequence, cache_directory=None
+) -> dict:
+    # Runs one grid point. Its seed sequence is split into one stream for the
+    # initial neutral velocities and one for the ion samples, so the result
+    # depends only on the point and its seed, not on which worker ran it.
+    # With a cache_directory a point already run with the same parameters,
+    # seed and code is loaded from the ResultCache instead of being rerun.
+    if cache_directory is not None:
+        results = cache.ResultCache(cache_directory)
+        key = results.key(
+            {
+                "point": point,
+                "entropy": seed_sequence.entropy,
+                "spawn_key": seed_sequence.spawn_key,
+            },
+            sources=(CX.__file__, __file__),
+        )
+        result = results.get(key)
+        if result is not None:
+            return result
+        result = run_point(point, seed_sequence)
+        results.put(key, result)
+        return result
+
+    neutral_seed, ion_seed = seed_sequence.spawn(2)
+    number_of_macroparticles = point["number_of_macroparticles"]
+    mass = point["mass"]
+    Volume = point["Volume"]
+    IC = CX.InitialConditions(
+        point["density"],
+        point["fluid_velocity"] * point["density"],
+        np.full(
+            number_of_macroparticles,
+            point["neutral_density"] * Volume / float(number_of_macroparticles),
+        ),
+        np.random.Generator(np.random.PCG64(neutral_seed)).normal(
+            point["neutral_velocity"],
+            (point["neutral_temperature"] / mass) ** 0.5,
+            number_of_macroparticles,
+        ),
+    )
+    ions = CX.IonFluid(
+        mass,
+        IC.fluid_density,
+        IC.fluid_momentum,
+        point["temperature"],
+        Volume,
+        sampler=CX.IonSampler(ion_seed),
+    )
+    neutrals = CX.Particles(
+        mass,
+        IC.weight,
+        IC.neutrals_velocity,
+        pairing=point["pairing"],
+        integrator=point["integrator"],
+    )
+    memory = CX.MemorySink()
+    CXrunner = CX.runner(
+        ions,
+        neutrals,
+        point["number_of_timesteps"],
+        point["dt_SI"],
+        point["CXrate"],
+        Volume,
+        recorder=CX.Recorder(point["interval"]),
+        diagnostics=CX.Diagnostics(
+            include_diagnostics=True, interval=point["interval"], sinks=[memory]
+        ),
+    )
+    start = time.perf_counter()
+    CXrunner.runCX()
+    result = {"seconds": time.perf_counter() - start}
+    for name in CX.Recorder.diagnostics:
+        result[name] = getattr(CXrunner.recorder, name)
+    # Metrics a mode does not report (the stochastic mode has no temperature
+    # variants) are filled with NaN
+    for name in SERIES[len(CX.Recorder.diagnostics) :]:
+        result[name] = np.array(
+            [record.get(name, np.nan) for record in memory.records], dtype=float
+        )
+    return result
+
+
+def _run_point(arguments) -> dict:
+    return run_point(*arguments)
+
+
+def run_sweep(
+    points: list, seed=None, workers: int = None, cache_directory=None
+) -> dict:
+    # Runs every point over a pool of `workers` processes (one per core by
+    # default, in this process for workers=1) and gathers the results into
+    # columns: one entry per point for each parameter and scalar result, and a
+    # (point x record) array for each time series, padded with NaN where runs
+    # recorded fewer rows. cache_directory enables the ResultCache per point.
+    seeds = np.random.SeedSequence(seed).spawn(len(points))
+    workers = os.cpu_count() if workers is None else workers
+    if workers == 1:
+        results = [
+            run_point(point, seed, cache_directory)
+            for point, seed in zip(points, seeds)
+        ]
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            results = list(
+                executor.map(
+                    _run_point,
+                    zip(points, seeds, itertools.repeat(cache_directory)),
+                )
+            )
+
+    columns = {name: np.array([point[name] for point in points]) for name in DEFAULTS}
+    columns["seconds"] = np.array([result["seconds"] for result in results])
+    columns["number_of_records"] = np.array([len(result["time"]) for result in results])
+    number_of_records = max(columns["number_of_records"])
+    for name in SERIES:
+        series = np.full((len(points), number_of_records), np.nan)
+        for row, result in zip(series, results):
+            row[: len(result[name])] = result[name]
+        columns[name] = series
+    columns["max_momentum_drift"] = np.nanmax(np.abs(columns["momentum_drift"]), axis=1)
+    columns["max_energy_error"] = np.nanmax(columns["energy_error"], axis=1)
+    return columns
+
+
+def save_sweep(path, columns: dict) -> None:
+    np.savez(path, **columns)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Charge exchange parameter sweep. Every parameter given a "
+        "list of values is swept and all combinations are run."
+    )
+    for name, default in DEFAULTS.items():
+        parser.add_argument(
+            "--" + name,
+            type=type(default),
+            nargs="+",
+            default=[default],
+            help="Values of " + name + " (default %(default)s)",
+        )
+    parser.add_argument("--seed", type=int, default=None, help="Root seed of the sweep")
+    parser.add_argument(
+        "--workers", type=int, default=None, help="Worker processes (default: cores)"
+    )
+    parser.add_argument("--output", default="sweep.npz", help="Columnar .npz output")
+    parser.add_argument(
+        "--cache", default=None, help="Directory of a result cache for the runs"
+    )
+    args = vars(parser.parse_args())
+    points = expand_grid(**{name: args[name] for name in DEFAULTS})
+    columns = run_sweep(points, args["seed"], args["workers"], args["cache"])
+    save_sweep(args["output"], columns)
+    print("%d runs written to %s" % (len(points), args["output"]))
+    print("largest momentum drift %.2e" % np.max(columns["max_momentum_drift"]))
@@ -1,5 +1,14 @@
 import numpy as np
+import cache
 import chargeexchange as CX
+import coupling
+import distributed
+import sweep
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
 
 class Testing(unittest.TestCase):
@@ -114,8 +123,16 @@ class Testing(unittest.TestCase):
         newIonFluid = CX.IonFluid(
             mass_ion, initial_fluid_density, initial_fluid_bulk_momentum_density,initial_fluid_temperature,volume
         )
-        #Setup runner class
-        CXrunner = CX.runner( newIonFluid, newPart, number_of_timesteps, dt_SI, CXrate,volume)
+        # Setup runner class, drawing the figures used by the report
+        CXrunner = CX.runner(
+            newIonFluid,
+            newPart,
+            number_of_timesteps,
+            dt_SI,
+            CXrate,
+            volume,
+            diagnostics=CX.Diagnostics(produce_plots=True, background_plots=False),
+        )
 
         momentum_particles_before = mass_neutral*np.sum(np.multiply(weight,initial_neutral_velocity))
         momentum_fluid_before = initial_fluid_bulk_momentum_density*volume
@@ -136,6 +153,1260 @@ class Testing(unittest.TestCase):
         1e-14, "Total Momentum not conserved for charge exchange"
         )
 
+    # This test checks that an ensemble step matches stepping each member on its own
+    def test_ensemble_applyCX(self):
+        print(
+            "\n Testing the ensemble charge exchange step against single realisations"
+        )
+        mass = 1.0
+        volume = 2.0
+        number_of_members = 3
+        number_of_macroparticles = 50
+        density = np.array([3.3e18, 2.0e18, 1.0e18])
+        momentum = 1.5 * density
+        temperature = np.array([1.0, 0.5, 2.0])
+        weight = np.full(
+            (number_of_members, number_of_macroparticles),
+            3.3e18 * volume / float(number_of_macroparticles),
+        )
+        vel = np.random.normal(0.0, 1.0, (number_of_members, number_of_macroparticles))
+        ionSingleMom = np.random.normal(
+            1.5, 1.0, (number_of_members, number_of_macroparticles)
+        )
+
+        ensembleFluid = CX.IonFluid(mass, density, momentum, temperature, volume)
+        ensemblePart = CX.Particles(mass, weight, vel)
+        ensemblePart.applyCX(5e-14, 1e-6, ensembleFluid, volume, ionSingleMom, 0)
+        ensemblePart.updateKineticEnergy()
+        ensemblePart.updatetemperature()
+
+        for member in range(number_of_members):
+            singleFluid = CX.IonFluid(
+                mass, density[member], momentum[member], temperature[member], volume
+            )
+            singlePart = CX.Particles(mass, weight[member], vel[member])
+            singlePart.applyCX(
+                5e-14, 1e-6, singleFluid, volume, ionSingleMom[member], 0
+            )
+            singlePart.updateKineticEnergy()
+            singlePart.updatetemperature()
+            np.testing.assert_allclose(ensemblePart.vel[member], singlePart.vel)
+            np.testing.assert_allclose(ensembleFluid.mom[member], singleFluid.mom)
+            np.testing.assert_allclose(
+                ensemblePart.temperature[member], singlePart.temperature
+            )
+
+    # This test checks that every member of an ensemble run conserves total momentum
+    def test_ensemble_runner(self):
+        print("\n Testing momentum conservation of an ensemble run")
+        mass = 1.0
+        volume = 2.0
+        number_of_members = 4
+        number_of_macroparticles = 500
+        density = np.full(number_of_members, 3.3e18)
+        momentum = 1.5 * density
+        vel = np.random.normal(1.5, 1.0, (number_of_members, number_of_macroparticles))
+        weight = np.full(
+            (number_of_members, number_of_macroparticles),
+            3.3e18 * volume / float(number_of_macroparticles),
+        )
+        newPart = CX.Particles(mass, weight, vel)
+        newIonFluid = CX.IonFluid(mass, density, momentum, 1e-12, volume)
+        CXrunner = CX.runner(newIonFluid, newPart, 200, 1e-8, 5e-14, volume)
+
+        momentum_before = momentum * volume + mass * np.sum(weight * vel, axis=1)
+        CXrunner.runCX()
+        momentum_after = CXrunner.ions.mom * volume + mass * np.sum(
+            CXrunner.neutrals.weight * CXrunner.neutrals.vel, axis=1
+        )
+
+        self.assertEqual(CXrunner.neutrals.vel.shape, vel.shape)
+        self.assertTrue(
+            np.all(
+                abs(momentum_after - momentum_before) / abs(momentum_before) < 1e-14
+            ),
+            "Total Momentum not conserved for ensemble charge exchange",
+        )
+
+    # This test checks the decimated recorder against the full velocity snapshots
+    def test_Recorder_class(self):
+        print("\n Testing the Recorder class")
+        mass = 1.0
+        volume = 2.0
+        number_of_macroparticles = 300
+        vel = np.random.normal(1.5, 1.0, number_of_macroparticles)
+        weight = np.full(number_of_macroparticles, 3.3e18 * volume / 300.0)
+        newPart = CX.Particles(mass, weight, vel)
+        newIonFluid = CX.IonFluid(mass, 3.3e18, 0.5 * 3.3e18, 1.0, volume)
+
+        with tempfile.TemporaryDirectory() as directory:
+            snapshot_path = os.path.join(directory, "snapshots.npy")
+            recorder = CX.Recorder(
+                interval=10, snapshot_path=snapshot_path, chunk_size=64
+            )
+            CXrunner = CX.runner(
+                newIonFluid, newPart, 95, 1e-7, 5e-14, volume, recorder=recorder
+            )
+            CXrunner.runCX()
+
+            self.assertEqual(recorder.number_of_records, 10)
+            np.testing.assert_allclose(recorder.time, np.arange(10) * 1e-6)
+            snapshots = np.load(snapshot_path, mmap_mode="r")
+            self.assertEqual(snapshots.shape, (10, number_of_macroparticles))
+            np.testing.assert_allclose(recorder.mean, mass * np.mean(snapshots, axis=1))
+            np.testing.assert_allclose(recorder.std, mass * np.std(snapshots, axis=1))
+            np.testing.assert_allclose(
+                recorder.bulk_momentum, mass * snapshots @ weight, rtol=1e-13
+            )
+            del snapshots
+
+    # This test checks that every pairing strategy conserves total momentum
+    def test_pairing_strategies(self):
+        print("\n Testing momentum conservation of the pairing strategies")
+        mass = 1.0
+        volume = 2.0
+        number_of_macroparticles = 1000
+        initial_fluid_bulk_momentum_density = 1.5 * 3.3e18
+        for name in CX.PAIRING_STRATEGIES:
+            vel = np.random.normal(0.5, 1.0, number_of_macroparticles)
+            weight = np.random.uniform(0.5, 1.5, number_of_macroparticles) * 3.3e15
+            newPart = CX.Particles(mass, weight, vel, pairing=name)
+            newIonFluid = CX.IonFluid(
+                mass, 3.3e18, initial_fluid_bulk_momentum_density, 1.0, volume
+            )
+            CXrunner = CX.runner(newIonFluid, newPart, 300, 1e-8, 5e-14, volume)
+
+            momentum_before = (
+                initial_fluid_bulk_momentum_density * volume
+                + mass * np.sum(weight * vel)
+            )
+            CXrunner.runCX()
+            momentum_after = CXrunner.ions.mom * volume + mass * np.sum(
+                CXrunner.neutrals.weight * CXrunner.neutrals.vel
+            )
+            self.assertLess(
+                abs(momentum_after - momentum_before) / abs(momentum_before),
+                1e-14,
+                "Total Momentum not conserved with " + name + " pairing",
+            )
+            if name in ("maintained", "quantile"):
+                self.assertTrue(np.all(np.diff(CXrunner.neutrals.vel) >= 0.0))
+
+    # This test checks the ordered quantile sampling of the ion fluid
+    def test_getQuantileMom(self):
+        print("\n Testing the ordered quantile sampling of ion momenta")
+        newIonFluid = CX.IonFluid(2.0, 3.3e18, 0.8 * 3.3e18, 1.5, 1.0)
+        samples = newIonFluid.getQuantileMom(4096)
+        self.assertTrue(np.all(np.diff(samples) > 0.0))
+        self.assertAlmostEqual(np.mean(samples), 2.0 * 0.8 / 2.0, places=12)
+        self.assertAlmostEqual(np.std(samples), 2.0 * (1.5 / 2.0) ** 0.5, places=12)
+
+    # This test checks reproducibility and the moments of the IonSampler class
+    def test_IonSampler_class(self):
+        print("\n Testing the IonSampler class")
+        mass = 2.0
+        temperature = 1.5
+        bulk_velocity = 0.8
+
+        def samples(sampler, number_of_timesteps):
+            newIonFluid = CX.IonFluid(
+                mass, 3.3e18, mass * bulk_velocity * 3.3e18, temperature, 1.0, sampler
+            )
+            return np.array(
+                [newIonFluid.getRandomMom(1001) for i in range(number_of_timesteps)]
+            )
+
+        # Same seed reproduces the samples and batching does not change them
+        np.testing.assert_array_equal(
+            samples(CX.IonSampler(42, batch_size=1), 5),
+            samples(CX.IonSampler(42, batch_size=4), 5),
+        )
+        first, second = CX.IonSampler(42).spawn(2)
+        self.assertFalse(np.allclose(samples(first, 1), samples(second, 1)))
+
+        for method in CX.IonSampler.methods:
+            b = samples(CX.IonSampler(7, batch_size=3, method=method), 4)
+            self.assertEqual(b.shape, (4, 1001))
+            np.testing.assert_allclose(
+                np.mean(b, axis=1), mass * bulk_velocity, rtol=1e-12
+            )
+            np.testing.assert_allclose(
+                np.std(b, axis=1), mass * (temperature / mass) ** 0.5, rtol=1e-12
+            )
+
+        # Sobol batches of large ensembles exceed scipy's dimension limit
+        newIonFluid = CX.IonFluid(
+            mass,
+            3.3e18,
+            np.full(400, mass * bulk_velocity * 3.3e18),
+            temperature,
+            1.0,
+            CX.IonSampler(7, method="sobol"),
+        )
+        b = newIonFluid.getRandomMom(16)
+        self.assertEqual(b.shape, (400, 16))
+        np.testing.assert_allclose(np.mean(b, axis=1), mass * bulk_velocity, rtol=1e-12)
+
+    # This test checks adaptive timestepping, including growth of the recorder
+    def test_TimestepController_class(self):
+        print("\n Testing the adaptive timestep controller")
+        mass = 1.0
+        volume = 2.0
+        number_of_macroparticles = 500
+        initial_fluid_bulk_momentum_density = 0.5 * 3.3e18
+        vel = np.random.normal(1.5, 1.0, number_of_macroparticles)
+        weight = np.full(number_of_macroparticles, 3.3e18 * volume / 500.0)
+        newPart = CX.Particles(mass, weight, vel)
+        newIonFluid = CX.IonFluid(
+            mass, 3.3e18, initial_fluid_bulk_momentum_density, 1e-12, volume
+        )
+        momentum_before = initial_fluid_bulk_momentum_density * volume + mass * np.sum(
+            weight * vel
+        )
+
+        with tempfile.TemporaryDirectory() as directory:
+            snapshot_path = os.path.join(directory, "snapshots.npy")
+            recorder = CX.Recorder(snapshot_path=snapshot_path, snapshot_interval=3)
+            # Two nominal steps of 1e-6 force the controller to take many more
+            # smaller steps than the recorder was initially sized for
+            controller = CX.TimestepController(1e-3)
+            CXrunner = CX.runner(
+                newIonFluid,
+                newPart,
+                2,
+                1e-6,
+                5e-14,
+                volume,
+                recorder=recorder,
+                controller=controller,
+            )
+            CXrunner.runCX()
+
+            number_of_records = recorder.number_of_records
+            self.assertGreater(number_of_records, 2)
+            self.assertTrue(np.all(np.diff(recorder.time) > 0.0))
+            self.assertLess(recorder.time[-1], 2e-6)
+            snapshots = np.load(snapshot_path, mmap_mode="r")
+            self.assertEqual(
+                snapshots.shape, (-(-number_of_records // 3), number_of_macroparticles)
+            )
+            np.testing.assert_allclose(
+                recorder.mean[::3], mass * np.mean(snapshots, axis=1)
+            )
+            del snapshots
+
+        momentum_after = CXrunner.ions.mom * volume + mass * np.sum(
+            CXrunner.neutrals.weight * CXrunner.neutrals.vel
+        )
+        self.assertLess(
+            abs(momentum_after - momentum_before) / abs(momentum_before),
+            1e-14,
+            "Total Momentum not conserved with adaptive timesteps",
+        )
+        # Near equilibrium a first-order step is bounded by the tolerance, and
+        # it shrinks with the energy moved over the step
+        controller = CX.TimestepController(1e-6)
+        self.assertAlmostEqual(controller.next_dt(1.0, 0.0, 1.0, 0.0), 2e-6**0.5)
+        self.assertEqual(controller.next_dt(1.0, 0.0, 1.0), 0.05)
+        self.assertLess(
+            controller.next_dt(1e-3, 0.0, 1.0, 1e-2),
+            controller.next_dt(1e-3, 0.0, 1.0, 1e-3),
+        )
+
+    # This test checks the exponential integrator with steps far beyond the
+    # explicit stability limit against the analytic bulk velocity relaxation
+    def test_exponential_integrator(self):
+        print("\n Testing the exponential charge exchange integrator")
+        mass = 1.0
+        volume = 2.0
+        number_of_macroparticles = 1000
+        ion_density = 3.3e18
+        neutral_density = 1.0e18
+        CXrate = 5e-14
+        dt = 1e-5  # dt*rate*n_ions = 1.65
+        vel = np.random.normal(1.5, 1.0, number_of_macroparticles)
+        weight = np.full(number_of_macroparticles, neutral_density * volume / 1000.0)
+        newPart = CX.Particles(
+            mass,
+            weight,
+            vel,
+            pairing=CX.QuantilePairing(jitter=False),
+            integrator="exponential",
+        )
+        newIonFluid = CX.IonFluid(mass, ion_density, 0.2 * ion_density, 0.5, volume)
+        momentum_before = 0.2 * ion_density * volume + mass * np.sum(weight * vel)
+        gap_before = np.mean(vel) - 0.2
+        total_energy = newIonFluid.kinetic_energy + newPart.kinetic_energy
+
+        for i in range(5):
+            ionSingleMom = newPart.sampleIonMom(newIonFluid)
+            newPart.applyCX(CXrate, dt, newIonFluid, volume, ionSingleMom, i)
+            newPart.updateKineticEnergy()
+            newPart.updatetemperature()
+            newIonFluid.updatetemperature(total_energy, newPart.kinetic_energy)
+            newIonFluid.updateKineticEnergy()
+            gap = np.mean(newPart.vel) - newIonFluid.mom / ion_density
+            expected = gap_before * np.exp(
+                -CXrate * (ion_density + neutral_density) * dt * (i + 1)
+            )
+            self.assertAlmostEqual(gap, expected, delta=1e-12)
+            self.assertGreater(newIonFluid.temperature, 0.0)
+
+        momentum_after = newIonFluid.mom * volume + mass * np.sum(
+            newPart.weight * newPart.vel
+        )
+        self.assertLess(
+            abs(momentum_after - momentum_before) / abs(momentum_before),
+            1e-14,
+            "Total Momentum not conserved with the exponential integrator",
+        )
+
+    # This test checks the split/merge engine conserves weight, momentum and energy
+    def test_SplitMergeEngine_class(self):
+        print("\n Testing the SplitMergeEngine class")
+        weight = np.random.uniform(0.5, 1.5, 5000) * 1e15
+        vel = np.random.normal(1.0, 1.0, 5000)
+        merged_weight, merged_vel = CX.SplitMergeEngine(1000).merge(weight, vel)
+        self.assertLessEqual(len(merged_vel), 1000)
+        self.assertTrue(np.all(np.diff(merged_vel) >= 0.0))
+        for power in range(3):
+            before = np.sum(weight * vel**power)
+            after = np.sum(merged_weight * merged_vel**power)
+            self.assertLess(abs(after - before) / abs(before), 1e-13)
+
+        # A charge exchange step in separate mode keeps the separate mode energy
+        mass = 1.0
+        volume = 2.0
+        CXrate = 5e-14
+        dt = 1e-6
+        weight = np.full(1000, 3.3e18 * volume / 1000.0)
+        vel = np.random.normal(1.5, 1.0, 1000)
+        newPart = CX.Particles(
+            mass, weight, vel, merger=CX.SplitMergeEngine(1200)
+        )
+        newIonFluid = CX.IonFluid(mass, 3.3e18, 0.5 * 3.3e18, 1.0, volume)
+        momentum_before = 0.5 * 3.3e18 * volume + mass * np.sum(weight * vel)
+        ionSingleMom = newPart.sampleIonMom(newIonFluid)
+        vel_sorted = np.sort(vel)
+        ion_sorted = np.sort(ionSingleMom)
+        fraction = dt * CXrate * 3.3e18
+        energy_separate = (
+            0.5
+            * mass
+            * np.sum(
+                weight * ((1.0 - fraction) * vel_sorted**2 + fraction * ion_sorted**2)
+            )
+        )
+        newPart.applyCX(CXrate, dt, newIonFluid, volume, ionSingleMom, 0)
+        newPart.updateKineticEnergy()
+
+        self.assertLessEqual(len(newPart.vel), 1200)
+        self.assertEqual(len(newPart.vel), len(newPart.weight))
+        self.assertLess(
+            abs(newPart.kinetic_energy - energy_separate) / energy_separate, 1e-13
+        )
+        self.assertLess(
+            abs(np.sum(newPart.weight) - np.sum(weight)) / np.sum(weight), 1e-14
+        )
+        momentum_after = newIonFluid.mom * volume + mass * np.sum(
+            newPart.weight * newPart.vel
+        )
+        self.assertLess(
+            abs(momentum_after - momentum_before) / abs(momentum_before),
+            1e-14,
+            "Total Momentum not conserved by the split/merge engine",
+        )
+        with self.assertRaises(ValueError):
+            CX.Particles(
+                mass,
+                weight,
+                vel,
+                integrator="exponential",
+                merger=CX.SplitMergeEngine(1200),
+            )
+
+    # This test checks the multi-cell kernel against single cell charge exchange
+    def test_spatial_applyCX(self):
+        print("\n Testing the multi-cell charge exchange kernel")
+        mass = 1.0
+        number_of_cells = 4  # The last cell holds no macroparticles
+        number_of_macroparticles = 600
+        volume = np.array([1.0, 2.0, 0.5, 1.0])
+        density = np.array([3.3e18, 1.0e18, 2.0e18, 1.0e18])
+        momentum = np.array([0.5, 1.0, -0.5, 0.0]) * density
+        temperature = np.array([1.0, 0.5, 2.0, 1.0])
+        cell = np.random.randint(0, 3, number_of_macroparticles)
+        vel = np.random.normal(1.0, 1.0, number_of_macroparticles)
+        weight = np.random.uniform(0.5, 1.5, number_of_macroparticles) * 1e16
+
+        for integrator in ("euler", "exponential"):
+            spatialFluid = CX.SpatialIonFluid(
+                mass, density, momentum, temperature, volume
+            )
+            spatialPart = CX.SpatialParticles(
+                mass, weight, vel, cell, number_of_cells, integrator
+            )
+            ionSingleMom = spatialPart.sampleIonMom(spatialFluid)
+            spatialPart.applyCX(5e-14, 1e-6, spatialFluid, volume, ionSingleMom, 0)
+            spatialPart.updateKineticEnergy()
+            spatialPart.updatetemperature()
+            self.assertEqual(spatialFluid.mom[3], momentum[3])
+
+            for c in range(3):
+                inside = cell == c
+                singleFluid = CX.IonFluid(
+                    mass, density[c], momentum[c], temperature[c], volume[c]
+                )
+                singlePart = CX.Particles(
+                    mass, weight[inside], vel[inside], "random", integrator
+                )
+                singlePart.applyCX(
+                    5e-14, 1e-6, singleFluid, volume[c], ionSingleMom[inside], 0
+                )
+                singlePart.updateKineticEnergy()
+                singlePart.updatetemperature()
+                np.testing.assert_allclose(spatialPart.vel[inside], singlePart.vel)
+                np.testing.assert_allclose(spatialFluid.mom[c], singleFluid.mom)
+                np.testing.assert_allclose(
+                    spatialPart.kinetic_energy[c], singlePart.kinetic_energy
+                )
+                np.testing.assert_allclose(
+                    spatialPart.temperature[c], singlePart.temperature
+                )
+
+    # This test checks momentum conservation of a multi-cell run
+    def test_spatial_runner(self):
+        print("\n Testing momentum conservation of a multi-cell run")
+        mass = 1.0
+        number_of_cells = 50
+        number_of_macroparticles = 5000
+        volume = 0.1
+        density = np.random.uniform(1.0e18, 3.3e18, number_of_cells)
+        momentum = np.random.normal(0.0, 1.0, number_of_cells) * density
+        cell = np.random.randint(0, number_of_cells, number_of_macroparticles)
+        vel = np.random.normal(1.5, 1.0, number_of_macroparticles)
+        weight = np.full(number_of_macroparticles, 3.3e18 * 5.0 / 5000.0)
+        newPart = CX.SpatialParticles(mass, weight, vel, cell, number_of_cells)
+        newIonFluid = CX.SpatialIonFluid(mass, density, momentum, 1.0, volume)
+        CXrunner = CX.runner(newIonFluid, newPart, 100, 1e-8, 5e-14, volume)
+
+        momentum_before = np.sum(momentum) * volume + mass * np.sum(weight * vel)
+        CXrunner.runCX()
+        momentum_after = np.sum(CXrunner.ions.mom) * volume + mass * np.sum(
+            CXrunner.neutrals.weight * CXrunner.neutrals.vel
+        )
+        self.assertEqual(CXrunner.recorder.bulk_momentum.shape, (100, number_of_cells))
+        self.assertLess(
+            abs(momentum_after - momentum_before) / abs(momentum_before),
+            1e-14,
+            "Total Momentum not conserved for the multi-cell run",
+        )
+
+    # This test checks float32 storage conserves momentum measured in float64
+    def test_float32_storage(self):
+        print("\n Testing momentum conservation with float32 particle storage")
+        mass = 1.0
+        volume = 2.0
+        number_of_macroparticles = 2000
+        density = 3.3e18
+        vel = np.random.normal(1.5, 1.0, number_of_macroparticles)
+        weight = np.full(number_of_macroparticles, density * volume / 2000.0)
+        newPart = CX.Particles(mass, weight, vel, dtype=np.float32)
+        newIonFluid = CX.IonFluid(mass, density, 1.5 * density, 1e-12, volume)
+        CXrunner = CX.runner(newIonFluid, newPart, 3200, 1e-8, 5e-14, volume)
+
+        def momentum(fluid, particles):
+            return fluid.mom * volume + mass * np.sum(
+                np.multiply(particles.weight, particles.vel, dtype=np.float64)
+            )
+
+        momentum_before = momentum(newIonFluid, newPart)
+        CXrunner.runCX()
+        self.assertEqual(CXrunner.neutrals.vel.dtype, np.float32)
+        self.assertEqual(CXrunner.neutrals.weight.dtype, np.float32)
+        self.assertLess(
+            abs(momentum(CXrunner.ions, CXrunner.neutrals) - momentum_before)
+            / abs(momentum_before),
+            1e-14,
+            "Total Momentum not conserved with float32 storage",
+        )
+        # The kinetic energy is accumulated from float64 products
+        neutrals = CXrunner.neutrals
+        neutrals.updateKineticEnergy()
+        vel = neutrals.vel.astype(np.float64)
+        self.assertAlmostEqual(
+            neutrals.kinetic_energy
+            / (0.5 * mass * np.sum(neutrals.weight.astype(np.float64) * vel * vel)),
+            1.0,
+            places=15,
+        )
+
+    # This test checks the instrumentation records and sinks of a run
+    def test_Diagnostics_class(self):
+        print("\n Testing the Diagnostics instrumentation")
+        mass = 1.0
+        volume = 2.0
+        density = 3.3e18
+        vel = np.random.normal(1.5, 1.0, 1000)
+        weight = np.full(1000, density * volume / 1000.0)
+        callback_records = []
+        memory = CX.MemorySink()
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, "diagnostics.csv")
+            npz_path = os.path.join(directory, "diagnostics.npz")
+            diagnostics = CX.Diagnostics(
+                True,
+                True,
+                False,
+                interval=10,
+                sinks=[
+                    memory,
+                    CX.CSVSink(csv_path),
+                    CX.NPZSink(npz_path),
+                    CX.CallbackSink(callback_records.append),
+                ],
+            )
+            newPart = CX.Particles(mass, weight, vel)
+            newIonFluid = CX.IonFluid(mass, density, 0.5 * density, 1.0, volume)
+            CXrunner = CX.runner(
+                newIonFluid, newPart, 100, 1e-8, 5e-14, volume, diagnostics=diagnostics
+            )
+            CXrunner.runCX()
+
+            with open(csv_path) as csv_file:
+                lines = csv_file.read().splitlines()
+            self.assertEqual(len(lines), 11)
+            self.assertEqual(lines[0].split(","), list(memory.records[0]))
+            columns = np.load(npz_path)
+            np.testing.assert_array_equal(columns["step"], np.arange(0, 100, 10))
+            np.testing.assert_allclose(
+                columns["temperature_separate"], memory.column("temperature_separate")
+            )
+
+        self.assertEqual(len(callback_records), 10)
+        self.assertLess(np.max(np.abs(memory.column("momentum_drift"))), 1e-14)
+        self.assertTrue(np.all(memory.column("temperature_combined") > 0.0))
+        for phase in CX.Diagnostics.phases:
+            self.assertTrue(np.all(memory.column("time_" + phase) >= 0.0))
+        self.assertIsNone(newPart.timer)
+
+    # This test checks plots are rendered lazily from saved run results
+    def test_render_plots(self):
+        print("\n Testing rendering of plots from saved run results")
+        figures = (
+            "Momentum_Numerical_Bulk.png",
+            "momentum_conservation.png",
+            "Momentum_Numerical_Single.png",
+            "Momentum_Numerical_Slope.png",
+            "Energy.png",
+            "Temperature.png",
+        )
+        imported = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys, chargeexchange; print(sorted(sys.modules))",
+            ],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(CX.__file__)),
+        )
+        self.assertNotIn("matplotlib", imported.stdout)
+
+        mass = 1.0
+        volume = 2.0
+        density = 3.3e18
+        vel = np.random.normal(1.5, 1.0, 1000)
+        weight = np.full(1000, density * volume / 1000.0)
+        for background_plots in (False, True):
+            with tempfile.TemporaryDirectory() as directory:
+                diagnostics = CX.Diagnostics(
+                    produce_plots=True,
+                    plot_directory=directory,
+                    background_plots=background_plots,
+                )
+                newPart = CX.Particles(mass, weight, vel)
+                newIonFluid = CX.IonFluid(mass, density, 0.5 * density, 1.0, volume)
+                CXrunner = CX.runner(
+                    newIonFluid,
+                    newPart,
+                    2000,
+                    1e-8,
+                    5e-14,
+                    volume,
+                    diagnostics=diagnostics,
+                )
+                CXrunner.runCX()
+                if background_plots:
+                    self.assertEqual(CXrunner.render_process.wait(), 0)
+                else:
+                    self.assertIsNone(CXrunner.render_process)
+                for figure in figures:
+                    self.assertTrue(os.path.exists(os.path.join(directory, figure)))
+
+        # 2000 records are decimated to about two per pixel column
+        plot = CX.Plotting.from_recorder(CXrunner.recorder, volume)
+        decimation = plot._decimation(CX._pyplot())
+        self.assertLess(len(plot.time[decimation]), 2000)
+        self.assertEqual(decimation.step, 2)
+
+    # This test checks a parameter sweep is independent of the number of workers
+    def test_sweep(self):
+        print("\n Testing the process pool parameter sweep")
+        points = sweep.expand_grid(
+            CXrate=[5e-14, 1e-13],
+            number_of_macroparticles=[200, 400],
+            number_of_timesteps=[50],
+            interval=[5],
+        )
+        self.assertEqual(len(points), 4)
+        serial = sweep.run_sweep(points, seed=3, workers=1)
+        pooled = sweep.run_sweep(points, seed=3, workers=2)
+        for name in sweep.SERIES:
+            self.assertEqual(serial[name].shape, (4, 10))
+            np.testing.assert_array_equal(serial[name], pooled[name])
+        np.testing.assert_array_equal(serial["CXrate"], [5e-14, 5e-14, 1e-13, 1e-13])
+        self.assertLess(np.max(serial["max_momentum_drift"]), 1e-14)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "sweep.npz")
+            sweep.save_sweep(path, serial)
+            np.testing.assert_array_equal(np.load(path)["mean"], serial["mean"])
+        with self.assertRaises(ValueError):
+            sweep.expand_grid(rate=[1.0])
+        # The stochastic mode reports no temperature variants
+        stochastic = sweep.run_sweep(
+            sweep.expand_grid(
+                integrator=["stochastic"],
+                number_of_macroparticles=[200],
+                number_of_timesteps=[50],
+                interval=[5],
+            ),
+            seed=3,
+            workers=1,
+        )
+        self.assertEqual(stochastic["temperature_combined"].shape, (1, 10))
+        self.assertTrue(np.all(np.isnan(stochastic["temperature_separate"])))
+        self.assertTrue(np.all(np.isfinite(stochastic["mean"])))
+        self.assertLess(np.max(stochastic["max_momentum_drift"]), 1e-14)
+
+    # This test checks cached runs are reloaded, keyed by inputs and evicted LRU
+    def test_ResultCache_class(self):
+        print("\n Testing the content-addressed result cache")
+        mass = 1.0
+        volume = 2.0
+        density = 3.3e18
+        vel = np.random.normal(1.5, 1.0, 500)
+        weight = np.full(500, density * volume / 500.0)
+
+        def run(results, seed, number_of_timesteps=100):
+            newPart = CX.Particles(mass, weight, vel)
+            newIonFluid = CX.IonFluid(
+                mass, density, 0.5 * density, 1.0, volume, CX.IonSampler(seed)
+            )
+            return cache.run_cached(
+                results, newIonFluid, newPart, number_of_timesteps, 1e-8, 5e-14, volume
+            )
+
+        with tempfile.TemporaryDirectory() as directory:
+            results = cache.ResultCache(directory)
+            first = run(results, 1)
+            second = run(results, 1)
+            self.assertFalse(first.cache_hit)
+            self.assertTrue(second.cache_hit)
+            entry_size = results.size()
+            self.assertIsInstance(second.mean, np.memmap)
+            for name in CX.Recorder.diagnostics:
+                np.testing.assert_array_equal(
+                    getattr(first, name), getattr(second, name)
+                )
+            self.assertFalse(run(results, 2).cache_hit)
+            self.assertFalse(run(results, 1, 101).cache_hit)
+
+            # Only the most recently used entry fits in a smaller cache
+            results.max_bytes = entry_size + entry_size // 2
+            run(results, 1)
+            results.evict()
+            self.assertEqual(results.size(), entry_size)
+            self.assertTrue(run(results, 1).cache_hit)
+            self.assertFalse(run(results, 2).cache_hit)
+
+            # Unseeded runs drawing from the global RNG are keyed by its state
+            def unseeded():
+                return cache.run_cached(
+                    results,
+                    CX.IonFluid(mass, density, 0.5 * density, 1.0, volume),
+                    CX.Particles(mass, weight, vel),
+                    20,
+                    1e-8,
+                    5e-14,
+                    volume,
+                )
+
+            self.assertFalse(unseeded().cache_hit)
+            self.assertFalse(unseeded().cache_hit)
+
+            # Options of particle subclasses are part of the key
+            def key(**options):
+                return results.key(
+                    cache.run_inputs(
+                        CX.IonFluid(mass, density, 0.5 * density, 1.0, volume),
+                        CX.HybridParticles(mass, weight, vel, **options),
+                        20,
+                        1e-8,
+                        5e-14,
+                        volume,
+                    )
+                )
+
+            self.assertEqual(key(tolerance=0.05), key(tolerance=0.05))
+            self.assertNotEqual(key(tolerance=0.05), key(tolerance=0.1))
+            self.assertNotEqual(key(check_interval=10), key(check_interval=5))
+
+            # Sweep points are cached too
+            points = sweep.expand_grid(
+                number_of_macroparticles=[100], number_of_timesteps=[20]
+            )
+            sweep_directory = os.path.join(directory, "sweep")
+            rerun = sweep.run_sweep(points, 4, 1, sweep_directory)
+            cached = sweep.run_sweep(points, 4, 1, sweep_directory)
+            np.testing.assert_array_equal(rerun["mean"], cached["mean"])
+            np.testing.assert_array_equal(rerun["seconds"], cached["seconds"])
+
+    # This test checks a run restarted from a checkpoint matches an uninterrupted run
+    def test_Checkpointer_class(self):
+        print("\n Testing checkpoint and restart of a run")
+        mass = 1.0
+        volume = 2.0
+        density = 3.3e18
+        vel = np.random.normal(1.5, 1.0, 500)
+        weight = np.full(500, density * volume / 500.0)
+
+        class Interrupt(Exception):
+            pass
+
+        # Fixed steps with a seeded sampler, and adaptive steps drawing from the
+        # global numpy random state, each interrupted after the 3rd checkpoint
+        variants = (
+            (True, None, 50, 170),
+            (False, CX.TimestepController(1e-3), 10, 37),
+        )
+        for use_sampler, controller, interval, interrupt_step in variants:
+
+            def interrupt(record):
+                if record["step"] == interrupt_step:
+                    raise Interrupt()
+
+            def make_runner(**options):
+                np.random.seed(5)
+                sampler = CX.IonSampler(7, batch_size=16) if use_sampler else None
+                newPart = CX.Particles(
+                    mass, weight, vel, pairing=CX.QuantilePairing()
+                )
+                newIonFluid = CX.IonFluid(
+                    mass, density, 0.5 * density, 1.0, volume, sampler
+                )
+                return CX.runner(
+                    newIonFluid,
+                    newPart,
+                    300,
+                    1e-8,
+                    5e-14,
+                    volume,
+                    controller=controller,
+                    **options
+                )
+
+            reference = make_runner()
+            reference.runCX()
+            with tempfile.TemporaryDirectory() as directory:
+                checkpointer = CX.Checkpointer(directory, interval)
+                interrupted = make_runner(
+                    checkpointer=checkpointer,
+                    diagnostics=CX.Diagnostics(
+                        include_diagnostics=True, sinks=[CX.CallbackSink(interrupt)]
+                    ),
+                )
+                with self.assertRaises(Interrupt):
+                    interrupted.runCX()
+                checkpointer.close()
+
+                restarted = make_runner(
+                    checkpointer=CX.Checkpointer(directory, interval)
+                )
+                np.random.seed(11)  # The checkpoint restores the global state
+                restarted.runCX(restart=True)
+
+            self.assertEqual(
+                restarted.number_of_steps_taken, reference.number_of_steps_taken
+            )
+            np.testing.assert_array_equal(
+                restarted.neutrals.vel, reference.neutrals.vel
+            )
+            self.assertEqual(restarted.ions.mom, reference.ions.mom)
+            self.assertEqual(restarted.ions.temperature, reference.ions.temperature)
+            for name in CX.Recorder.diagnostics:
+                np.testing.assert_array_equal(
+                    getattr(restarted.recorder, name), getattr(reference.recorder, name)
+                )
+
+    # This test checks the sparse stochastic mode conserves momentum and relaxes
+    # the bulk velocity at the charge exchange rate
+    def test_stochastic_mode(self):
+        print("\n Testing the sparse stochastic charge exchange mode")
+        mass = 1.0
+        volume = 2.0
+        number_of_members = 2
+        number_of_macroparticles = 100000
+        ion_density = 3.3e18
+        neutral_density = 1.0e18
+        CXrate = 5e-14
+        dt = 1e-8
+        weight = np.full(
+            (number_of_members, number_of_macroparticles),
+            neutral_density * volume / number_of_macroparticles,
+        )
+        vel = np.random.normal(1.5, 1.0, weight.shape)
+        newPart = CX.Particles(mass, weight, vel, integrator="stochastic")
+        newIonFluid = CX.IonFluid(
+            mass,
+            ion_density,
+            np.full(number_of_members, 0.2 * ion_density),
+            0.5,
+            volume,
+            CX.IonSampler(0),
+        )
+        self.assertIsNone(newPart.sampleIonMom(newIonFluid))
+        momentum_before = newIonFluid.mom * volume + mass * np.sum(weight * vel, axis=1)
+        gap_before = np.mean(vel, axis=1) - 0.2
+        CXrunner = CX.runner(
+            newIonFluid, newPart, 200, dt, CXrate, volume, recorder=CX.Recorder(200)
+        )
+        CXrunner.runCX()
+
+        momentum_after = newIonFluid.mom * volume + mass * np.sum(
+            newPart.weight * newPart.vel, axis=1
+        )
+        np.testing.assert_array_less(
+            np.abs(momentum_after - momentum_before) / np.abs(momentum_before), 1e-14
+        )
+        # Events follow the binomial mean and only the chosen particles change
+        self.assertLess(
+            np.max(np.abs(newPart.events / (number_of_macroparticles * 1.65e-3) - 1.0)),
+            0.5,
+        )
+        # The incrementally kept sums match a full recomputation
+        np.testing.assert_allclose(
+            newPart.kinetic_energy,
+            0.5 * mass * np.sum(newPart.weight * newPart.vel**2, axis=1),
+            rtol=1e-12,
+        )
+        gap = np.mean(newPart.vel, axis=1) - newIonFluid.mom / ion_density
+        expected = gap_before * np.exp(
+            -CXrate * (ion_density + neutral_density) * dt * 200
+        )
+        np.testing.assert_allclose(gap, expected, rtol=0.05)
+
+        with self.assertRaises(ValueError):
+            CX.SpatialParticles(
+                mass, weight[0], vel[0], np.zeros(100000, int), 1, "stochastic"
+            )
+
+    # This test checks tabulated rates against their functions and that cached
+    # rate coefficients are re-evaluated only as the fluid temperature drifts
+    def test_rate_tables(self):
+        print("\n Testing tabulated, cached rate coefficients")
+        temperatures = np.geomspace(0.1, 100.0, 40)
+        speeds = np.linspace(0.0, 10.0, 30)
+        power_law = CX.RateTable.from_function(
+            lambda T: 5e-14 * T**0.3, temperatures
+        )
+        # Lookups are accurate to the resampled grid and clamped at its edges
+        np.testing.assert_allclose(
+            power_law.evaluate([0.5, 3.7, 1000.0]),
+            5e-14 * np.array([0.5, 3.7, 100.0]) ** 0.3,
+            rtol=1e-4,
+        )
+        table = CX.RateTable.from_function(
+            lambda T, s: 5e-14 * T**0.3 * (1.0 + 0.1 * s), temperatures, speeds
+        )
+        self.assertTrue(table.speed_dependent)
+        np.testing.assert_allclose(
+            table.evaluate([0.5, 3.7], [1.2, 6.3]),
+            5e-14 * np.array([0.5, 3.7]) ** 0.3 * (1.0 + 0.1 * np.array([1.2, 6.3])),
+            rtol=1e-3,
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "rates.npz")
+            table.save(path)
+            np.testing.assert_array_equal(CX.RateTable.load(path).grid, table.grid)
+
+        mass = 1.0
+        volume = 2.0
+        density = 3.3e18
+        number_of_macroparticles = 2000
+
+        def run(rate, members=(2,), integrator="euler", steps=400):
+            vel = np.random.default_rng(1).normal(
+                1.5, 1.0, members + (number_of_macroparticles,)
+            )
+            weight = np.full(vel.shape, density * volume / number_of_macroparticles)
+            ions = CX.IonFluid(
+                mass,
+                density,
+                np.full(members, 0.2 * density),
+                1.0,
+                volume,
+                CX.IonSampler(0),
+            )
+            neutrals = CX.Particles(mass, weight, vel, integrator=integrator)
+            momentum_before = ions.mom * volume + mass * np.sum(weight * vel, axis=-1)
+            CX.runner(
+                ions, neutrals, steps, 1e-8, rate, volume, recorder=CX.Recorder(steps)
+            ).runCX()
+            momentum_after = ions.mom * volume + mass * np.sum(
+                neutrals.weight * neutrals.vel, axis=-1
+            )
+            np.testing.assert_array_less(
+                np.abs(momentum_after - momentum_before) / np.abs(momentum_before),
+                1e-14,
+            )
+            return neutrals
+
+        # A flat table reproduces the constant rate, evaluated only when the
+        # temperature has moved by more than the tolerance
+        flat = CX.RateCoefficients(
+            CX.RateTable(temperatures, np.full(40, 5e-14)), temperature_tolerance=0.05
+        )
+        np.testing.assert_allclose(run(flat).vel, run(5e-14).vel, rtol=1e-10)
+        self.assertGreater(flat.number_of_evaluations, 1)
+        self.assertLess(flat.number_of_evaluations, 20)
+
+        rates = CX.RateCoefficients(table)
+        for integrator in ("euler", "exponential"):
+            run(rates, integrator=integrator)
+        self.assertEqual(np.shape(rates.cached), (2, table.resolution))
+        run(rates, members=())
+        self.assertEqual(np.shape(rates.cached), (table.resolution,))
+        with self.assertRaises(ValueError):
+            run(rates, integrator="stochastic")
+        # A single fluid whose temperature drifts re-evaluates a
+        # temperature-only table, with every integrator
+        for integrator in CX.INTEGRATORS:
+            scalar = CX.RateCoefficients(power_law)
+            run(scalar, members=(), integrator=integrator)
+            self.assertGreater(scalar.number_of_evaluations, 1)
+            self.assertEqual(
+                np.ndim(
+                    scalar.evaluate(CX.IonFluid(mass, density, 0.0, 2.0, volume), None)
+                ),
+                0,
+            )
+
+    # This test checks ionisation and recombination operator-split with charge
+    # exchange conserve particles and momentum
+    def test_operator_splitting(self):
+        print("\n Testing ionisation and recombination operator-split with CX")
+        mass = 1.0
+        volume = 2.0
+        ion_density = 3.3e18
+        number_of_macroparticles = 2000
+
+        def setup(members=(2,), merger=None):
+            vel = np.random.default_rng(2).normal(
+                1.5, 1.0, members + (number_of_macroparticles,)
+            )
+            weight = np.full(vel.shape, 1e18 * volume / number_of_macroparticles)
+            ions = CX.IonFluid(
+                mass,
+                ion_density,
+                np.full(members, 0.2 * ion_density),
+                1.0,
+                volume,
+                CX.IonSampler(0),
+            )
+            return ions, CX.Particles(mass, weight, vel, merger=merger)
+
+        def totals(ions, neutrals):
+            return (
+                ions.density * volume
+                + np.sum(neutrals.weight * np.ones_like(neutrals.vel), axis=-1),
+                ions.mom * volume
+                + mass * np.sum(neutrals.weight * neutrals.vel, axis=-1),
+            )
+
+        for scheme, merger, members in (
+            ("lie", None, (2,)),
+            ("strang", None, (2,)),
+            ("strang", CX.SplitMergeEngine(3000), ()),
+        ):
+            ions, neutrals = setup(members, merger)
+            particles_before, momentum_before = totals(ions, neutrals)
+            CX.runner(
+                ions,
+                neutrals,
+                200,
+                1e-8,
+                5e-14,
+                volume,
+                recorder=CX.Recorder(200),
+                processes=[("ionisation", 2e-14), CX.Recombination(1e-14)],
+                splitting=scheme,
+            ).runCX()
+            particles_after, momentum_after = totals(ions, neutrals)
+            np.testing.assert_array_less(
+                np.abs(particles_after - particles_before) / particles_before, 1e-13
+            )
+            np.testing.assert_array_less(
+                np.abs(momentum_after - momentum_before) / np.abs(momentum_before),
+                1e-14,
+            )
+            self.assertLessEqual(neutrals.vel.shape[-1], 3000)
+
+        # Ionisation alone depletes the neutrals logistically, as the ions it
+        # produces ionise further neutrals
+        ions, neutrals = setup(())
+        rate = 5e-14
+        CX.runner(
+            ions, neutrals, 400, 1e-8, 0.0, volume, processes=[("ionisation", rate)]
+        ).runCX()
+        total = (ion_density + 1e18) * volume
+        decay = np.exp(-rate * total / volume * 400 * 1e-8)
+        neutrals_expected = (
+            total * 1e18 * volume * decay / (total - 1e18 * volume * (1.0 - decay))
+        )
+        self.assertLess(abs(np.sum(neutrals.weight) / neutrals_expected - 1.0), 1e-3)
+
+        with self.assertRaises(ValueError):
+            CX.OperatorSplitting([("ionisation", rate)], scheme="yoshida")
+
+    # This test checks a run coupled to a fluid process through shared memory
+    # reproduces the runner
+    def test_shared_memory_coupling(self):
+        print("\n Testing coupling to a fluid process through shared memory")
+        mass = 1.0
+        volume = 2.0
+        number_of_macroparticles = 2000
+        number_of_timesteps = 100
+        members = (2,)
+
+        def neutrals():
+            vel = np.random.default_rng(1).normal(
+                1.5, 1.0, members + (number_of_macroparticles,)
+            )
+            weight = np.full(vel.shape, 3.3e18 * volume / number_of_macroparticles)
+            return CX.Particles(mass, weight, vel)
+
+        buffer = coupling.FluidBuffer(members)
+        buffer.density[...] = 3.3e18
+        buffer.mom[...] = [0.2 * 3.3e18, -0.5 * 3.3e18]
+        buffer.temperature[...] = 1.0
+        barrier = multiprocessing.Barrier(2)
+        fluid = multiprocessing.Process(
+            target=coupling.stand_in_fluid,
+            args=(buffer.name, members, mass, barrier, number_of_timesteps),
+        )
+        fluid.start()
+        try:
+            coupled = coupling.KineticCoupler(
+                buffer, neutrals(), 5e-14, volume, barrier, CX.IonSampler(0)
+            )
+            coupled.run(number_of_timesteps, 1e-8)
+            fluid.join()
+            self.assertEqual(fluid.exitcode, 0)
+            mom = np.array(buffer.mom)
+            temperature = np.array(buffer.temperature)
+            coupled.detach()
+        finally:
+            buffer.close()
+            buffer.unlink()
+
+        # The fluid process ends where a runner's own IonFluid does
+        ions = CX.IonFluid(
+            mass,
+            3.3e18,
+            np.array([0.2, -0.5]) * 3.3e18,
+            1.0,
+            volume,
+            CX.IonSampler(0),
+        )
+        reference = CX.runner(
+            ions, neutrals(), number_of_timesteps, 1e-8, 5e-14, volume
+        )
+        reference.runCX()
+        np.testing.assert_allclose(
+            coupled.neutrals.vel, reference.neutrals.vel, rtol=1e-12
+        )
+        np.testing.assert_allclose(mom, ions.mom, rtol=1e-12)
+        np.testing.assert_allclose(temperature, ions.temperature, rtol=1e-12)
+
+    # This test checks sharded particles conserve momentum and give the same
+    # results whatever the number of workers
+    def test_sharded_particles(self):
+        print("\n Testing deterministic sharding of the macroparticles")
+        mass = 1.0
+        volume = 2.0
+        number_of_macroparticles = 100000
+
+        def run(workers, integrator):
+            vel = np.random.default_rng(1).normal(1.5, 1.0, number_of_macroparticles)
+            weight = np.full(
+                number_of_macroparticles, 3.3e18 * volume / number_of_macroparticles
+            )
+            neutrals = distributed.ShardedParticles(
+                mass, weight, vel, integrator, workers, chunk_size=8192, seed=5
+            )
+            ions = CX.IonFluid(mass, 3.3e18, 0.2 * 3.3e18, 1.0, volume)
+            momentum_before = ions.mom * volume + mass * np.sum(weight * vel)
+            try:
+                CX.runner(
+                    ions, neutrals, 50, 1e-8, 5e-14, volume, recorder=CX.Recorder(10)
+                ).runCX()
+            finally:
+                neutrals.close()
+            momentum_after = ions.mom * volume + mass * np.sum(
+                neutrals.weight * neutrals.vel
+            )
+            self.assertLess(
+                abs(momentum_after - momentum_before) / abs(momentum_before),
+                1e-14,
+                "Total Momentum not conserved by the sharded particles",
+            )
+            self.assertAlmostEqual(
+                neutrals.kinetic_energy
+                / (0.5 * mass * np.sum(neutrals.weight * neutrals.vel**2)),
+                1.0,
+                places=12,
+            )
+            return neutrals.vel, ions.mom, ions.temperature
+
+        for integrator in ("euler", "exponential"):
+            serial = run(1, integrator)
+            # Any number of workers reproduces the serial run bit for bit
+            for workers in (2, 3):
+                sharded = run(workers, integrator)
+                np.testing.assert_array_equal(sharded[0], serial[0])
+                self.assertEqual(sharded[1:], serial[1:])
+
+        with self.assertRaises(ValueError):
+            distributed.ShardedParticles(mass, np.ones((2, 10)), np.ones((2, 10)))
+        # Processes that replace the particle arrays would detach the workers
+        neutrals = distributed.ShardedParticles(
+            mass, np.ones(100), np.ones(100), workers=1
+        )
+        ions = CX.IonFluid(mass, 3.3e18, 0.2 * 3.3e18, 1.0, volume)
+        try:
+            with self.assertRaises(ValueError):
+                CX.runner(
+                    ions,
+                    neutrals,
+                    5,
+                    1e-8,
+                    5e-14,
+                    volume,
+                    recorder=CX.Recorder(10),
+                    processes=[("ionisation", 5e-14)],
+                ).runCX()
+            with self.assertRaises(ValueError):
+                neutrals.vel = np.zeros(100)
+            neutrals.vel += 1.0
+        finally:
+            neutrals.close()
+
+    # This test checks the hybrid kinetic/moment model follows the kinetic run
+    # through its switches, checkpoints and resampling
+    def test_hybrid_model(self):
+        print("\n Testing the hybrid kinetic/moment model")
+        mass = 1.0
+        volume = 2.0
+        number_of_macroparticles = 5000
+        ion_density = 3.3e18
+
+        def run(particles_class, fluid_velocity, restart=False, **options):
+            vel = np.random.default_rng(1).normal(1.5, 1.0, number_of_macroparticles)
+            weight = np.full(vel.shape, 1e18 * volume / number_of_macroparticles)
+            ions = CX.IonFluid(
+                mass,
+                ion_density,
+                fluid_velocity * ion_density,
+                1.0,
+                volume,
+                CX.IonSampler(0),
+            )
+            neutrals = particles_class(mass, weight, vel)
+            momentum_before = ions.mom * volume + mass * np.sum(weight * vel)
+            CXrunner = CX.runner(
+                ions,
+                neutrals,
+                2000,
+                1e-8,
+                5e-14,
+                volume,
+                recorder=CX.Recorder(100),
+                **options
+            )
+            CXrunner.runCX(restart=restart)
+            momentum_after = ions.mom * volume + neutrals.total_momentum()
+            self.assertLess(
+                abs(momentum_after - momentum_before) / abs(momentum_before),
+                1e-14,
+                "Total Momentum not conserved by the hybrid model",
+            )
+            return CXrunner
+
+        self.assertLess(CX._mixture_departure(0.5, 2.0, 0.5, 2.0), 1e-14)
+        self.assertGreater(CX._mixture_departure(0.0, 1.0, 3.0, 1.0), 0.5)
+        # Relaxing neutrals start kinetic, hand over to the moment model once
+        # near-Maxwellian, and follow the kinetic run
+        kinetic = run(CX.Particles, 0.2)
+        hybrid = run(CX.HybridParticles, 0.2)
+        self.assertTrue(hybrid.neutrals.moment_mode)
+        self.assertEqual(hybrid.neutrals.number_of_switches, 1)
+        self.assertFalse(np.all(hybrid.recorder.std == hybrid.recorder.std[0]))
+        # The moment model follows the kinetic update of Maxwellian neutrals,
+        # so only sampling noise separates the two runs
+        for name, rtol in (
+            ("mean", 1e-3),
+            ("temperature_fluid", 1e-2),
+            ("temperature_particles", 1e-2),
+        ):
+            np.testing.assert_allclose(
+                getattr(hybrid.recorder, name),
+                getattr(kinetic.recorder, name),
+                rtol=rtol,
+            )
+
+        # Checkpoints save the moment mode without resampling it, and a restart
+        # continues the same trajectory
+        with tempfile.TemporaryDirectory() as directory:
+            checkpointed = run(
+                CX.HybridParticles, 0.2, checkpointer=CX.Checkpointer(directory, 250)
+            )
+            restarted = run(
+                CX.HybridParticles,
+                0.2,
+                restart=True,
+                checkpointer=CX.Checkpointer(directory, 250),
+            )
+        for CXrunner in (checkpointed, restarted):
+            self.assertEqual(CXrunner.neutrals.number_of_switches, 1)
+            self.assertEqual(CXrunner.ions.mom, hybrid.ions.mom)
+            self.assertEqual(CXrunner.ions.temperature, hybrid.ions.temperature)
+
+        # Reading vel resamples macroparticles matching the advanced moments
+        neutrals = hybrid.neutrals
+        kinetic_energy = neutrals.kinetic_energy
+        temperature = neutrals.temperature
+        vel = neutrals.vel
+        self.assertFalse(neutrals.moment_mode)
+        neutrals.updateKineticEnergy()
+        neutrals.updatetemperature()
+        self.assertAlmostEqual(neutrals.kinetic_energy / kinetic_energy, 1.0, places=13)
+        self.assertAlmostEqual(neutrals.temperature / temperature, 1.0, places=12)
+        self.assertLess(neutrals.shape_departure(), 0.2)
+        self.assertEqual(vel.shape, (number_of_macroparticles,))
+        with self.assertRaises(ValueError):
+            CX.HybridParticles(mass, np.ones(10), np.ones(10), dtype=np.float32)
+
 
 if __name__ == "__main__":
     unittest.main()